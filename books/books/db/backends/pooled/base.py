@@ -0,0 +1,62 @@
+"""
+django.db.backends.postgresql with a per-process connection pool.
+
+Django still "closes" the connection at the end of every request
+(CONN_MAX_AGE = 0), but close() returns it to the pool and the next
+connect() takes it from there, so a request does not pay for the TCP and
+authentication handshake. Pool settings go to DATABASES[alias]['POOL']:
+MIN_SIZE, MAX_SIZE, TIMEOUT (seconds to wait for a free connection),
+MAX_LIFETIME, MAX_IDLE and CHECK_IDLE (idle seconds after which a connection
+is pinged on checkout), see ConnectionPool.
+"""
+import psycopg2.extras
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base
+from django.utils.asyncio import async_unsafe
+
+from books.db.backends.pooled.creation import DatabaseCreation
+from books.db.backends.pooled.pool import get_pool
+
+POOL_DEFAULTS = {'MIN_SIZE': 1, 'MAX_SIZE': 10, 'TIMEOUT': 10, 'MAX_LIFETIME': 30 * 60, 'MAX_IDLE': 5 * 60,
+                 'CHECK_IDLE': 5}
+
+
+def connect(conn_params):
+    # то, что base.DatabaseWrapper.get_new_connection делает один раз на соединение
+    connection = base.Database.connect(**conn_params)
+    psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+    return connection
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None # пул, из которого взято текущее соединение
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        if self.alias == NO_DB_ALIAS: # служебное соединение с базой postgres для CREATE/DROP DATABASE
+            return super().get_new_connection(conn_params)
+
+        options = {**POOL_DEFAULTS, **self.settings_dict.get('POOL', {})}
+        pool = get_pool(self.alias, conn_params, lambda: connect(conn_params),
+                        {key.lower(): value for key, value in options.items()})
+        connection = pool.getconn()
+        self.pool = pool
+        isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+        if isolation_level is None:
+            self.isolation_level = connection.isolation_level
+        else:
+            self.isolation_level = isolation_level
+            if connection.isolation_level != isolation_level:
+                connection.set_session(isolation_level=isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None or self.pool is None:
+            return super()._close()
+        pool, self.pool = self.pool, None
+        with self.wrap_database_errors:
+            pool.putconn(self.connection)
@@ -0,0 +1,10 @@
+from django.db.backends.postgresql import creation
+
+from books.db.backends.pooled.pool import close_pools
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # DROP DATABASE не пройдет, пока в пуле остаются открытые соединения с тестовой базой
+        close_pools(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
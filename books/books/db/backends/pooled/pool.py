@@ -0,0 +1,255 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import psycopg2 as Database
+from psycopg2 import extensions
+
+# пулы процесса по (pid, alias, параметры подключения). Ключ с pid: после fork дочерний процесс заводит свои пулы,
+# а соединения родителя не закрывает - сокеты у них общие, и закрытие оборвало бы соединения родителя
+pools = {}
+pools_lock = threading.Lock()
+
+
+class PoolTimeout(Database.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections of one database.
+
+    getconn() hands out the most recently returned idle connection (LIFO,
+    so surplus ones stay idle and get closed after max_idle seconds, down to
+    min_size), opens a new one while fewer than max_size are open, or waits
+    up to timeout seconds for one to be returned. A connection idle for
+    check_idle seconds or more is pinged with SELECT 1 before it is handed
+    out, and one older than max_lifetime is replaced. putconn() rolls back
+    an unfinished transaction, resets the session with DISCARD ALL and drops
+    broken connections.
+    """
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10.0, max_lifetime=1800.0, max_idle=300.0,
+                 check_idle=5.0, name=''):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f'Invalid pool size: min {min_size}, max {max_size}')
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self.name = name
+        self.condition = threading.Condition()
+        self.idle = deque() # (соединение, когда открыто, когда возвращено), последнее возвращенное - справа
+        self.in_use = {} # id(соединения) -> когда открыто
+        self.size = 0 # открытые и открывающиеся соединения
+        self.stats = Counter()
+        self.closed = False
+
+    def fill(self):
+        # открываем min_size соединений заранее, чтобы первые запросы не платили за подключение
+        while True:
+            with self.condition:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            self.putconn(self.open())
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            connection, opened_at, returned_at = self.reserve(deadline)
+            if connection is None:
+                connection = self.open()
+                opened_at = time.monotonic()
+            elif not self.healthy(connection, opened_at, returned_at):
+                self.discard(connection)
+                continue
+            with self.condition:
+                self.in_use[id(connection)] = opened_at
+                self.stats['checkouts'] += 1
+            return connection
+
+    def reserve(self, deadline):
+        # свободное соединение из пула или место под новое; (None, ...) - открыть новое
+        with self.condition:
+            if self.closed:
+                raise Database.InterfaceError(f'Connection pool {self.name} is closed')
+            started = None
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if started is None:
+                    started = time.monotonic()
+                    self.stats['waits'] += 1
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    self.stats['wait_seconds'] += time.monotonic() - started
+                    raise PoolTimeout(f'No free connection in pool {self.name} after {self.timeout}s '
+                                      f'({self.max_size} in use)')
+                self.condition.wait(remaining)
+            if started is not None:
+                self.stats['wait_seconds'] += time.monotonic() - started
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+            return None, None, None
+
+    def open(self):
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.stats['opened'] += 1
+        return connection
+
+    def healthy(self, connection, opened_at, returned_at):
+        now = time.monotonic()
+        if connection.closed:
+            return False
+        if now - opened_at >= self.max_lifetime:
+            with self.condition:
+                self.stats['expired'] += 1
+            return False
+        if now - returned_at >= self.check_idle:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback() # без autocommit SELECT 1 открыл транзакцию
+            except Database.Error:
+                with self.condition:
+                    self.stats['failed_checks'] += 1
+                return False
+        return True
+
+    def putconn(self, connection):
+        with self.condition:
+            opened_at = self.in_use.pop(id(connection), None)
+        fresh = opened_at is None # только что открыто в fill(), сбрасывать нечего
+        if fresh:
+            opened_at = time.monotonic()
+        status = extensions.TRANSACTION_STATUS_UNKNOWN if connection.closed else connection.info.transaction_status
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                connection.rollback()
+                status = extensions.TRANSACTION_STATUS_IDLE
+            except Database.Error:
+                status = extensions.TRANSACTION_STATUS_UNKNOWN
+        expired = self.closed or time.monotonic() - opened_at >= self.max_lifetime
+        if status == extensions.TRANSACTION_STATUS_IDLE and not expired and not fresh:
+            try:
+                self.reset(connection)
+            except Database.Error:
+                status = extensions.TRANSACTION_STATUS_UNKNOWN
+        if expired or status != extensions.TRANSACTION_STATUS_IDLE:
+            self.discard(connection)
+            return
+
+        with self.condition:
+            self.idle.append((connection, opened_at, time.monotonic()))
+            stale = self.take_stale()
+            self.condition.notify()
+        for connection in stale:
+            self.discard(connection)
+
+    def reset(self, connection):
+        # SET, временные таблицы, advisory-блокировки, LISTEN и WITH HOLD курсоры запроса не должны достаться следующему.
+        # DISCARD ALL не выполняется внутри транзакции, а без autocommit psycopg2 открыл бы ее перед запросом
+        autocommit = connection.autocommit
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('DISCARD ALL')
+        connection.autocommit = autocommit
+        if (connection.isolation_level, connection.readonly, connection.deferrable) != (None, None, None):
+            # сервер уже вернул умолчания, а psycopg2 помнит прежние и не стал бы их заново выставлять
+            connection.set_session(isolation_level='DEFAULT', readonly='DEFAULT', deferrable='DEFAULT')
+
+    def take_stale(self):
+        # слева - дольше всех простаивающие. Вызывается под self.condition
+        stale = []
+        now = time.monotonic()
+        while self.idle and self.size - len(stale) > self.min_size and now - self.idle[0][2] >= self.max_idle:
+            stale.append(self.idle.popleft()[0])
+        return stale
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        finally:
+            with self.condition:
+                self.size -= 1
+                self.stats['closed'] += 1
+                self.condition.notify()
+
+    def close(self):
+        # выданные соединения закроются при возврате
+        with self.condition:
+            self.closed = True
+            idle = [connection for connection, _, _ in self.idle]
+            self.idle.clear()
+        for connection in idle:
+            self.discard(connection)
+
+    def metrics(self):
+        with self.condition:
+            return dict(self.stats, idle=len(self.idle), in_use=len(self.in_use), size=self.size)
+
+
+def get_pool(alias, conn_params, connect, options):
+    key = (os.getpid(), alias, repr(sorted(conn_params.items())))
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is not None and not pool.closed:
+            return pool
+        pool = pools[key] = ConnectionPool(connect, name=f'{alias}:{conn_params.get("database")}', **options)
+    pool.fill()
+    return pool
+
+
+def pools_of(alias=None):
+    with pools_lock:
+        return [pool for (pid, pool_alias, _), pool in pools.items()
+                if pid == os.getpid() and alias in (None, pool_alias)]
+
+
+def close_pools(alias=None):
+    # закрытые пулы убираем и из pools, чтобы они не оставались в метриках
+    with pools_lock:
+        keys = [key for key in pools if key[0] == os.getpid() and alias in (None, key[1])]
+        closing = [pools.pop(key) for key in keys]
+    for pool in closing:
+        pool.close()
+
+
+POOL_METRICS = (
+    ('store_db_pool_connections', 'gauge', 'Open connections of the pool', None),
+    ('store_db_pool_checkouts_total', 'counter', 'Connections handed out', 'checkouts'),
+    ('store_db_pool_waits_total', 'counter', 'Checkouts that had to wait for a free connection', 'waits'),
+    ('store_db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a free connection', 'wait_seconds'),
+    ('store_db_pool_timeouts_total', 'counter', 'Checkouts that gave up after the pool timeout', 'timeouts'),
+    ('store_db_pool_opened_total', 'counter', 'Connections opened', 'opened'),
+    ('store_db_pool_closed_total', 'counter', 'Connections closed', 'closed'),
+    ('store_db_pool_failed_checks_total', 'counter', 'Idle connections that failed the health check', 'failed_checks'),
+    ('store_db_pool_expired_total', 'counter', 'Connections replaced after max lifetime', 'expired'),
+)
+
+
+def pool_metrics():
+    # строки в формате Prometheus для MetricsRegistry.add_collector
+    stats = sorted((pool.name, pool.metrics()) for pool in pools_of())
+    lines = []
+    for metric, kind, help_text, key in POOL_METRICS:
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+        for name, values in stats:
+            if key is None:
+                lines += [f'{metric}{{pool="{name}",state="idle"}} {values["idle"]}',
+                          f'{metric}{{pool="{name}",state="in_use"}} {values["in_use"]}']
+            else:
+                lines.append(f'{metric}{{pool="{name}"}} {values.get(key, 0)}')
+    return lines
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -23,6 +24,9 @@ SECRET_KEY = 'django-insecure-(s^=9ja_z1dcu!e7ac=dl7qm6)vp)#%w89$3e0!%^2n@_pfawb
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
+# debug toolbar тяжелый (и только sync, под ASGI тормозит каждый запрос), поэтому только в отладке.
+# Метрики запросов в проде собирает store.metrics.RequestMetricsMiddleware
+DEBUG_TOOLBAR = DEBUG and os.environ.get('BOOKS_DEBUG_TOOLBAR', '1') == '1'
 # APPEND_SLASH = False
 
 
@@ -37,8 +41,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
-    "debug_toolbar",
     'social_django',
 
     'store',
@@ -49,6 +53,7 @@ INTERNAL_IPS = [
 ]
 
 MIDDLEWARE = [
+    'store.metrics.RequestMetricsMiddleware', # первым, чтобы общее время включало остальные middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,12 +61,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
-    'debug_toolbar_force.middleware.ForceDebugToolbarMiddleware',
-
 ]
 
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.insert(INSTALLED_APPS.index('social_django'), 'debug_toolbar')
+    MIDDLEWARE += [
+        'debug_toolbar.middleware.DebugToolbarMiddleware',
+        'debug_toolbar_force.middleware.ForceDebugToolbarMiddleware',
+    ]
+
 ROOT_URLCONF = 'books.urls'
 
 TEMPLATES = [
@@ -95,15 +103,34 @@ WSGI_APPLICATION = 'books.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # 'ENGINE': 'django.db.backends.postgresql', # соединение открывалось и закрывалось на каждый запрос
+        'ENGINE': 'books.db.backends.pooled', # тот же postgresql, но close() в конце запроса возвращает соединение в пул
         'NAME': 'books_db',
         'USER': 'books_user',
         'PASSWORD': '',
         'HOST': 'localhost',
         'PORT': '',
+        # пул на процесс, см. books/db/backends/pooled. CONN_MAX_AGE остается 0: соединение возвращается в пул после каждого запроса
+        'POOL': {
+            'MIN_SIZE': 2,
+            'MAX_SIZE': 20, # сколько потоков процесса одновременно держат соединение, остальные ждут до TIMEOUT секунд
+            'TIMEOUT': 10,
+            'MAX_LIFETIME': 30 * 60,
+            'MAX_IDLE': 5 * 60, # лишние сверх MIN_SIZE соединения закрываются после стольких секунд простоя
+            'CHECK_IDLE': 5, # простоявшее дольше соединение перед выдачей проверяется SELECT 1
+        },
     }
 }
 
+# реплики только для чтения: BOOKS_DB_REPLICA_HOSTS=replica1.local,replica2.local - та же база и пользователь, что у default.
+# На них уходят чтения безопасных запросов BookViewSet, см. store.replicas.ReplicaRouter и store.views.ReplicaReadMixin
+for number, host in enumerate(filter(None, os.environ.get('BOOKS_DB_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{number}'] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['store.replicas.ReplicaRouter']
+STORE_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+STORE_REPLICA_LAG = 5 # секунд: столько после записи пользователь читает с primary
+
 AUTHENTICATION_BACKENDS = (
     # 'social_core.backends.open_id.OpenIdAuth',
     # 'social_core.backends.google.GoogleOpenId',
@@ -115,6 +142,28 @@ AUTHENTICATION_BACKENDS = (
     'social_core.backends.github.GithubOAuth2',
 )
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'books',
+    }
+}
+
+# LocMemCache у каждого процесса свой. Ответы от этого не устаревают (ключи строятся из версий в базе), но общий кеш,
+# например redis (пакет django-redis, poetry install -E redis), не греется заново в каждом воркере:
+# BOOKS_REDIS_URL=redis://127.0.0.1:6379/1
+if os.environ.get('BOOKS_REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ['BOOKS_REDIS_URL'],
+    }
+
+STORE_CACHE_ALIAS = 'default'
+STORE_CACHE_TIMEOUT = 60 * 5 # ответы BookViewSet, после изменения книг и связей не читаются и просто истекают
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -163,8 +212,24 @@ REST_FRAMEWORK = {
     'DEFAULT_PARSER_CLASSES': (
         'rest_framework.parsers.JSONParser',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'store.pagination.KeysetPagination', # курсорная пагинация, глубокие страницы не дороже первой
+    'PAGE_SIZE': 20,
 }
 
+STORE_FAST_LIST = True # GET /book/ собирается из .values() без ModelSerializer, см. store.views.FastBookListMixin
+STORE_READERS_PREVIEW_SIZE = 5 # сколько читателей показывать в списке книг, полный список - /book/{id}/readers/
+STORE_EXPORT_CHUNK_SIZE = 2000 # строк за одно чтение server-side курсора в /book/export/
+# пересчет рейтинга после оценки: 'sync' - сразу в запросе, 'thread' - фоновым потоком, 'db' - через таблицу заданий
+# и команду drain_rating_queue. 'thread' имеет смысл только в долгоживущих процессах веб-сервера: короткий процесс
+# (команда, import_books) дожидается потока при выходе. Включается, например, так: BOOKS_RATING_QUEUE=thread
+STORE_RATING_QUEUE = os.environ.get('BOOKS_RATING_QUEUE', 'sync')
+STORE_RATING_QUEUE_DELAY = 0.5 # сколько секунд поток копит оценки, прежде чем пересчитать
+STORE_RELATIONS_BULK_LIMIT = 1000 # максимум элементов в одном POST /book_relation/bulk/
+STORE_BOOKS_BULK_LIMIT = 1000 # максимум книг в одном PATCH/DELETE /book/bulk/
+STORE_SIMILAR_BOOKS = 20 # сколько похожих книг хранить на книгу, см. build_similar_books
+STORE_RECOMMENDED_BOOKS = 20 # длина ленты /book/recommended/
+STORE_SIMILARITY_ENGINE = 'auto' # 'scipy', если установлены numpy и scipy, иначе 'python'
+
 SOCIAL_AUTH_JSONFIELD_ENABLED = True
 
 SOCIAL_AUTH_GITHUB_KEY = '4ede233efad0b838c4b2'
@@ -0,0 +1,12 @@
+"""
+Settings for the test suite: python manage.py test --settings=books.settings_test
+(or DJANGO_SETTINGS_MODULE=books.settings_test, e.g. for pytest-django).
+"""
+
+from books.settings import *  # noqa: F401,F403
+
+# зеркало default не видит данных из транзакции TestCase, поэтому тесты идут без реплик, а тесты роутера
+# включают отдельную базу 'replica' через override_settings. Данные в ней свои, так видно, откуда читал запрос
+DATABASES = {alias: database for alias, database in DATABASES.items() if alias == 'default'}
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'NAME': f'test_{DATABASES["default"]["NAME"]}_replica'})
+STORE_DB_REPLICAS = []
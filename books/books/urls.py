@@ -13,24 +13,31 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from rest_framework.routers import SimpleRouter
 from django.conf.urls import url
 from django.urls import include
 
-from store.views import BookViewSet, auth, UserBookRelationView
+from store.views import BookViewSet, MyBooksView, auth, UserBookRelationView, book_detail_async, book_list_async, metrics
 
 router = SimpleRouter()
 
 router.register(r'book', BookViewSet)
 router.register(r'book_relation', UserBookRelationView)
+router.register(r'me/books', MyBooksView, basename='my-books')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url('', include('social_django.urls', namespace='social')),
     path('auth/', auth),
-    path("__debug__/", include("debug_toolbar.urls")),
+    path('async/book/', book_list_async, name='book-list-async'), # те же list/retrieve, что и /book/, для запуска под ASGI
+    path('async/book/<int:pk>/', book_detail_async, name='book-detail-async'),
+    path('metrics/', metrics, name='metrics'),
 ]
 
+if settings.DEBUG_TOOLBAR:
+    urlpatterns.append(path("__debug__/", include("debug_toolbar.urls")))
+
 urlpatterns += router.urls
@@ -6,7 +6,7 @@ from store.models import Book, UserBookRelation
 
 @admin.register(Book)
 class BookAdmin(ModelAdmin):
-    pass
+    readonly_fields = Book.AGGREGATE_FIELDS # агрегаты пересчитываются из UserBookRelation, руками их не правим
 
 
 # admin.site.register(Book) # можно так добавлять в админку
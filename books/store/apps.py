@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+
+    def ready(self):
+        import store.metrics # noqa: F401 - подключаем обработчики сигналов
+        import store.signals # noqa: F401
+        from books.db.backends.pooled.pool import pool_metrics
+        from store.metrics import registry
+        registry.add_collector(pool_metrics) # метрики пулов на /metrics/
@@ -0,0 +1,80 @@
+import itertools
+import random
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from store.logic import recalc_book_aggregates, refresh_search_vectors
+from store.models import Book, UserBookRelation
+
+# синтетические данные для seed_books, bench_api и bench_search
+WORDS = ['war', 'peace', 'dead', 'souls', 'crime', 'punishment', 'idiot', 'demons', 'mother', 'fathers', 'sons',
+         'garden', 'cherry', 'master', 'margarita', 'quiet', 'flows', 'don', 'white', 'guard', 'heart', 'dog']
+AUTHORS = ['Tolstoy', 'Dostoevsky', 'Gogol', 'Chekhov', 'Turgenev', 'Bulgakov', 'Sholokhov', 'Pushkin', 'Bunin']
+BENCH_USER_PREFIX = 'bench_user_'
+# оценки ставят реже, чем лайкают, и чаще высокие
+RATE_WEIGHTS = {1: 5, 2: 7, 3: 18, 4: 35, 5: 35}
+
+
+def bench_users():
+    return User.objects.filter(username__startswith=BENCH_USER_PREFIX)
+
+
+def without_debug_toolbar(middleware=None):
+    # debug toolbar собирает панели на каждый запрос и искажает замеры
+    return [name for name in middleware or settings.MIDDLEWARE if not name.startswith('debug_toolbar')]
+
+
+def synthetic_books(rnd, count, start=0, owners=()):
+    return [Book(name=f'{" ".join(rnd.sample(WORDS, 3))} {i}', price=rnd.randint(100, 5000) / 100,
+                 author_name=f'{rnd.choice(AUTHORS)} {rnd.randint(1, 500)}',
+                 discount=rnd.choice([None, None, 0, 5, 10, 20, 50]),
+                 owner=rnd.choice(owners) if owners else None)
+            for i in range(start, start + count)]
+
+
+def seed_dataset(books, users, relations, seed=0, batch_size=5000, like_share=0.3, rate_share=0.4,
+                 bookmark_share=0.15, bought_share=0.1):
+    """
+    Creates bench users, books and relations. Books get relations with a
+    Zipf-like popularity: a few books have most of the readers, as in a real
+    catalogue. Aggregates and search vectors are rebuilt set-based at the end.
+    The same seed gives the same dataset.
+    """
+    rnd = random.Random(seed)
+    with transaction.atomic():
+        first_user = bench_users().count()
+        User.objects.bulk_create([User(username=f'{BENCH_USER_PREFIX}{i}', first_name=f'Reader{i}', last_name='Bench')
+                                  for i in range(first_user, first_user + users)], batch_size=batch_size)
+        user_ids = list(bench_users().values_list('id', flat=True))
+        owners = list(User.objects.filter(pk__in=user_ids[:50]))
+
+        first_book = Book.objects.count()
+        for start in range(0, books, batch_size):
+            Book.objects.bulk_create(synthetic_books(rnd, min(batch_size, books - start), first_book + start, owners))
+        book_ids = list(Book.objects.order_by('-id').values_list('id', flat=True)[:books])
+
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(book_ids))))
+        pairs = set()
+        attempts = 0
+        while len(pairs) < relations and attempts < relations * 20: # пары (user, book) уникальны
+            size = min(batch_size, relations - len(pairs))
+            for book_id in rnd.choices(book_ids, cum_weights=cum_weights, k=size):
+                pairs.add((rnd.choice(user_ids), book_id))
+            attempts += size
+        pairs = sorted(pairs)
+        for start in range(0, len(pairs), batch_size):
+            UserBookRelation.objects.bulk_create([
+                UserBookRelation(user_id=user_id, book_id=book_id,
+                                 like=rnd.random() < like_share,
+                                 in_bookmarks=rnd.random() < bookmark_share,
+                                 bought=rnd.random() < bought_share,
+                                 rate=rnd.choices(list(RATE_WEIGHTS), list(RATE_WEIGHTS.values()))[0]
+                                 if rnd.random() < rate_share else None)
+                for user_id, book_id in pairs[start:start + batch_size]
+            ], ignore_conflicts=True) # связи bulk_create не проходят через save, агрегаты пересчитываем ниже
+
+        recalc_book_aggregates(Book.objects.filter(pk__in=book_ids))
+        refresh_search_vectors(Book.objects.filter(search_vector__isnull=True))
+    return len(book_ids), users, len(pairs)
@@ -0,0 +1,136 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from store.models import Book, CatalogVersion
+
+# ETag и ключи кеша строятся из версий в базе, а не из токенов в кеше: кеш у каждого воркера может быть свой (LocMem),
+# а база общая. Версии читаются той же базой, что и ответ, так что ответ с отстающей реплики ложится под ее же версию
+
+
+def get_cache():
+    return caches[settings.STORE_CACHE_ALIAS]
+
+
+def request_versions(request, key, get_version):
+    # ConditionalReadMixin и CachedReadMixin спрашивают одну и ту же версию, читаем ее один раз за запрос
+    versions = request.__dict__.setdefault('store_versions', {})
+    if key not in versions:
+        versions[key] = get_version()
+    return versions[key]
+
+
+def list_version(request):
+    # None - книги еще ни разу не менялись
+    return request_versions(request, 'list', lambda: CatalogVersion.objects.values_list('version', flat=True).first())
+
+
+def book_version(request, book_id):
+    # None - книги нет или кривой id
+    def get_version():
+        try:
+            return Book.objects.filter(pk=book_id).values_list('version', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+    return request_versions(request, ('book', book_id), get_version)
+
+
+def request_user_id(request):
+    # в ответе есть my_relation, так что у каждого пользователя свои кеш и ETag, у анонимных - общие
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def replica_pin_key(user_id):
+    return f'store:db:pinned:{user_id}'
+
+
+def pin_to_primary(request):
+    # после записи пользователь STORE_REPLICA_LAG секунд читает с primary и сразу видит свой лайк или оценку
+    user_id = request_user_id(request)
+    if user_id is not None:
+        get_cache().set(replica_pin_key(user_id), True, settings.STORE_REPLICA_LAG)
+
+
+def pinned_to_primary(request):
+    user_id = request_user_id(request)
+    return user_id is not None and get_cache().get(replica_pin_key(user_id), False)
+
+
+def normalized_query(request):
+    # один и тот же запрос с параметрами в другом порядке должен попасть в тот же ключ
+    params = sorted((key, request.query_params.getlist(key)) for key in request.query_params)
+    return repr((request.scheme, request.get_host(), request.path, params, request_user_id(request)))
+
+
+def query_digest(versions, request):
+    return hashlib.sha1(repr((versions, normalized_query(request))).encode('utf-8')).hexdigest()
+
+
+def response_cache_key(action, versions, request):
+    return f'store:books:response:{action}:{query_digest(versions, request)}'
+
+
+class ConditionalReadMixin:
+    """
+    Strong ETags for list/retrieve. If-None-Match is checked before the
+    queryset and serializer run: the list ETag comes from CatalogVersion,
+    the detail ETag from Book.version (it also grows with the book's
+    relations and with renames of its owner and readers).
+    """
+    def list(self, request, *args, **kwargs):
+        etag = quote_etag(query_digest(list_version(request), request))
+        return self.conditional_response(request, etag, lambda: super(ConditionalReadMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        book_id = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        version = book_version(request, book_id)
+        if version is None: # пусть retrieve отдаст 404 как обычно
+            return super().retrieve(request, *args, **kwargs)
+        etag = quote_etag(query_digest((book_id, version), request))
+        return self.conditional_response(request, etag, lambda: super(ConditionalReadMixin, self).retrieve(request, *args, **kwargs))
+
+    def conditional_response(self, request, etag, get_response):
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        response = get_response()
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
+
+
+class CachedReadMixin:
+    """
+    Read-through cache for list/retrieve, keyed on the same database versions
+    as the ETags. Writes bump the versions, so stale entries are never read
+    again and just expire.
+    """
+    def list(self, request, *args, **kwargs):
+        key = response_cache_key('list', list_version(request), request)
+        return self.cached_response(key, lambda: super(CachedReadMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        book_id = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        version = book_version(request, book_id)
+        if version is None:
+            return super().retrieve(request, *args, **kwargs)
+        key = response_cache_key('retrieve', (book_id, version), request)
+        return self.cached_response(key, lambda: super(CachedReadMixin, self).retrieve(request, *args, **kwargs))
+
+    def cached_response(self, key, get_response):
+        cache = get_cache()
+        data = cache.get(key)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        response = get_response()
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.STORE_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
@@ -0,0 +1,74 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from django_filters import FilterSet, NumberFilter
+from rest_framework.filters import OrderingFilter, SearchFilter
+
+from store.models import SEARCH_CONFIG, Book
+
+
+class BookSearchFilter(SearchFilter):
+    """
+    The same ?search= API as SearchFilter, but backed by Book.search_vector
+    (GIN index) instead of ILIKE '%term%' on every search field.
+    Every word must match a word prefix in name or author_name. Results are
+    ranked unless an explicit ?ordering= is given.
+    """
+    word_re = re.compile(r'\w+')
+
+    def get_search_query(self, request):
+        words = [word for term in self.get_search_terms(request) for word in self.word_re.findall(term)]
+        if not words:
+            return None
+        # слова состоят только из \w, так что синтаксис tsquery в них не пролезет
+        return SearchQuery(' & '.join(f'{word}:*' for word in words), search_type='raw', config=SEARCH_CONFIG)
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_query(request)
+        if query is None:
+            return queryset
+        # ранг приводим к double precision, чтобы он без потерь проходил через курсор пагинации
+        rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+        return queryset.filter(search_vector=query).annotate(search_rank=rank).order_by('-search_rank', 'id')
+
+
+class BookFilter(FilterSet):
+    # диапазоны по полям, которые раньше считались в annotate, теперь это хранимые колонки с индексами
+    price_with_discount__gte = NumberFilter(field_name='price_with_discount', lookup_expr='gte')
+    price_with_discount__lte = NumberFilter(field_name='price_with_discount', lookup_expr='lte')
+    annotated_likes__gte = NumberFilter(field_name='likes_count', lookup_expr='gte')
+    annotated_likes__lte = NumberFilter(field_name='likes_count', lookup_expr='lte')
+
+    class Meta:
+        model = Book
+        fields = {
+            'id': ['exact'],
+            'price': ['exact'],
+            'name': ['exact'],
+            'rating': ['gte', 'lte'],
+        }
+
+
+class BookOrderingFilter(OrderingFilter):
+    """
+    OrderingFilter that lets the API name of a field differ from the column
+    it is sorted by: view.ordering_aliases maps e.g. annotated_likes (the
+    serializer field) to likes_count, which has an index. view.ordering_filters
+    maps a field to a Q applied only when sorting by it.
+    """
+    def filter_queryset(self, request, queryset, view):
+        filters = getattr(view, 'ordering_filters', {})
+        for name in self.get_ordering(request, queryset, view) or []:
+            if name.lstrip('-') in filters:
+                queryset = queryset.filter(filters[name.lstrip('-')])
+        return super().filter_queryset(request, queryset, view)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        aliases = getattr(view, 'ordering_aliases', {})
+        if not ordering or not aliases:
+            return ordering
+        return [('-' if name.startswith('-') else '') + aliases.get(name.lstrip('-'), name.lstrip('-'))
+                for name in ordering]
@@ -0,0 +1,193 @@
+import csv
+import json
+import os
+from collections import Counter
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+
+from store.logic import recalc_book_aggregates, refresh_search_vectors
+from store.models import Book, UserBookRelation
+
+FORMATS = {'.csv': 'csv', '.json': 'json', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+BOOK_FIELDS = ('name', 'price', 'author_name', 'discount')
+RELATION_FIELDS = ('like', 'in_bookmarks', 'rate', 'bought')
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'f', 'no', 'n'}
+
+
+class ImportRecordError(ValueError):
+    pass
+
+
+def detect_format(path):
+    try:
+        return FORMATS[os.path.splitext(path)[1].lower()]
+    except KeyError:
+        raise ImportRecordError(f'{path}: unknown format, expected one of {", ".join(sorted(FORMATS))}')
+
+
+def read_records(path, format=None):
+    """
+    Yields (record number, dict) pairs. CSV and JSONL are read line by line,
+    a .json file must hold a list of records and is loaded whole.
+    """
+    format = format or detect_format(path)
+    with open(path, newline='', encoding='utf-8') as file:
+        if format == 'csv':
+            yield from enumerate(csv.DictReader(file), 2) # первая строка - заголовок
+            return
+
+        if format == 'jsonl':
+            lines = ((number, line) for number, line in enumerate(file, 1) if line.strip())
+        else:
+            lines = [(None, file.read())]
+        for number, line in lines:
+            try:
+                data = json.loads(line)
+            except ValueError as error:
+                raise ImportRecordError(f'record {number or "?"}: invalid JSON: {error}')
+            if number is not None:
+                yield number, data
+            elif isinstance(data, list):
+                yield from enumerate(data, 1)
+            else:
+                raise ImportRecordError(f'{path}: expected a JSON list of records')
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def clean_value(model, name, value, number):
+    # те же проверки, что у полей модели: max_length, max_digits, choices
+    field = model._meta.get_field(name)
+    if isinstance(value, str):
+        value = value.strip()
+    if value == '':
+        value = None
+    if isinstance(field, models.BooleanField):
+        if value is None:
+            return False
+        if isinstance(value, str) and value.lower() in TRUE_VALUES | FALSE_VALUES:
+            return value.lower() in TRUE_VALUES
+    elif value is None and field.null:
+        return None
+    try:
+        return field.clean(value, None)
+    except ValidationError as error:
+        raise ImportRecordError(f'record {number}: {name}: {" ".join(error.messages)}')
+
+
+def record_key(record, name, number):
+    value = record.get(name)
+    value = str(value).strip() if value is not None else ''
+    if not value:
+        raise ImportRecordError(f'record {number}: {name} is required')
+    return value
+
+
+class BookImport:
+    """
+    Batched import of books and relations for import_books.
+
+    Books are keyed by Book.external_id: records whose external_id is already
+    in the database are skipped, relations that already exist are left as
+    they are, so an interrupted import can simply be run again. bulk_create
+    bypasses Book.save and UserBookRelation.save, so ratings, counters and
+    search vectors of every book mentioned in the files are recomputed
+    set-based in finish().
+    """
+    def __init__(self, batch_size=2000, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.counts = Counter()
+        self.user_ids = {}
+        self.book_ids = {} # external_id -> id всех книг из файлов, и новых, и импортированных раньше
+
+    def import_books(self, records):
+        for batch in batches(records, self.batch_size):
+            with transaction.atomic():
+                self.save_books(batch)
+            self.report()
+
+    def import_relations(self, records):
+        for batch in batches(records, self.batch_size):
+            with transaction.atomic():
+                self.save_relations([(number, record_key(record, 'book', number), record) for number, record in batch])
+            self.report()
+
+    def save_books(self, batch):
+        books, relations = {}, []
+        for number, record in batch:
+            if not isinstance(record, dict):
+                raise ImportRecordError(f'record {number}: expected an object')
+            key = record_key(record, 'external_id', number)
+            values = {name: clean_value(Book, name, record.get(name), number) for name in BOOK_FIELDS}
+            owner = record.get('owner')
+            books.setdefault(key, (values, str(owner).strip() if owner else None)) # повтор external_id - как повторный импорт
+            relations += [(number, key, relation) for relation in record.get('relations') or []]
+
+        self.counts['books'] += len(batch)
+        self.book_ids.update(Book.objects.filter(external_id__in=books).values_list('external_id', 'id'))
+        new = {key: value for key, value in books.items() if key not in self.book_ids}
+        owner_ids = self.resolve_users({owner for _, owner in new.values() if owner})
+        created = Book.objects.bulk_create([
+            Book(external_id=key, owner_id=owner_ids.get(owner), **values)
+            for key, (values, owner) in new.items()
+        ])
+        self.book_ids.update((book.external_id, book.pk) for book in created)
+        self.counts['created'] += len(created)
+        self.counts['skipped'] += len(books) - len(created)
+        if relations:
+            self.save_relations(relations)
+
+    def save_relations(self, relations):
+        missing = {key for _, key, _ in relations if key not in self.book_ids}
+        if missing:
+            self.book_ids.update(Book.objects.filter(external_id__in=missing).values_list('external_id', 'id'))
+
+        rows = {}
+        for number, key, relation in relations:
+            if not isinstance(relation, dict):
+                raise ImportRecordError(f'record {number}: expected an object')
+            if key not in self.book_ids:
+                raise ImportRecordError(f'record {number}: unknown book {key!r}')
+            username = record_key(relation, 'user', number)
+            values = {name: clean_value(UserBookRelation, name, relation.get(name), number) for name in RELATION_FIELDS}
+            rows.setdefault((username, self.book_ids[key]), values)
+
+        user_ids = self.resolve_users({username for username, _ in rows})
+        UserBookRelation.objects.bulk_create([
+            UserBookRelation(user_id=user_ids[username], book_id=book_id, **values)
+            for (username, book_id), values in rows.items()
+        ], ignore_conflicts=True) # уже существующие связи не трогаем
+        self.counts['relations'] += len(rows)
+
+    def resolve_users(self, usernames):
+        missing = usernames - self.user_ids.keys()
+        if missing:
+            existing = set(User.objects.filter(username__in=missing).values_list('username', flat=True))
+            # новые пользователи без пароля: войти смогут только после сброса пароля
+            User.objects.bulk_create([User(username=username, password=make_password(None))
+                                      for username in sorted(missing - existing)], ignore_conflicts=True)
+            self.counts['users'] += len(missing - existing)
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        return self.user_ids
+
+    def finish(self):
+        book_ids = sorted(set(self.book_ids.values()))
+        for batch in batches(book_ids, self.batch_size):
+            with transaction.atomic():
+                recalc_book_aggregates(Book.objects.filter(pk__in=batch))
+                refresh_search_vectors(Book.objects.filter(pk__in=batch, search_vector__isnull=True))
+        return len(book_ids)
+
+    def report(self):
+        if self.progress:
+            self.progress(self.counts)
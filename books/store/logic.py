@@ -1,11 +1,435 @@
-from django.db.models import Avg
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, models, router, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
 
-from store.models import UserBookRelation
+from store.models import SHELVES, Book, BookStats, UserBookRelation, UserShelfStats, book_search_vector
+from store.rating_queue import get_rating_queue
+
+# поле связи -> счетчик в Book
+COUNTERS = {
+    'like': 'likes_count',
+    'in_bookmarks': 'bookmarks_count',
+    'bought': 'buyers_count',
+}
+
+# полка -> счетчик в UserShelfStats
+SHELF_COUNTERS = {shelf: f'{shelf}_count' for shelf in SHELVES}
+
+
+def rating_expression(rating_sum, rating_count):
+    # рейтинг считается в самой базе из суммы и количества оценок: NullIf дает NULL, если оценок не осталось
+    return Cast(rating_sum, models.DecimalField(max_digits=12, decimal_places=2)) / NullIf(rating_count, Value(0))
+
+
+def relation_updates(old, new, rating=True):
+    # old/new - значения полей связи до и после изменения (None - связи нет). Возвращает F()-выражения для UPDATE книги.
+    # rating=False - рейтинг не трогаем, его пересчитает очередь
+    updates = {}
+    readers_delta = (new is not None) - (old is not None)
+    if readers_delta:
+        updates['readers_count'] = F('readers_count') + readers_delta
+
+    old = old or {}
+    new = new or {}
+    for field, counter in COUNTERS.items():
+        delta = bool(new.get(field)) - bool(old.get(field))
+        if delta:
+            updates[counter] = F(counter) + delta
+
+    old_rate, new_rate = old.get('rate'), new.get('rate')
+    rate_delta = (new_rate or 0) - (old_rate or 0)
+    count_delta = (new_rate is not None) - (old_rate is not None)
+    if rating and (rate_delta or count_delta):
+        updates['rating_sum'] = F('rating_sum') + rate_delta
+        updates['rating_count'] = F('rating_count') + count_delta
+        updates['rating'] = rating_expression(F('rating_sum') + rate_delta, F('rating_count') + count_delta)
+
+    # любое изменение связи видно в ответе книги (счетчики, рейтинг, readers, my_relation), а ответы кешируются по Book.version.
+    # Заодно это покупки, от которых зависят похожие книги (store.recommendations)
+    if old != new:
+        updates['version'] = F('version') + 1
+    return updates
+
+
+def apply_relation_change(book_id, old, new):
+    # инкрементальный пересчет: вместо Avg и Count по всем связям книги меняем агрегаты через F(), одним UPDATE
+    queue = get_rating_queue()
+    updates = relation_updates(old, new, rating=not queue.deferred)
+    if updates:
+        Book.objects.filter(pk=book_id).update(**updates)
+    if queue.deferred and (old or {}).get('rate') != (new or {}).get('rate'):
+        queue.schedule([book_id]) # рейтинг пересчитается позже, одним запросом на все накопившиеся оценки книги
+
+
+def rating_totals():
+    # подзапросы с настоящими суммой и количеством оценок книги, для полного пересчета и проверки
+    rates = UserBookRelation.objects.filter(book=OuterRef('pk'), rate__isnull=False).order_by().values('book')
+    rating_sum = Coalesce(Subquery(rates.annotate(total=Sum('rate')).values('total')), 0)
+    rating_count = Coalesce(Subquery(rates.annotate(total=Count('rate')).values('total')), 0)
+    return rating_sum, rating_count
+
+
+def counter_totals():
+    relations = UserBookRelation.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    totals = {counter: Coalesce(Subquery(relations.annotate(total=Count('pk', filter=Q(**{field: True})))
+                                      .values('total')), 0)
+              for field, counter in COUNTERS.items()}
+    totals['readers_count'] = Coalesce(Subquery(relations.annotate(total=Count('pk')).values('total')), 0)
+    return totals
+
+
+def recalc_ratings(books):
+    # полный пересчет агрегатов для queryset книг одним UPDATE
+    rating_sum, rating_count = rating_totals()
+    return books.update(rating_sum=rating_sum,
+                        rating_count=rating_count,
+                        rating=rating_expression(rating_sum, rating_count),
+                        version=F('version') + 1)
+
+
+def recalc_counters(books):
+    return books.update(version=F('version') + 1, **counter_totals())
+
+
+def recalc_book_aggregates(books):
+    # рейтинг и счетчики сразу, например после массовых изменений связей
+    rating_sum, rating_count = rating_totals()
+    return books.update(rating_sum=rating_sum,
+                        rating_count=rating_count,
+                        rating=rating_expression(rating_sum, rating_count),
+                        version=F('version') + 1,
+                        **counter_totals())
+
+
+def ratings_drift(books):
+    # книги, у которых сохраненные агрегаты разошлись с реальными оценками
+    rating_sum, rating_count = rating_totals()
+    return books.annotate(expected_sum=rating_sum, expected_count=rating_count).exclude(
+        rating_sum=F('expected_sum'), rating_count=F('expected_count'))
+
+
+def counters_drift(books):
+    totals = counter_totals()
+    return books.annotate(**{f'expected_{counter}': total for counter, total in totals.items()}).exclude(
+        **{counter: F(f'expected_{counter}') for counter in totals})
+
+
+def refresh_search_vectors(books):
+    # для массовых вставок и обновлений, где Book.save не вызывается
+    return books.update(search_vector=book_search_vector('name', 'author_name'))
+
+
+def book_stats_select():
+    # строки BookStats, посчитанные заново из книг, как в триггере store_book_stats_upsert (миграции 0020 и 0025)
+    connection = connections[router.db_for_write(BookStats)]
+    quote = connection.ops.quote_name
+    books, users = quote(Book._meta.db_table), quote(User._meta.db_table)
+    return (f'SELECT b.id AS book_id, '
+            f'CASE WHEN b.discount IS NULL OR b.discount = 0 THEN b.price ELSE b.price - (b.price * b.discount) / 100 END '
+            f'AS price_with_discount, u.username AS owner_name '
+            f'FROM {books} b LEFT JOIN {users} u ON u.id = b.owner_id'), connection
+
+
+def rebuild_book_stats(book_ids=None):
+    # полная пересинхронизация read model, например после ручных правок в базе в обход триггеров
+    select, connection = book_stats_select()
+    stats = connection.ops.quote_name(BookStats._meta.db_table)
+    params = []
+    if book_ids is not None:
+        select += ' WHERE b.id = ANY(%s)'
+        params.append(list(book_ids))
+    columns = ['price_with_discount', 'owner_name']
+    books = connection.ops.quote_name(Book._meta.db_table)
+    # версия растет только у книг, чья строка действительно поменялась: ответы книг кешируются по Book.version
+    sql = (f'WITH rebuilt AS (INSERT INTO {stats} (book_id, {", ".join(columns)}) {select} '
+           f'ON CONFLICT (book_id) DO UPDATE SET ' + ', '.join(f'{column} = EXCLUDED.{column}' for column in columns) +
+           f' WHERE ({", ".join(f"{stats}.{column}" for column in columns)}) IS DISTINCT FROM '
+           f'({", ".join(f"EXCLUDED.{column}" for column in columns)}) RETURNING book_id) '
+           f'UPDATE {books} SET version = version + 1 WHERE id IN (SELECT book_id FROM rebuilt)')
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def book_stats_drift():
+    # id книг, у которых строки BookStats нет или она разошлась с самой книгой
+    select, connection = book_stats_select()
+    stats = connection.ops.quote_name(BookStats._meta.db_table)
+    sql = (f'SELECT expected.book_id FROM ({select}) expected LEFT JOIN {stats} s ON s.book_id = expected.book_id '
+           f'WHERE s.book_id IS NULL OR (s.price_with_discount, s.owner_name) IS DISTINCT FROM '
+           f'(expected.price_with_discount, expected.owner_name) '
+           f'ORDER BY expected.book_id')
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return [book_id for book_id, in cursor.fetchall()]
+
+
+def shelf_stats_select(user_ids=None):
+    # счетчики полок, посчитанные заново по связям, как в триггере store_user_shelf_stats_change (миграция 0024)
+    relations = UserBookRelation.objects.order_by().values('user_id').annotate(
+        **{field: Count('id', filter=SHELVES[shelf]) for shelf, field in SHELF_COUNTERS.items()})
+    if user_ids is not None:
+        relations = relations.filter(user_id__in=list(user_ids))
+    sql, params = relations.query.sql_with_params()
+    return sql, list(params), connections[router.db_for_write(UserShelfStats)]
+
+
+def rebuild_shelf_stats(user_ids=None):
+    # пересинхронизация счетчиков полок, например после правок связей в обход триггеров
+    select, params, connection = shelf_stats_select(user_ids)
+    quote = connection.ops.quote_name
+    stats, relations = quote(UserShelfStats._meta.db_table), quote(UserBookRelation._meta.db_table)
+    columns = list(SHELF_COUNTERS.values())
+    # у пользователя без связей строки нет совсем, так же как после триггера
+    delete = f'DELETE FROM {stats} s WHERE NOT EXISTS (SELECT 1 FROM {relations} r WHERE r.user_id = s.user_id)'
+    delete_params = []
+    if user_ids is not None:
+        delete += ' AND s.user_id = ANY(%s)'
+        delete_params.append(list(user_ids))
+    sql = (f'INSERT INTO {stats} (user_id, {", ".join(columns)}) {select} '
+           f'ON CONFLICT (user_id) DO UPDATE SET ' + ', '.join(f'{column} = EXCLUDED.{column}' for column in columns))
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(delete, delete_params)
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def shelf_stats_drift():
+    # id пользователей, у которых сохраненные счетчики полок разошлись со связями. Нет строки - это нули
+    select, params, connection = shelf_stats_select()
+    stats = connection.ops.quote_name(UserShelfStats._meta.db_table)
+    expected = ', '.join(f'COALESCE(e.{column}, 0)' for column in SHELF_COUNTERS.values())
+    stored = ', '.join(f'COALESCE(s.{column}, 0)' for column in SHELF_COUNTERS.values())
+    sql = (f'SELECT COALESCE(e.user_id, s.user_id) FROM ({select}) e FULL JOIN {stats} s ON s.user_id = e.user_id '
+           f'WHERE ({expected}) IS DISTINCT FROM ({stored}) ORDER BY 1')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [user_id for user_id, in cursor.fetchall()]
+
+
+def shelf_counts(user):
+    # число книг на каждой полке пользователя: одна строка UserShelfStats по первичному ключу вместо COUNT(*) по связям
+    counts = UserShelfStats.objects.filter(user=user).values(*SHELF_COUNTERS.values()).first()
+    return {shelf: counts[field] if counts else 0 for shelf, field in SHELF_COUNTERS.items()}
+
+
+def update_books(books, values):
+    """
+    Bulk edit of catalogue fields with one UPDATE, without loading the books.
+    Does what Book.save does for a single book: bumps version and rebuilds
+    search_vector, from the new values since SET sees the old row.
+    """
+    values = dict(values)
+    if {'name', 'author_name'} & set(values):
+        values['search_vector'] = book_search_vector(*[Value(values[name]) if name in values else name
+                                                    for name in ('name', 'author_name')])
+    return books.update(version=F('version') + 1, **values)
+
+
+# on_delete, которые delete_books выполняет сам, без загрузки строк (DO_NOTHING - ничего не делать)
+FAST_ON_DELETE = (models.CASCADE, models.SET_NULL, models.PROTECT, models.DO_NOTHING)
+
+
+def references(model):
+    # внешние ключи других моделей на model
+    return [relation for relation in model._meta.get_fields(include_hidden=True) # include_hidden - еще и related_name='+'
+            if relation.auto_created and not relation.concrete and (relation.one_to_many or relation.one_to_one)]
+
+
+def book_references():
+    """
+    Reverse foreign keys to Book that delete_books can handle with one SQL
+    statement per table, or None if some of them need Django's Collector:
+    another on_delete (RESTRICT, SET_DEFAULT, SET()) or a cascade into a
+    model that is referenced itself.
+    """
+    relations = references(Book)
+    for relation in relations:
+        if relation.on_delete not in FAST_ON_DELETE:
+            return None
+        if relation.on_delete is models.CASCADE and references(relation.related_model):
+            return None
+    return relations
+
+
+def delete_books(books):
+    """
+    Deletes the books and the rows that reference them with one DELETE per
+    table. queryset.delete() would load every book and every relation of it
+    to send post_delete; instead the deleted ids come back from RETURNING.
+    The catalog version trigger drops the cached lists. CASCADE, SET_NULL and
+    PROTECT are applied in SQL; if a reference needs anything else, the books
+    are deleted with queryset.delete(). Raises ProtectedError.
+    """
+    relations = book_references()
+    if relations is None:
+        # Collector Django: загрузит книги и связи, кеши сбросит post_delete каждой книги
+        return books.delete()[1].get(Book._meta.label, 0)
+
+    connection = connections[router.db_for_write(Book)]
+    quote = connection.ops.quote_name
+    for relation in relations:
+        # проверка до транзакции, чтобы исключение не ломало транзакцию вызывающего. Ссылку, появившуюся
+        # после проверки, не пропустит сам внешний ключ в конце транзакции
+        if relation.on_delete is models.PROTECT:
+            protected = relation.related_model._base_manager.using(connection.alias).filter(
+                **{f'{relation.field.name}__in': books.values('pk')})
+            if protected.exists():
+                raise models.ProtectedError(
+                    f"Cannot delete some instances of model 'Book' because they are referenced through "
+                    f"protected foreign keys: '{relation.related_model.__name__}.{relation.field.name}'.",
+                    set(protected))
+
+    sql, params = books.values('pk').query.sql_with_params()
+    with transaction.atomic(using=connection.alias, savepoint=False), connection.cursor() as cursor:
+        # сначала сами книги: строки заблокированы, и новая связь с ними уже не появится
+        cursor.execute(f'DELETE FROM {quote(Book._meta.db_table)} WHERE {quote(Book._meta.pk.column)} IN ({sql}) '
+                       f'RETURNING {quote(Book._meta.pk.column)}', params)
+        book_ids = [row[0] for row in cursor.fetchall()]
+        if book_ids:
+            # внешние ключи Django проверяются в конце транзакции, так что порядок удаления не важен
+            for relation in relations:
+                table, column = quote(relation.related_model._meta.db_table), quote(relation.field.column)
+                if relation.on_delete is models.CASCADE:
+                    cursor.execute(f'DELETE FROM {table} WHERE {column} = ANY(%s)', [book_ids])
+                elif relation.on_delete is models.SET_NULL:
+                    cursor.execute(f'UPDATE {table} SET {column} = NULL WHERE {column} = ANY(%s)', [book_ids])
+    return len(book_ids)
 
 
 def set_rating(book):
+    recalc_ratings(Book.objects.filter(pk=book.pk))
+
+
+def upsert_relations(user, items):
+    """
+    Applies many {book_id, like, in_bookmarks, rate, bought} changes of one user
+    in a single transaction: the user's relations are locked, merged with the
+    items, written with one INSERT ... ON CONFLICT DO UPDATE, and aggregates are
+    recalculated once for the books whose counted fields actually changed.
+    Fields missing from an item keep their current (or default) value.
+    """
+    fields = [field for field in UserBookRelation.COUNTED_FIELDS if field != 'book_id']
+    defaults = {field: UserBookRelation._meta.get_field(field).get_default() for field in fields}
+    with transaction.atomic():
+        book_ids = [item['book_id'] for item in items]
+        existing = {values['book_id']: values for values in UserBookRelation.objects.select_for_update().filter(
+            user=user, book_id__in=book_ids).values('book_id', *fields)}
+
+        results, changed = {}, {}
+        for item in items:
+            old = existing.get(item['book_id'])
+            new = dict(old or dict(defaults, book_id=item['book_id']))
+            new.update((field, item[field]) for field in fields if field in item)
+            results[item['book_id']] = new
+            if new != old:
+                changed[item['book_id']] = new
+
+        if changed:
+            # bulk_create(update_conflicts=True) появился только в Django 4.1, поэтому upsert написан руками
+            connection = connections[router.db_for_write(UserBookRelation)]
+            quote = connection.ops.quote_name
+            model_fields = [UserBookRelation._meta.get_field(field) for field in fields]
+            columns = [quote(field.column) for field in model_fields]
+            book_type = UserBookRelation._meta.get_field('book').target_field.cast_db_type(connection)
+            arrays = ', '.join(f'%s::{field.cast_db_type(connection)}[]' for field in model_fields)
+            sql = (f'INSERT INTO {quote(UserBookRelation._meta.db_table)} (user_id, book_id, {", ".join(columns)}) '
+                   f'SELECT %s, * FROM unnest(%s::{book_type}[], {arrays}) '
+                   f'ON CONFLICT (user_id, book_id) DO UPDATE SET '
+                   + ', '.join(f'{column} = EXCLUDED.{column}' for column in columns))
+            params = [user.pk, list(changed)] + [[row[field] for row in changed.values()] for field in fields]
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            recalc_book_aggregates(Book.objects.filter(pk__in=list(changed)))
+    return [results[item['book_id']] for item in items]
+
+
+def get_or_create_relation(user, book_id):
+    """
+    get_or_create for the relation PATCH in one statement: INSERT ... SELECT
+    from the book (no row if the book does not exist) ON CONFLICT DO UPDATE
+    returns the existing or new relation and locks it. For a new relation
+    the same statement bumps readers_count/version of the book, as saving
+    a fresh relation would. Returns None if there is no such book.
+    """
+    fields = [field for field in UserBookRelation.COUNTED_FIELDS if field != 'book_id']
+    model_fields = [UserBookRelation._meta.get_field(field) for field in fields]
+    defaults = [field.get_default() for field in model_fields]
+
+    connection = connections[router.db_for_write(UserBookRelation)]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in model_fields)
+    relations, books = quote(UserBookRelation._meta.db_table), quote(Book._meta.db_table)
+    sql = (f'WITH relation AS ('
+           f'INSERT INTO {relations} (user_id, book_id, {columns}) '
+           f'SELECT %s, id, {", ".join(["%s"] * len(fields))} FROM {books} WHERE id = %s '
+           f'ON CONFLICT (user_id, book_id) DO UPDATE SET user_id = EXCLUDED.user_id ' # пустое обновление, чтобы вернуть и заблокировать строку
+           f'RETURNING id, {columns}, (xmax = 0) AS created'
+           f'), new_reader AS (' # связь со значениями по умолчанию добавляет книге только читателя, см. relation_updates
+           f'UPDATE {books} SET readers_count = readers_count + 1, version = version + 1 '
+           f'WHERE id = %s AND EXISTS (SELECT 1 FROM relation WHERE created)'
+           f') SELECT * FROM relation')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user.pk, *defaults, book_id, book_id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    relation_id, *values, created = row
+    relation = UserBookRelation(id=relation_id, user=user, book_id=book_id, **dict(zip(fields, values)))
+    relation._state.adding = False
+    relation._state.db = connection.alias
+    return relation
+
+
+def reader_previews(book_ids, limit=None):
+    # первые limit читателей каждой книги одним запросом. LATERAL + LIMIT читает по индексу (book_id, id) ровно limit связей на книгу,
+    # а row_number() по связям сортировал всех читателей страницы, даже если у книги их десятки тысяч
+    if limit is None:
+        limit = settings.STORE_READERS_PREVIEW_SIZE
+    previews = {book_id: [] for book_id in book_ids}
+    if not previews or limit <= 0:
+        return previews
+
+    connection = connections[router.db_for_read(UserBookRelation)]
+    relations = connection.ops.quote_name(UserBookRelation._meta.db_table)
+    users = connection.ops.quote_name(User._meta.db_table)
+    sql = (f'SELECT b.id, r.id, u.first_name, u.last_name FROM unnest(%s) AS b(id) '
+           f'CROSS JOIN LATERAL (SELECT id, user_id FROM {relations} WHERE book_id = b.id ORDER BY id LIMIT %s) r '
+           f'JOIN {users} u ON u.id = r.user_id')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (list(previews), limit))
+        rows = sorted(cursor.fetchall()) # порядок сортируем тут, на нескольких десятках строк, а не в базе
+    for book_id, relation_id, first_name, last_name in rows:
+        previews[book_id].append({'first_name': first_name, 'last_name': last_name})
+    return previews
+
+
+def attach_reader_previews(books, limit=None):
+    previews = reader_previews([book.pk for book in books], limit)
+    for book in books:
+        book.reader_preview = previews[book.pk]
+    return books
+
+
+def my_relations(user, book_ids):
+    # связи пользователя с книгами страницы одним запросом по уникальному индексу (user, book).
+    # Для книг без связи - значения по умолчанию, для анонимного пользователя - None без запроса в базу
+    if user is None or not user.is_authenticated:
+        return {book_id: None for book_id in book_ids}
+    fields = [field for field in UserBookRelation.COUNTED_FIELDS if field != 'book_id']
+    defaults = {field: UserBookRelation._meta.get_field(field).get_default() for field in fields}
+    relations = {book_id: dict(defaults) for book_id in book_ids}
+    if relations:
+        for values in UserBookRelation.objects.filter(user=user, book_id__in=list(relations)).values('book_id', *fields):
+            relations[values.pop('book_id')] = values
+    return relations
+
 
-    rating_res = UserBookRelation.objects.filter(book=book).aggregate(book_rating_count=Avg('rate')).get('book_rating_count') # aggregate возвращает словарь, а через get обращаемся к ключу словаря, можно просто через [book_rating_count]
-    book.rating = rating_res
-    # print('book.rating===================/////', book.rating, book.name)
-    book.save()
+def attach_my_relations(books, user):
+    relations = my_relations(user, [book.pk for book in books])
+    for book in books:
+        book.my_relation = relations[book.pk]
+    return books
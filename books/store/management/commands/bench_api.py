@@ -0,0 +1,240 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from store.bench import WORDS, bench_users, without_debug_toolbar
+from store.cache import get_cache
+from store.logic import upsert_relations
+from store.models import Book, UserBookRelation
+from store.rating_queue import get_rating_queue
+
+# метрики, по которым compare ищет регрессии: больше - хуже
+COMPARED = ('p50_ms', 'p99_ms', 'queries_mean')
+
+
+class Command(BaseCommand):
+    help = ('Measures BookViewSet and UserBookRelationView endpoints in-process (latency percentiles, throughput, '
+            'SQL queries) and writes the results as JSON; --compare diffs them against an earlier run')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--scenario', action='append', help='Run only these scenarios (repeatable)')
+        parser.add_argument('--warm-cache', action='store_true',
+                            help='Keep the response cache between requests (by default it is cleared before each one)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--output', help='Write results to this JSON file')
+        parser.add_argument('--compare', metavar='BASELINE', help='JSON of an earlier run to compare with')
+        parser.add_argument('--against', metavar='RESULTS',
+                            help='With --compare: compare this JSON instead of running the benchmark')
+        parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['against']:
+            if not options['compare']:
+                raise CommandError('--against needs --compare')
+            results = self.load(options['against'])
+        else:
+            results = self.run(options)
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    json.dump(results, f, indent=2, sort_keys=True)
+                self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['compare']:
+            regressions = self.compare(self.load(options['compare']), results, options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def run(self, options):
+        rnd = random.Random(options['seed'])
+        book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+        user = bench_users().order_by('id').first()
+        if not book_ids or user is None:
+            raise CommandError('No data to measure, run seed_books first')
+
+        scenarios = self.scenarios(rnd, book_ids)
+        if options['scenario']:
+            unknown = set(options['scenario']) - set(scenarios)
+            if unknown:
+                raise CommandError(f'Unknown scenario(s): {", ".join(sorted(unknown))}')
+            scenarios = {name: scenario for name, scenario in scenarios.items() if name in options['scenario']}
+
+        client = Client(HTTP_HOST=options['host'])
+        client.force_login(user)
+        results = {'meta': self.meta(options), 'scenarios': {}}
+        # запросы идут в autocommit, как в проде: с коммитом, on_commit (сброс кеша, очередь рейтинга) и без внешней
+        # транзакции вокруг PATCH. Связи пользователя, которые поменяли PATCH-и, потом возвращаем как были
+        relations = self.relations(user)
+        try:
+            with override_settings(MIDDLEWARE=without_debug_toolbar()):
+                for name, scenario in scenarios.items():
+                    results['scenarios'][name] = stats = self.measure(client, scenario, options)
+                    self.stdout.write(f'{name:22} {stats["rps"]:8.1f} req/s  p50={stats["p50_ms"]:7.2f}ms  '
+                                      f'p90={stats["p90_ms"]:7.2f}ms  p99={stats["p99_ms"]:7.2f}ms  '
+                                      f'queries={stats["queries_mean"]:.1f}  errors={stats["errors"]}')
+        finally:
+            self.restore_relations(user, relations)
+        return results
+
+    @staticmethod
+    def relations(user):
+        return {values['book_id']: values for values in
+                UserBookRelation.objects.filter(user=user).values(*UserBookRelation.COUNTED_FIELDS)}
+
+    def restore_relations(self, user, before):
+        queue = get_rating_queue()
+        if hasattr(queue, 'flush'): # пусть фоновый пересчет закончится до того, как мы вернем связи
+            queue.flush(timeout=30)
+        after = self.relations(user)
+        created = set(after) - set(before)
+        changed = [values for book_id, values in before.items() if after.get(book_id) != values]
+        with transaction.atomic():
+            UserBookRelation.objects.filter(user=user, book_id__in=created).delete() # агрегаты книг вернет relation_deleted
+            if changed:
+                upsert_relations(user, changed)
+
+    @staticmethod
+    def scenarios(rnd, book_ids):
+        # сценарий - функция, которая по номеру запроса возвращает (method, url, data)
+        prices = list(Book.objects.filter(pk__in=rnd.sample(book_ids, min(20, len(book_ids))))
+                      .values_list('price', flat=True))
+        list_url = reverse('book-list')
+        return {
+            'book_list': lambda i: ('get', list_url, {}),
+            'book_list_filter': lambda i: ('get', list_url, {'price': str(rnd.choice(prices))}),
+            'book_list_search': lambda i: ('get', list_url, {'search': ' '.join(rnd.sample(WORDS, rnd.randint(1, 2)))}),
+            'book_list_ordering': lambda i: ('get', list_url, {'ordering': rnd.choice(['-price', 'name', 'discount'])}),
+            'book_retrieve': lambda i: ('get', reverse('book-detail', args=(rnd.choice(book_ids),)), {}),
+            'relation_patch': lambda i: ('patch', reverse('userbookrelation-detail', args=(rnd.choice(book_ids),)),
+                                         {'like': rnd.random() < 0.5, 'rate': rnd.randint(1, 5)}),
+        }
+
+    def measure(self, client, scenario, options):
+        cache = get_cache()
+        latencies, queries, sql_ms, errors = [], [], [], 0
+        started = None
+        for i in range(options['warmup'] + options['requests']):
+            if i == options['warmup']:
+                started = time.perf_counter()
+                elapsed_outside = 0.0
+            method, url, data = scenario(i)
+            if not options['warm_cache']:
+                pause = time.perf_counter()
+                cache.clear()
+                if started is not None:
+                    elapsed_outside += time.perf_counter() - pause
+
+            start = time.perf_counter()
+            if method == 'get':
+                response = client.get(url, data)
+            else:
+                response = getattr(client, method)(url, data=json.dumps(data), content_type='application/json')
+            latency = time.perf_counter() - start
+            if started is None:
+                continue
+
+            latencies.append(latency * 1000)
+            errors += response.status_code >= 400
+            timing = self.server_timing(response)
+            queries.append(timing.get('queries', 0))
+            sql_ms.append(timing.get('db', 0.0))
+
+        elapsed = time.perf_counter() - started - elapsed_outside
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'rps': round(len(latencies) / elapsed, 2),
+            'mean_ms': round(statistics.fmean(latencies), 3),
+            'p50_ms': round(self.percentile(latencies, 0.5), 3),
+            'p90_ms': round(self.percentile(latencies, 0.9), 3),
+            'p99_ms': round(self.percentile(latencies, 0.99), 3),
+            'max_ms': round(latencies[-1], 3),
+            'queries_mean': round(statistics.fmean(queries), 2),
+            'queries_max': max(queries),
+            'sql_mean_ms': round(statistics.fmean(sql_ms), 3),
+        }
+
+    @staticmethod
+    def percentile(values, share):
+        return values[min(len(values) - 1, int(len(values) * share))]
+
+    @staticmethod
+    def server_timing(response):
+        # число запросов и время SQL берем из заголовка RequestMetricsMiddleware
+        timing = {}
+        for part in response.get('Server-Timing', '').split(','):
+            name, *params = [param.strip() for param in part.split(';')]
+            for param in params:
+                key, _, value = param.partition('=')
+                if key == 'dur':
+                    timing[name] = float(value)
+                elif key == 'desc' and name == 'db':
+                    timing['queries'] = int(value.strip('"').split()[0])
+        return timing
+
+    @staticmethod
+    def meta(options):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                    cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            commit = None
+        return {
+            'commit': commit,
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'database': f'{connection.vendor} {connection.Database.__name__}',
+            'database_version': getattr(connection, 'pg_version', None),
+            'django': django.get_version(),
+            'books': Book.objects.count(),
+            'users': bench_users().count(),
+            'relations': UserBookRelation.objects.count(),
+            'requests': options['requests'],
+            'warm_cache': options['warm_cache'],
+            'seed': options['seed'],
+            'rating_queue': settings.STORE_RATING_QUEUE,
+            'fast_list': settings.STORE_FAST_LIST,
+        }
+
+    def compare(self, baseline, results, threshold):
+        base_meta, meta = baseline['meta'], results['meta']
+        self.stdout.write(f'Comparing {meta.get("commit")} against {base_meta.get("commit")}')
+        for key in ('books', 'relations', 'database', 'warm_cache'):
+            if base_meta.get(key) != meta.get(key):
+                self.stdout.write(self.style.WARNING(f'  {key} differs: {base_meta.get(key)} -> {meta.get(key)}'))
+
+        regressions = []
+        for name, stats in results['scenarios'].items():
+            base = baseline['scenarios'].get(name)
+            if base is None:
+                self.stdout.write(f'{name:22} new scenario')
+                continue
+            changes = []
+            for metric in COMPARED:
+                old, new = base[metric], stats[metric]
+                change = (new - old) / old if old else 0.0
+                regressed = change > threshold
+                if regressed:
+                    regressions.append(f'{name}.{metric}')
+                text = f'{metric}={old:g}->{new:g} ({change:+.0%})'
+                changes.append(self.style.ERROR(text) if regressed else text)
+            self.stdout.write(f'{name:22} ' + '  '.join(changes))
+        return regressions
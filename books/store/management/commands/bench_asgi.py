@@ -0,0 +1,111 @@
+import asyncio
+import io
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test import override_settings
+
+from store.bench import without_debug_toolbar
+
+HOST = 'localhost'
+
+
+class Command(BaseCommand):
+    help = ('Runs concurrent GET requests in-process through the WSGI handler, the ASGI handler with the sync '
+            'BookViewSet and the ASGI handler with the async views, and prints requests/sec and latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--path', default='/book/?ordering=-price',
+                            help='List or detail URL of BookViewSet; the async run uses the same URL under /async/')
+        parser.add_argument('--with-debug-toolbar', action='store_true',
+                            help='Keep the debug toolbar middleware; it is sync-only and dominates ASGI timings')
+        parser.add_argument('--cold', action='store_true',
+                            help='Add a unique query parameter to every request so the response cache never hits')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['path'])
+        urls = [self.url(url.path, url.query, i, options['cold']) for i in range(options['requests'])]
+        async_urls = [(f'/async{path}', query) for path, query in urls]
+
+        middleware = settings.MIDDLEWARE if options['with_debug_toolbar'] else without_debug_toolbar()
+        with override_settings(MIDDLEWARE=middleware): # обработчики собирают цепочку middleware при создании
+            wsgi, asgi = get_wsgi_application(), get_asgi_application()
+        self.report('wsgi  sync view ', self.run_wsgi(wsgi, urls, options['concurrency']))
+        self.report('asgi  sync view ', asyncio.run(self.run_asgi(asgi, urls, options['concurrency'])))
+        self.report('asgi  async view', asyncio.run(self.run_asgi(asgi, async_urls, options['concurrency'])))
+
+    @staticmethod
+    def url(path, query, i, cold):
+        if cold:
+            query = f'{query}&_bench={i}' if query else f'_bench={i}'
+        return path, query
+
+    def run_wsgi(self, app, urls, concurrency):
+        def request(url):
+            path, query = url
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+                'SERVER_NAME': HOST, 'SERVER_PORT': '80', 'HTTP_HOST': HOST, 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(), 'wsgi.url_scheme': 'http',
+                'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            }
+            statuses = []
+            start = time.perf_counter()
+            response = app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+            try:
+                b''.join(response)
+            finally:
+                response.close() # request_finished: закрывает соединение с базой, как настоящий сервер
+            return time.perf_counter() - start, int(statuses[0].split()[0])
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(request, urls))
+        return time.perf_counter() - start, results
+
+    async def run_asgi(self, app, urls, concurrency):
+        async def request(url):
+            path, query = url
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+                'headers': [(b'host', HOST.encode())], 'client': ('127.0.0.1', 0), 'server': (HOST, 80),
+            }
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            start = time.perf_counter()
+            await app(scope, receive, send)
+            return time.perf_counter() - start, messages[0]['status']
+
+        pending = iter(urls)
+        results = []
+
+        async def worker():
+            for url in pending: # итератор общий, каждый url достанется одному воркеру
+                results.append(await request(url))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.perf_counter() - start, results
+
+    def report(self, label, run):
+        elapsed, results = run
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        errors = sum(status >= 400 for _, status in results)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(f'{label}: {len(results) / elapsed:8.1f} req/s  p50={statistics.median(latencies):7.2f}ms  '
+                          f'p99={p99:7.2f}ms  errors={errors}')
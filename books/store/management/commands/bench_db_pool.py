@@ -0,0 +1,104 @@
+import statistics
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from books.db.backends.pooled.base import POOL_DEFAULTS
+from books.db.backends.pooled.pool import close_pools, pools_of
+
+ENGINES = (
+    ('plain', 'django.db.backends.postgresql'),
+    ('pooled', 'books.db.backends.pooled'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Measures what a request pays for its database connection: connect, one query and close, as Django does '
+            'with CONN_MAX_AGE = 0, on the plain postgresql backend and on the pooled one')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300, help='Requests per thread')
+        parser.add_argument('--threads', type=int, default=1)
+        parser.add_argument('--pool-size', type=int, help='MAX_SIZE of the pool, by default the one from settings')
+        parser.add_argument('--query', default='SELECT 1')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['threads'] < 1:
+            raise CommandError('--requests and --threads must be positive')
+        settings_dict = dict(connections[options['database']].settings_dict)
+        if options['pool_size']:
+            pool = {**POOL_DEFAULTS, **settings_dict.get('POOL', {})}
+            settings_dict['POOL'] = dict(pool, MAX_SIZE=options['pool_size'],
+                                         MIN_SIZE=min(pool['MIN_SIZE'], options['pool_size']))
+
+        with self.database('bench_baseline', dict(settings_dict, ENGINE=ENGINES[0][1])) as alias:
+            baseline = [self.run_query(connections[alias], options['query']) for _ in range(options['requests'])]
+        self.stdout.write(f'{"query only":10} median={statistics.median(baseline):.3f}ms (already open connection)')
+        for label, engine in ENGINES:
+            with self.database(f'bench_{label}', dict(settings_dict, ENGINE=engine)) as alias:
+                timings, errors = self.measure(alias, options)
+                metrics = self.pool_metrics(alias) if label == 'pooled' else ''
+            timings.sort()
+            self.stdout.write(f'{label:10} requests={len(timings)} threads={options["threads"]} errors={errors} '
+                              f'median={statistics.median(timings):.3f}ms p99={self.percentile(timings, 0.99):.3f}ms '
+                              f'overhead={statistics.median(timings) - statistics.median(baseline):.3f}ms{metrics}')
+
+    @staticmethod
+    @contextmanager
+    def database(alias, settings_dict):
+        # временный alias в DATABASES: connections[alias] в каждом потоке дает свое соединение, как у потоков веб-сервера
+        connections.settings[alias] = settings_dict
+        try:
+            yield alias
+        finally:
+            connections[alias].close()
+            close_pools(alias) # соединения бенчмарка не оставляем открытыми
+            del connections.settings[alias]
+
+    def measure(self, alias, options):
+        timings, errors = [], []
+
+        def worker():
+            wrapper = connections[alias]
+            for _ in range(options['requests']):
+                start = time.perf_counter()
+                try:
+                    self.run_query(wrapper, options['query'])
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    wrapper.close() # конец запроса: при CONN_MAX_AGE = 0 Django закрывает соединение
+                timings.append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return timings, len(errors)
+
+    @staticmethod
+    def run_query(wrapper, query):
+        start = time.perf_counter()
+        with wrapper.cursor() as cursor:
+            cursor.execute(query)
+            cursor.fetchall()
+        return (time.perf_counter() - start) * 1000
+
+    @staticmethod
+    def pool_metrics(alias):
+        stats = Counter()
+        for pool in pools_of(alias):
+            stats.update(pool.metrics())
+        return (f' | pool: checkouts={stats.get("checkouts", 0)} opened={stats.get("opened", 0)} '
+                f'waits={stats.get("waits", 0)} wait={stats.get("wait_seconds", 0) * 1000:.1f}ms '
+                f'timeouts={stats.get("timeouts", 0)}')
+
+    @staticmethod
+    def percentile(values, share):
+        return values[min(len(values) - 1, int(len(values) * share))]
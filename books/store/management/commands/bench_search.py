@@ -0,0 +1,71 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from store.bench import synthetic_books
+from store.filters import BookSearchFilter
+from store.logic import refresh_search_vectors
+from store.models import Book
+from store.views import BookViewSet
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares the ILIKE SearchFilter with the full-text BookSearchFilter on ?search='
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='*', default=['tolstoy', 'war peace', 'margarita 7'])
+        parser.add_argument('--books', type=int, default=0,
+                            help='Seed that many synthetic books for the run, rolled back afterwards')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--explain', action='store_true', help='Print EXPLAIN ANALYZE of both queries')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['books']:
+                    self.seed(options['books'])
+                self.compare(options['terms'], options['repeat'], options['explain'])
+                raise Rollback # синтетические книги в базе не оставляем
+        except Rollback:
+            pass
+
+    def seed(self, count, batch_size=5000):
+        rnd = random.Random(0)
+        for start in range(0, count, batch_size):
+            Book.objects.bulk_create(synthetic_books(rnd, min(batch_size, count - start), start))
+        refresh_search_vectors(Book.objects.filter(search_vector__isnull=True))
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(Book._meta.db_table)}')
+        self.stdout.write(f'Seeded {count} books')
+
+    def compare(self, terms, repeat, explain):
+        view = BookViewSet()
+        factory = APIRequestFactory()
+        for term in terms:
+            request = Request(factory.get('/book/', {'search': term}))
+            for label, backend in (('ilike', SearchFilter()), ('fulltext', BookSearchFilter())):
+                queryset = backend.filter_queryset(request, Book.objects.order_by('id'), view)
+                page = queryset.values_list('id', flat=True)[:20]
+                page_timings, count_timings = [], []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    list(page.all()) # all() - новый queryset, иначе результат возьмется из кеша queryset
+                    page_timings.append((time.perf_counter() - start) * 1000)
+                    start = time.perf_counter()
+                    total = queryset.count()
+                    count_timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(f'{term!r:16} {label:9} matches={total:<7} '
+                                  f'first page median={statistics.median(page_timings):.2f}ms '
+                                  f'count median={statistics.median(count_timings):.2f}ms')
+                if explain:
+                    self.stdout.write(page.explain(analyze=True))
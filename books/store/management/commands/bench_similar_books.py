@@ -0,0 +1,93 @@
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+
+from store.bench import seed_dataset
+from store.models import Book, SimilarBook
+from store.recommendations import ENGINES, build_similar_books, get_engine_class, signals
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measures build time and memory of similar books on a synthetic dataset, rolled back afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--relations', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--engine', action='append', choices=list(ENGINES),
+                            help='Engine to measure, can be repeated. Defaults to every installed one')
+        parser.add_argument('--changed', type=int, default=100, help='Books changed before the incremental run')
+        parser.add_argument('--memory-sample', type=int, default=1000,
+                            help='Books scored under tracemalloc, which slows Python code down several times')
+
+    def handle(self, *args, **options):
+        engines = options['engine'] or [name for name in ENGINES if self.installed(name)]
+        try:
+            with transaction.atomic():
+                start = time.perf_counter()
+                books, users, relations = seed_dataset(options['books'], options['users'], options['relations'],
+                                                       seed=options['seed'])
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+                self.stdout.write(f'Seeded {books} book(s), {users} user(s), {relations} relation(s) '
+                                  f'in {time.perf_counter() - start:.1f}s')
+                for name in engines:
+                    self.measure(name, options)
+                raise Rollback # синтетические данные в базе не оставляем
+        except Rollback:
+            pass
+
+    @staticmethod
+    def installed(name):
+        try:
+            get_engine_class(name)
+        except ImportError:
+            return False
+        return True
+
+    def measure(self, name, options):
+        engine = get_engine_class(name)
+        book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+
+        start = time.perf_counter()
+        rows = list(signals().iterator(chunk_size=10000))
+        fetched = time.perf_counter()
+        similarity = engine(rows)
+        loaded = time.perf_counter()
+        scored = sum(len(similar) for _, similar in similarity.top_similar(book_ids, 20))
+        computed = time.perf_counter()
+        self.stdout.write(f'{name:7} fetch {len(rows)} signal(s) {fetched - start:.2f}s, '
+                          f'matrix {loaded - fetched:.2f}s, top-20 of {len(book_ids)} book(s) {computed - loaded:.2f}s '
+                          f'({scored} pair(s))')
+
+        del similarity
+        tracemalloc.start()
+        similarity = engine(rows)
+        matrix = tracemalloc.get_traced_memory()[0]
+        for _ in similarity.top_similar(book_ids[:options['memory_sample']], 20):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del similarity, rows
+        self.stdout.write(f'{name:7} memory: matrix {matrix / 2 ** 20:.1f} MiB, peak while scoring {peak / 2 ** 20:.1f} MiB')
+
+        SimilarBook.objects.all().delete()
+        start = time.perf_counter()
+        build_similar_books(full=True, engine=name)
+        full = time.perf_counter() - start
+
+        changed = random.Random(options['seed']).sample(book_ids, min(options['changed'], len(book_ids)))
+        Book.objects.filter(pk__in=changed).update(version=F('version') + 1) # как после изменения связей
+        start = time.perf_counter()
+        changed, rebuilt = build_similar_books(engine=name)
+        self.stdout.write(f'{name:7} full build with saving {full:.2f}s, incremental after {changed} changed book(s): '
+                          f'{rebuilt} list(s) in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.recommendations import ENGINES, build_similar_books, get_engine_class
+
+
+class Command(BaseCommand):
+    help = 'Precomputes similar books from likes, high rates and purchases. Only changed books unless --full'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild the lists of all books')
+        parser.add_argument('--engine', choices=['auto', *ENGINES], help='Defaults to STORE_SIMILARITY_ENGINE')
+        parser.add_argument('--k', type=int, help='Similar books per book, defaults to STORE_SIMILAR_BOOKS')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Books per saving transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep rebuilding changed books instead of exiting')
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between incremental runs')
+
+    def handle(self, *args, **options):
+        try:
+            engine = get_engine_class(options['engine'])
+        except ImportError as error:
+            raise CommandError(error)
+
+        full = options['full']
+        while True:
+            start = time.perf_counter()
+            changed, rebuilt = build_similar_books(full=full, engine=options['engine'], k=options['k'],
+                                                   batch_size=options['batch_size'])
+            self.stdout.write(f'{changed} changed book(s), rebuilt {rebuilt} list(s) with {engine.__name__} '
+                              f'in {time.perf_counter() - start:.1f}s')
+            if not options['loop']:
+                break
+            full = False
+            time.sleep(options['interval'])
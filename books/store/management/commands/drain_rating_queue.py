@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.rating_queue import DbRatingQueue
+
+
+class Command(BaseCommand):
+    help = "Recalculates ratings for books queued by STORE_RATING_QUEUE = 'db'"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new jobs instead of exiting')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        queue = DbRatingQueue()
+        total_jobs = total_books = 0
+        while True:
+            jobs, books = queue.drain(options['batch_size'])
+            total_jobs += jobs
+            total_books += books
+            if jobs:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(f'Processed {total_jobs} job(s) for {total_books} book(s)')
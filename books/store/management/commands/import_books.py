@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.importer import FORMATS, BookImport, ImportRecordError, read_records
+
+
+class Command(BaseCommand):
+    help = ('Imports books from a CSV, JSON or JSONL file in batches. Columns: external_id, name, price, author_name, '
+            'discount, owner (username); JSON records may also hold a "relations" list')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())),
+                            help='Format of the books file, by default taken from its extension')
+        parser.add_argument('--relations',
+                            help='CSV, JSON or JSONL file of relations: book (external_id), user (username), '
+                                 'like, in_bookmarks, rate, bought')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        start = time.perf_counter()
+        importer = BookImport(options['batch_size'], progress=self.report if options['verbosity'] > 0 else None)
+        try:
+            importer.import_books(read_records(options['path'], options['format']))
+            if options['relations']:
+                importer.import_relations(read_records(options['relations']))
+        except (ImportRecordError, OSError) as error:
+            # уже загруженные пачки остаются в базе, их агрегаты досчитываем, а повторный запуск их пропустит
+            importer.finish()
+            raise CommandError(f'{error} (batches before it are imported, fix the file and run the command again)')
+
+        books = importer.finish()
+        counts = importer.counts
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {counts["created"]} new book(s), skipped {counts["skipped"]} already imported, '
+            f'{counts["relations"]} relation(s), {counts["users"]} new user(s); '
+            f'recalculated {books} book(s) in {time.perf_counter() - start:.1f}s'))
+
+    def report(self, counts):
+        self.stdout.write(f'{counts["books"]} book record(s): {counts["created"]} new, {counts["skipped"]} skipped, '
+                          f'{counts["relations"]} relation(s)')
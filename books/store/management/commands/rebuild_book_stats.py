@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import book_stats_drift, rebuild_book_stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the BookStats read model (discounted price, owner name) from books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books whose stats are missing or have drifted, do not write')
+
+    def handle(self, *args, **options):
+        drifted = book_stats_drift()
+        if options['check']:
+            if drifted:
+                raise CommandError(f'Book stats drifted for {len(drifted)} book(s): {drifted}')
+            self.stdout.write('Book stats are consistent')
+            return
+
+        updated = rebuild_book_stats()
+        self.stdout.write(f'Rebuilt stats for {updated} book(s), {len(drifted)} had drifted')
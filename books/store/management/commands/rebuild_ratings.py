@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import ratings_drift, recalc_ratings
+from store.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Book.rating_sum/rating_count/rating from UserBookRelation rates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books whose stored aggregates have drifted, do not write')
+
+    def handle(self, *args, **options):
+        drifted = list(ratings_drift(Book.objects.all()).values_list('id', flat=True))
+        if options['check']:
+            if drifted:
+                raise CommandError(f'Rating aggregates drifted for {len(drifted)} book(s): {drifted}')
+            self.stdout.write('Rating aggregates are consistent')
+            return
+
+        updated = recalc_ratings(Book.objects.all())
+        self.stdout.write(f'Rebuilt rating aggregates for {updated} book(s), {len(drifted)} had drifted')
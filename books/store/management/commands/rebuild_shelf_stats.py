@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import rebuild_shelf_stats, shelf_stats_drift
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds UserShelfStats (books liked, bookmarked, bought and rated per user) from relations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report users whose shelf counters have drifted, do not write')
+
+    def handle(self, *args, **options):
+        drifted = shelf_stats_drift()
+        if options['check']:
+            if drifted:
+                raise CommandError(f'Shelf counters drifted for {len(drifted)} user(s): {drifted}')
+            self.stdout.write('Shelf counters are consistent')
+            return
+
+        updated = rebuild_shelf_stats()
+        self.stdout.write(f'Rebuilt shelf counters for {updated} user(s), {len(drifted)} had drifted')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import counters_drift, recalc_counters
+from store.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Repairs Book.likes_count/bookmarks_count/buyers_count after bulk imports or manual edits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books whose stored counters have drifted, do not write')
+
+    def handle(self, *args, **options):
+        drifted = counters_drift(Book.objects.all())
+        if options['check']:
+            drifted = list(drifted.values_list('id', flat=True))
+            if drifted:
+                raise CommandError(f'Counters drifted for {len(drifted)} book(s): {drifted}')
+            self.stdout.write('Counters are consistent')
+            return
+
+        # пересчитываем только разошедшиеся книги
+        updated = recalc_counters(Book.objects.filter(pk__in=drifted.values('pk')))
+        self.stdout.write(f'Repaired counters for {updated} book(s)')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from store.bench import BENCH_USER_PREFIX, bench_users, seed_dataset
+from store.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic dataset of books, bench users and their relations for bench_api'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--relations', type=int, default=50000)
+        parser.add_argument('--seed', type=int, default=0, help='The same seed gives the same dataset')
+        parser.add_argument('--clear', action='store_true',
+                            help=f'Delete books owned by {BENCH_USER_PREFIX}* users and the users themselves first')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted, _ = Book.objects.filter(owner__username__startswith=BENCH_USER_PREFIX).delete()
+            bench_users().delete()
+            self.stdout.write(f'Deleted {deleted} object(s) of the previous dataset')
+
+        books, users, relations = seed_dataset(options['books'], options['users'], options['relations'],
+                                               seed=options['seed'])
+        self.stdout.write(f'Seeded {books} book(s), {users} user(s), {relations} relation(s)')
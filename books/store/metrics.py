@@ -0,0 +1,174 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.deprecation import MiddlewareMixin
+
+# метрики текущего запроса. ContextVar, а не thread local: async view выполняет запросы к базе в потоке из пула
+current_metrics = ContextVar('store_request_metrics', default=None)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # последняя корзина - +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    In-process histograms per DRF view action, in the Prometheus text format.
+    Each worker process has its own registry, so a scraper has to read every
+    worker. Other modules can add lines to the output with add_collector().
+    """
+    METRICS = (
+        ('store_request_duration_seconds', 'Request processing time', DURATION_BUCKETS),
+        ('store_sql_duration_seconds', 'Time spent in SQL queries per request', DURATION_BUCKETS),
+        ('store_serializer_duration_seconds', 'Time spent building serializer data per request', DURATION_BUCKETS),
+        ('store_db_queries', 'SQL queries per request', QUERY_BUCKETS),
+        ('store_response_size_bytes', 'Response body size', SIZE_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.collectors = []
+
+    def observe(self, view, values):
+        with self.lock:
+            for (name, _, buckets), value in zip(self.METRICS, values):
+                if value is not None:
+                    self.histograms.setdefault((name, view), Histogram(buckets)).observe(value)
+
+    def add_collector(self, collector):
+        # collector() возвращает готовые строки в текстовом формате Prometheus
+        self.collectors.append(collector)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help_text, _ in self.METRICS:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (metric, view), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    labels = f'view="{view}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_metrics.get()
+    if metrics is None: # запрос вне http-запроса: команды, фоновые потоки
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.sql_time += time.perf_counter() - start
+        metrics.queries += 1
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # обертка живет в объекте соединения своего потока и переживает переподключения, добавляем ее один раз
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def serializer_timer():
+    metrics = current_metrics.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.serializer_time += time.perf_counter() - start
+
+
+class TimedSerializerMixin:
+    # время сборки serializer.data попадает в метрики запроса. to_representation вложенных полей .data не вызывает,
+    # так что время не считается дважды
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    func = match.func
+    view_class = getattr(func, 'cls', None) or getattr(func, 'view_class', None)
+    if view_class is None:
+        return f'{func.__module__}.{func.__name__}'
+    actions = getattr(func, 'actions', None) or {} # у ViewSet: {'get': 'list', ...}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f'{view_class.__name__}.{action}'
+
+
+class RequestMetricsMiddleware(MiddlewareMixin):
+    """
+    Per request: SQL query count and time, serializer time, total time and
+    response size. They go to the Server-Timing header and to the
+    in-process histograms shown at /metrics/. Should be the first
+    middleware, so that the total covers the rest of the chain.
+    """
+
+    def process_request(self, request):
+        request._metrics_start = time.perf_counter()
+        request._metrics = RequestMetrics()
+        current_metrics.set(request._metrics)
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_metrics', None)
+        if metrics is None: # process_request не вызывался, например ответ вернуло middleware выше
+            return response
+        current_metrics.set(None) # не reset(token): под ASGI process_request и process_response идут в разных контекстах
+        total = time.perf_counter() - request._metrics_start
+        size = None if response.streaming else len(response.content)
+
+        registry.observe(view_name(request), (total, metrics.sql_time, metrics.serializer_time, metrics.queries, size))
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={metrics.sql_time * 1000:.2f};desc="{metrics.queries} queries"',
+            f'serializer;dur={metrics.serializer_time * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+        return response
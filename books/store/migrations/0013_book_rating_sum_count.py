@@ -0,0 +1,36 @@
+# Generated by Django 3.2.19 on 2026-10-18 06:50
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_totals(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    rates = UserBookRelation.objects.filter(book=OuterRef('pk'), rate__isnull=False).order_by().values('book')
+    Book.objects.update(
+        rating_sum=Coalesce(Subquery(rates.annotate(total=Sum('rate')).values('total')), 0),
+        rating_count=Coalesce(Subquery(rates.annotate(total=Count('rate')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_book_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.19 on 2026-10-18 06:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    relations = UserBookRelation.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    counters = {'likes_count': 'like', 'bookmarks_count': 'in_bookmarks', 'buyers_count': 'bought'}
+    Book.objects.update(**{
+        counter: Coalesce(Subquery(relations.annotate(total=Count('pk', filter=Q(**{field: True}))).values('total')), 0)
+        for counter, field in counters.items()
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_book_rating_sum_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='bookmarks_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='buyers_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='likes_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 3.2.19 on 2026-10-18 06:58
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Min, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+import django.db.models.deletion
+
+
+def remove_duplicate_relations(apps, schema_editor):
+    # перед уникальным ограничением оставляем самую раннюю связь каждой пары (user, book)
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    keep = UserBookRelation.objects.values('user', 'book').annotate(keep_id=Min('id')).values('keep_id')
+    duplicates = UserBookRelation.objects.exclude(id__in=keep)
+    book_ids = list(duplicates.values_list('book_id', flat=True).distinct())
+    if not book_ids:
+        return
+    duplicates.delete()
+
+    # у исторических моделей нет UserBookRelation.delete из store.models, поэтому агрегаты книг с дублями
+    # пересчитываем здесь же, по тем же формулам, что store.logic.recalc_book_aggregates
+    relations = UserBookRelation.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    rates = relations.filter(rate__isnull=False)
+    rating_sum = Coalesce(Subquery(rates.annotate(total=Sum('rate')).values('total')), 0)
+    rating_count = Coalesce(Subquery(rates.annotate(total=Count('rate')).values('total')), 0)
+    counters = {'likes_count': 'like', 'bookmarks_count': 'in_bookmarks', 'buyers_count': 'bought'}
+    Book.objects.filter(pk__in=book_ids).update(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating=Cast(rating_sum, models.DecimalField(max_digits=12, decimal_places=2)) / NullIf(rating_count, Value(0)),
+        readers_count=Coalesce(Subquery(relations.annotate(total=Count('pk')).values('total')), 0),
+        version=F('version') + 1,
+        **{counter: Coalesce(Subquery(relations.annotate(total=Count('pk', filter=Q(**{field: True}))).values('total')), 0)
+           for counter, field in counters.items()},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0017_book_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_relations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='userbookrelation',
+            name='book',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='store.book'),
+        ),
+        migrations.AlterField(
+            model_name='userbookrelation',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['price', 'id'], name='store_book_price_id'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['name', 'id'], name='store_book_name_id'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['discount', 'id'], name='store_book_discount_id'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['book', 'id'], name='store_relation_book_id'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('like', True)), fields=['book'], name='store_relation_book_liked'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('rate__isnull', False)), fields=['book'], name='store_relation_book_rated'),
+        ),
+        migrations.AddConstraint(
+            model_name='userbookrelation',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='store_relation_user_book_unique'),
+        ),
+    ]
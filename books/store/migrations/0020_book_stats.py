@@ -0,0 +1,83 @@
+# Generated by Django 3.2.19 on 2026-10-18 07:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# та же формула, что была в BookViewSet.queryset: без скидки или со скидкой 0 - просто цена
+PRICE_WITH_DISCOUNT = ('CASE WHEN {book}.discount IS NULL OR {book}.discount = 0 THEN {book}.price '
+                       'ELSE {book}.price - ({book}.price * {book}.discount) / 100 END')
+
+CREATE_TRIGGERS = f"""
+CREATE FUNCTION store_book_stats_upsert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO store_bookstats (book_id, price_with_discount, likes_count, rating, owner_name)
+    VALUES (NEW.id, {PRICE_WITH_DISCOUNT.format(book='NEW')}, NEW.likes_count, NEW.rating,
+            (SELECT username FROM auth_user WHERE id = NEW.owner_id))
+    ON CONFLICT (book_id) DO UPDATE SET
+        price_with_discount = EXCLUDED.price_with_discount,
+        likes_count = EXCLUDED.likes_count,
+        rating = EXCLUDED.rating,
+        owner_name = EXCLUDED.owner_name;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_book_stats_insert AFTER INSERT ON store_book
+    FOR EACH ROW EXECUTE FUNCTION store_book_stats_upsert();
+
+CREATE TRIGGER store_book_stats_update AFTER UPDATE ON store_book
+    FOR EACH ROW WHEN (
+        OLD.price IS DISTINCT FROM NEW.price OR OLD.discount IS DISTINCT FROM NEW.discount OR
+        OLD.likes_count IS DISTINCT FROM NEW.likes_count OR OLD.rating IS DISTINCT FROM NEW.rating OR
+        OLD.owner_id IS DISTINCT FROM NEW.owner_id
+    ) EXECUTE FUNCTION store_book_stats_upsert();
+
+CREATE FUNCTION store_book_stats_owner_renamed() RETURNS trigger AS $$
+BEGIN
+    UPDATE store_bookstats SET owner_name = NEW.username
+    FROM store_book WHERE store_book.owner_id = NEW.id AND store_bookstats.book_id = store_book.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_book_stats_owner AFTER UPDATE OF username ON auth_user
+    FOR EACH ROW WHEN (OLD.username IS DISTINCT FROM NEW.username)
+    EXECUTE FUNCTION store_book_stats_owner_renamed();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER store_book_stats_owner ON auth_user;
+DROP FUNCTION store_book_stats_owner_renamed();
+DROP TRIGGER store_book_stats_update ON store_book;
+DROP TRIGGER store_book_stats_insert ON store_book;
+DROP FUNCTION store_book_stats_upsert();
+"""
+
+FILL = f"""
+INSERT INTO store_bookstats (book_id, price_with_discount, likes_count, rating, owner_name)
+SELECT store_book.id, {PRICE_WITH_DISCOUNT.format(book='store_book')}, store_book.likes_count, store_book.rating,
+       auth_user.username
+FROM store_book LEFT JOIN auth_user ON auth_user.id = store_book.owner_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_rating_recalc_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='store.book')),
+                ('price_with_discount', models.DecimalField(decimal_places=4, max_digits=11)),
+                ('likes_count', models.IntegerField(default=0)),
+                ('rating', models.DecimalField(decimal_places=2, max_digits=3, null=True)),
+                ('owner_name', models.CharField(max_length=150, null=True)),
+            ],
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+        migrations.RunSQL(FILL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.19 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_book_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['rating', 'id'], name='store_book_rating_id'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['likes_count', 'id'], name='store_book_likes_id'),
+        ),
+        migrations.AddIndex(
+            model_name='bookstats',
+            index=models.Index(fields=['price_with_discount', 'book'], name='store_bookstats_price_book'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.19 on 2026-10-18 07:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0022_book_external_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSimilarityState',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='similarity_state', serialize=False, to='store.book')),
+                ('version', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SimilarBook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_books', to='store.book')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_to', to='store.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='similarbook',
+            index=models.Index(fields=['book', '-score'], name='store_similar_book_score'),
+        ),
+        migrations.AddIndex(
+            model_name='similarbook',
+            index=models.Index(fields=['similar'], name='store_similar_book_similar'),
+        ),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 3.2.19 on 2026-10-18 07:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# вклад каждой связи в счетчики полок ее пользователя, те же условия, что в store.models.SHELVES
+ROW_COUNTS = ('SELECT user_id, {sign}"like"::integer AS liked, {sign}in_bookmarks::integer AS bookmarked, '
+              '{sign}bought::integer AS bought, {sign}(rate IS NOT NULL)::integer AS rated FROM {rows}')
+
+# счетчики меняются на сумму по пользователю за весь оператор, а не на строку: bulk_create, upsert-ы и удаление
+# книг с тысячами связей обновляют каждого пользователя один раз, всегда в порядке user_id, без взаимных блокировок
+UPSERT = """
+        INSERT INTO store_usershelfstats (user_id, liked_count, bookmarked_count, bought_count, rated_count)
+        SELECT user_id, sum(liked), sum(bookmarked), sum(bought), sum(rated) FROM ({changes}) changes
+        GROUP BY user_id
+        HAVING sum(liked) <> 0 OR sum(bookmarked) <> 0 OR sum(bought) <> 0 OR sum(rated) <> 0
+        ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            liked_count = store_usershelfstats.liked_count + EXCLUDED.liked_count,
+            bookmarked_count = store_usershelfstats.bookmarked_count + EXCLUDED.bookmarked_count,
+            bought_count = store_usershelfstats.bought_count + EXCLUDED.bought_count,
+            rated_count = store_usershelfstats.rated_count + EXCLUDED.rated_count;"""
+
+NEW_ROWS = ROW_COUNTS.format(sign='', rows='new_rows')
+OLD_ROWS = ROW_COUNTS.format(sign='-', rows='old_rows')
+
+CREATE_TRIGGERS = f"""
+CREATE FUNCTION store_user_shelf_stats_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN{UPSERT.format(changes=NEW_ROWS)}
+    ELSIF TG_OP = 'UPDATE' THEN{UPSERT.format(changes=f'{NEW_ROWS} UNION ALL {OLD_ROWS}')}
+    ELSE{UPSERT.format(changes=OLD_ROWS)}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_user_shelf_stats_insert AFTER INSERT ON store_userbookrelation
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION store_user_shelf_stats_change();
+
+CREATE TRIGGER store_user_shelf_stats_update AFTER UPDATE ON store_userbookrelation
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION store_user_shelf_stats_change();
+
+CREATE TRIGGER store_user_shelf_stats_delete AFTER DELETE ON store_userbookrelation
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION store_user_shelf_stats_change();
+
+-- при удалении пользователя Django может удалить его счетчики раньше связей, и тогда удаление связей создаст строку
+-- заново. Пользователь удаляется последним, вместе с ним убираем и ее, иначе не пройдет проверка внешнего ключа
+CREATE FUNCTION store_user_shelf_stats_user_deleted() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM store_usershelfstats WHERE user_id IN (SELECT id FROM old_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_user_shelf_stats_user AFTER DELETE ON auth_user
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION store_user_shelf_stats_user_deleted();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER store_user_shelf_stats_user ON auth_user;
+DROP FUNCTION store_user_shelf_stats_user_deleted();
+DROP TRIGGER store_user_shelf_stats_delete ON store_userbookrelation;
+DROP TRIGGER store_user_shelf_stats_update ON store_userbookrelation;
+DROP TRIGGER store_user_shelf_stats_insert ON store_userbookrelation;
+DROP FUNCTION store_user_shelf_stats_change();
+"""
+
+FILL = f"""
+INSERT INTO store_usershelfstats (user_id, liked_count, bookmarked_count, bought_count, rated_count)
+SELECT user_id, sum(liked), sum(bookmarked), sum(bought), sum(rated)
+FROM ({ROW_COUNTS.format(sign='', rows='store_userbookrelation')}) changes GROUP BY user_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('store', '0023_similar_books'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShelfStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shelf_stats', serialize=False, to='auth.user')),
+                ('liked_count', models.IntegerField(default=0)),
+                ('bookmarked_count', models.IntegerField(default=0)),
+                ('bought_count', models.IntegerField(default=0)),
+                ('rated_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('like', True)), fields=['user', 'id'], include=('book', 'like', 'in_bookmarks', 'rate', 'bought'), name='store_relation_user_liked'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('in_bookmarks', True)), fields=['user', 'id'], include=('book', 'like', 'in_bookmarks', 'rate', 'bought'), name='store_relation_user_bookmarked'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('bought', True)), fields=['user', 'id'], include=('book', 'like', 'in_bookmarks', 'rate', 'bought'), name='store_relation_user_bought'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('rate__isnull', False)), fields=['user', 'id'], include=('book', 'like', 'in_bookmarks', 'rate', 'bought'), name='store_relation_user_rated'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+        migrations.RunSQL(FILL, migrations.RunSQL.noop),
+    ]
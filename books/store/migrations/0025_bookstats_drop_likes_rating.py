@@ -0,0 +1,76 @@
+# Generated by Django 3.2.19 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+# та же формула, что в миграции 0020
+PRICE_WITH_DISCOUNT = ('CASE WHEN NEW.discount IS NULL OR NEW.discount = 0 THEN NEW.price '
+                       'ELSE NEW.price - (NEW.price * NEW.discount) / 100 END')
+
+# likes_count и rating список книг читает из самой книги, в BookStats они только дублировались
+REPLACE_TRIGGERS = f"""
+DROP TRIGGER store_book_stats_update ON store_book;
+
+CREATE OR REPLACE FUNCTION store_book_stats_upsert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO store_bookstats (book_id, price_with_discount, owner_name)
+    VALUES (NEW.id, {PRICE_WITH_DISCOUNT}, (SELECT username FROM auth_user WHERE id = NEW.owner_id))
+    ON CONFLICT (book_id) DO UPDATE SET
+        price_with_discount = EXCLUDED.price_with_discount,
+        owner_name = EXCLUDED.owner_name;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_book_stats_update AFTER UPDATE ON store_book
+    FOR EACH ROW WHEN (
+        OLD.price IS DISTINCT FROM NEW.price OR OLD.discount IS DISTINCT FROM NEW.discount OR
+        OLD.owner_id IS DISTINCT FROM NEW.owner_id
+    ) EXECUTE FUNCTION store_book_stats_upsert();
+"""
+
+RESTORE_TRIGGERS = f"""
+DROP TRIGGER store_book_stats_update ON store_book;
+
+CREATE OR REPLACE FUNCTION store_book_stats_upsert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO store_bookstats (book_id, price_with_discount, likes_count, rating, owner_name)
+    VALUES (NEW.id, {PRICE_WITH_DISCOUNT}, NEW.likes_count, NEW.rating,
+            (SELECT username FROM auth_user WHERE id = NEW.owner_id))
+    ON CONFLICT (book_id) DO UPDATE SET
+        price_with_discount = EXCLUDED.price_with_discount,
+        likes_count = EXCLUDED.likes_count,
+        rating = EXCLUDED.rating,
+        owner_name = EXCLUDED.owner_name;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_book_stats_update AFTER UPDATE ON store_book
+    FOR EACH ROW WHEN (
+        OLD.price IS DISTINCT FROM NEW.price OR OLD.discount IS DISTINCT FROM NEW.discount OR
+        OLD.likes_count IS DISTINCT FROM NEW.likes_count OR OLD.rating IS DISTINCT FROM NEW.rating OR
+        OLD.owner_id IS DISTINCT FROM NEW.owner_id
+    ) EXECUTE FUNCTION store_book_stats_upsert();
+
+UPDATE store_bookstats SET likes_count = store_book.likes_count, rating = store_book.rating
+FROM store_book WHERE store_book.id = store_bookstats.book_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0024_user_shelves'),
+    ]
+
+    operations = [
+        migrations.RunSQL(REPLACE_TRIGGERS, RESTORE_TRIGGERS),
+        migrations.RemoveField(
+            model_name='bookstats',
+            name='likes_count',
+        ),
+        migrations.RemoveField(
+            model_name='bookstats',
+            name='rating',
+        ),
+    ]
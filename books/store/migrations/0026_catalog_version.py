@@ -0,0 +1,63 @@
+# Generated by Django 3.2.19 on 2026-10-18 08:23
+
+from django.db import migrations, models
+
+# версия берется из отдельной последовательности: nextval не откатывается и не сбрасывается вместе с таблицами,
+# так что значения не повторяются, даже если строку удалить или транзакцию откатить.
+# Триггер на оператор срабатывает и без затронутых строк, пустые операторы версию не меняют.
+# Строка блокируется до конца транзакции, так что записи книг идут по очереди
+CREATE_TRIGGERS = """
+CREATE SEQUENCE store_catalog_version_seq;
+
+CREATE FUNCTION store_catalog_version_bump() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM 1 FROM old_rows LIMIT 1;
+    ELSE
+        PERFORM 1 FROM new_rows LIMIT 1;
+    END IF;
+    IF FOUND THEN
+        INSERT INTO store_catalogversion (id, version) VALUES (1, nextval('store_catalog_version_seq'))
+        ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_catalog_version_insert AFTER INSERT ON store_book
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION store_catalog_version_bump();
+
+CREATE TRIGGER store_catalog_version_update AFTER UPDATE ON store_book
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION store_catalog_version_bump();
+
+CREATE TRIGGER store_catalog_version_delete AFTER DELETE ON store_book
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION store_catalog_version_bump();
+
+INSERT INTO store_catalogversion (id, version) VALUES (1, nextval('store_catalog_version_seq'));
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER store_catalog_version_delete ON store_book;
+DROP TRIGGER store_catalog_version_update ON store_book;
+DROP TRIGGER store_catalog_version_insert ON store_book;
+DROP FUNCTION store_catalog_version_bump();
+DROP SEQUENCE store_catalog_version_seq;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0025_bookstats_drop_likes_rating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.PositiveSmallIntegerField(default=1, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField()),
+            ],
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
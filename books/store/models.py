@@ -1,6 +1,24 @@
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import models, transaction
+from django.db.models import F, Q, Value
 from django.contrib.auth.models import User
 
+SEARCH_CONFIG = 'simple' # без стемминга: названия и имена авторов на разных языках
+
+# полки пользователя в /me/books/?shelf=: связь попадает на полку, если выполнено условие
+SHELVES = {
+    'liked': Q(like=True),
+    'bookmarked': Q(in_bookmarks=True),
+    'bought': Q(bought=True),
+    'rated': Q(rate__isnull=False),
+}
+
+
+def book_search_vector(name, author_name):
+    # совпадение в названии весит больше, чем в имени автора
+    return SearchVector(name, weight='A', config=SEARCH_CONFIG) + SearchVector(author_name, weight='B', config=SEARCH_CONFIG)
+
 
 
 class Book(models.Model):
@@ -11,10 +29,56 @@ class Book(models.Model):
     readers = models.ManyToManyField(User, through='UserBookRelation', related_name='books')
     discount = models.IntegerField(blank=True, null=True)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=None, null=True)
+    rating_sum = models.IntegerField(default=0) # сумма и количество оценок, из них в store.logic считается rating
+    rating_count = models.IntegerField(default=0)
+    likes_count = models.IntegerField(default=0) # счетчики связей, обновляются в store.logic при сохранении и удалении UserBookRelation
+    bookmarks_count = models.IntegerField(default=0)
+    buyers_count = models.IntegerField(default=0)
+    readers_count = models.IntegerField(default=0)
+    version = models.IntegerField(default=1) # растет при каждом изменении книги, ее связей и имен владельца/читателей, из него строится ETag
+    search_vector = SearchVectorField(null=True, editable=False) # name + author_name для полнотекстового поиска, обновляется в save
+    external_id = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False) # ключ книги во внешнем каталоге, по нему import_books пропускает уже загруженные книги
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='store_book_search_gin'),
+            # фильтры и сортировки BookViewSet, id - добивка для курсорной пагинации
+            models.Index(fields=['price', 'id'], name='store_book_price_id'),
+            models.Index(fields=['name', 'id'], name='store_book_name_id'),
+            models.Index(fields=['discount', 'id'], name='store_book_discount_id'),
+            models.Index(fields=['rating', 'id'], name='store_book_rating_id'),
+            models.Index(fields=['likes_count', 'id'], name='store_book_likes_id'),
+        ]
+
+    AGGREGATE_FIELDS = ('rating', 'rating_sum', 'rating_count',
+                        'likes_count', 'bookmarks_count', 'buyers_count', 'readers_count', 'version')
 
     def __str__(self):
         return f'ID {self.id}: {self.name}'
 
+    def save(self, *args, **kwargs):
+        # агрегаты меняются только через F() в store.logic, поэтому при обычном сохранении книги их не перезаписываем старыми значениями из памяти
+        updating = not self._state.adding and not kwargs.get('force_insert')
+        update_search = True
+        if updating:
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                           if not field.primary_key and field.name not in self.AGGREGATE_FIELDS
+                                           and field.name != 'search_vector']
+            update_search = bool({'name', 'author_name'} & set(kwargs['update_fields']))
+            kwargs['update_fields'] = [*kwargs['update_fields'], 'version'] + (['search_vector'] if update_search else [])
+            self.version = F('version') + 1 # увеличиваем в том же UPDATE, без гонок с изменениями связей
+        if update_search:
+            # Value, а не F: выражение с колонками нельзя вставить в INSERT
+            self.search_vector = book_search_vector(Value(self.name), Value(self.author_name))
+        super().save(*args, **kwargs)
+        # в памяти остались выражения: новую версию сразу дочитываем (по ней строится ETag) из той базы, куда писали, а не с реплики,
+        # а search_vector из модели никто не читает, его просто убираем
+        if updating:
+            self.refresh_from_db(using=self._state.db, fields=['version'])
+        if update_search:
+            del self.search_vector
+
 
 class UserBookRelation(models.Model):
     RATE_CHOICES = (
@@ -25,8 +89,8 @@ class UserBookRelation(models.Model):
         (5, 'Incredible'),
     )
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False) # отдельные индексы не нужны, их заменяют составные из Meta
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, db_index=False)
     like = models.BooleanField(default=False)
     in_bookmarks = models.BooleanField(default=False)
     rate = models.PositiveSmallIntegerField(choices=RATE_CHOICES, null=True)
@@ -41,24 +105,146 @@ class UserBookRelation(models.Model):
                f'bought: {self.bought}'
 
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='store_relation_user_book_unique'), # заодно индекс для get_or_create и поиска по user
+        ]
+        indexes = [
+            models.Index(fields=['book', 'id'], name='store_relation_book_id'), # читатели книги по порядку
+            models.Index(fields=['book'], condition=Q(like=True), name='store_relation_book_liked'),
+            models.Index(fields=['book'], condition=Q(rate__isnull=False), name='store_relation_book_rated'),
+            # полки пользователя, новые связи первыми. В индексе все поля связи, так что страница полки вместе с
+            # my_relation читается index only scan, а условие полки отсекает остальные связи из индекса
+            *[models.Index(fields=['user', 'id'], include=['book', 'like', 'in_bookmarks', 'rate', 'bought'],
+                           condition=condition, name=f'store_relation_user_{shelf}')
+              for shelf, condition in SHELVES.items()],
+        ]
+
+    COUNTED_FIELDS = ('book_id', 'like', 'in_bookmarks', 'rate', 'bought') # поля, от которых зависят агрегаты книги
+
     def __init__(self, *args, **kwargs):
         super(UserBookRelation, self).__init__(*args, **kwargs)
-        self.old_rate = self.rate # чтобы получить старое значение rate, создаем переменную на уровне родительского класса и в нее сохраняем значение rate
+        self.old_values = self.counted_values() # чтобы получить старые значения (rate, like и т.д.), сохраняем их на уровне объекта
 
+    @property
+    def old_rate(self):
+        return self.old_values['rate']
 
-    def save(self, *args, **kwargs): # пишем свой метод save (который есть в ролительском классе Model), который вызывается при сохранении модели, и добавляем туда свою функцию set_rating, которая будет пересчитывать рейтинг, при каждом сохранении UserBookRelation.
+    def counted_values(self):
+        return {field: getattr(self, field) for field in self.COUNTED_FIELDS}
 
 
-        from store.logic import set_rating # делаем локальный импорт, потому что мы вызываем внутри этого класса функцию set_rating, в которой используется сам этот класс, то есть получается замкнутый круг, и питон так не отрабатывает
+    def save(self, *args, **kwargs): # пишем свой метод save (который есть в ролительском классе Model), который вызывается при сохранении модели, и добавляем туда свою функцию apply_relation_change, которая будет пересчитывать рейтинг и счетчики, при каждом сохранении UserBookRelation.
 
-        creating1 = not self.pk # если такая связь еще не создана, то не будет и pk, проверяем это, чтобы добавить в условие if ниже. Это нужно чтоб запустить пересчет рейтинга в случае, когда рейтинг не только изменился, но и в случае когда создалась новая связь в которой сразу указан рейтинг. not - чтобы в переменной creating1 создалось что-то, если рейтинга еще нет.
-        super().save(*args, **kwargs) #  но делаем так, чтоб метод save  не перезаписался в родительском классе Model
 
-        # print('old_rate===///', self.book, '=', self.old_rate, '--', self.user)
-        # print('new_rate===///', self.book, '=', self.rate, '--', self.user)
+        from store.logic import apply_relation_change # делаем локальный импорт, потому что мы вызываем внутри этого класса функцию apply_relation_change, в которой используется сам этот класс, то есть получается замкнутый круг, и питон так не отрабатывает
 
-        # new_rating = self.rate # можно не рефрешить, потому что self всегда актуальное с базой
-        if self.rate != self.old_rate or creating1:
-            set_rating(self.book)
+        creating1 = not self.pk # если такая связь еще не создана, то не будет и pk. Тогда старых значений в базе нет, и пересчет должен учесть связь целиком
+        old = None if creating1 else self.old_values
+        new = self.counted_values()
+        with transaction.atomic(savepoint=False): # внутри уже открытой транзакции savepoint не нужен
+            super().save(*args, **kwargs) #  но делаем так, чтоб метод save  не перезаписался в родительском классе Model
 
+            if old != new:
+                # передаем book_id, а не self.book, чтобы не тянуть книгу из базы
+                if old and old['book_id'] != new['book_id']:
+                    apply_relation_change(old['book_id'], old, None)
+                    old = None
+                apply_relation_change(new['book_id'], old, new)
+        self.old_values = new # теперь в базе лежат новые значения, следующее сохранение считает разницу уже от них
+        # удаление пересчитывает store.signals.relation_deleted: delete() не вызывается при каскадном удалении и queryset.delete()
+
+
+class BookStats(models.Model):
+    """
+    Read model of the values the book list used to compute per request:
+    discounted price (CASE) and owner username (join to auth_user). One row
+    per book, kept up to date by PostgreSQL triggers on store_book and
+    auth_user (migrations 0020 and 0025), so it also follows
+    queryset.update() and raw SQL. rebuild_book_stats resyncs it.
+    """
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    price_with_discount = models.DecimalField(max_digits=11, decimal_places=4) # price * discount / 100 дает до 4 знаков
+    owner_name = models.CharField(max_length=150, null=True)
+
+    class Meta:
+        indexes = [
+            # сортировка и фильтр списка книг по ?price_with_discount, book - добивка для курсорной пагинации
+            models.Index(fields=['price_with_discount', 'book'], name='store_bookstats_price_book'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id}: {self.price_with_discount}, owner: {self.owner_name}'
+
+
+class UserShelfStats(models.Model):
+    """
+    Number of books on each shelf of a user (see SHELVES), so the profile
+    header and /me/books/counts/ need no COUNT(*). Kept up to date by
+    statement-level PostgreSQL triggers on store_userbookrelation (migration
+    0024), so it also follows bulk_create, upserts and raw deletes. A user
+    without a row has empty shelves. rebuild_shelf_stats resyncs it.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='shelf_stats')
+    liked_count = models.IntegerField(default=0)
+    bookmarked_count = models.IntegerField(default=0)
+    bought_count = models.IntegerField(default=0)
+    rated_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.user_id}: ' + ', '.join(f'{shelf} {getattr(self, f"{shelf}_count")}' for shelf in SHELVES)
 
+
+class CatalogVersion(models.Model):
+    """
+    Version of the whole book collection: a single row (id 1) that a
+    statement-level PostgreSQL trigger (migration 0026) moves to the next
+    value of a sequence on every write to store_book. List ETags and
+    cached list responses are keyed by it, so a write served by one process
+    invalidates them in every process. No row means no book was changed yet.
+    """
+    id = models.PositiveSmallIntegerField(primary_key=True, default=1)
+    version = models.BigIntegerField()
+
+    def __str__(self):
+        return str(self.version)
+
+
+class RatingRecalcJob(models.Model):
+    # очередь пересчета рейтинга для STORE_RATING_QUEUE = 'db'. Несколько заданий одной книги схлопываются при разборе
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.book_id}, {self.created_at}'
+
+
+class SimilarBook(models.Model):
+    """
+    Top STORE_SIMILAR_BOOKS books per book by cosine similarity of their
+    reader signals (likes, high rates, purchases). Precomputed offline by
+    build_similar_books (see store.recommendations), read by
+    /book/{id}/similar/ and /book/recommended/.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_books')
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_to')
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            # уникальность (book, similar) обеспечивает сборщик: список книги всегда заменяется целиком
+            models.Index(fields=['book', '-score'], name='store_similar_book_score'), # список похожих по порядку
+            models.Index(fields=['similar'], name='store_similar_book_similar'), # какие списки задело изменение книги
+        ]
+
+    def __str__(self):
+        return f'{self.book_id} ~ {self.similar_id}: {self.score:.3f}'
+
+
+class BookSimilarityState(models.Model):
+    # Book.version, с которым для книги последний раз считались похожие книги. Разошлись - список пора пересчитать
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='similarity_state')
+    version = models.IntegerField()
+
+    def __str__(self):
+        return f'{self.book_id}: {self.version}'
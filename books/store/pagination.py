@@ -0,0 +1,197 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on the queryset ordering plus an id tiebreaker.
+
+    Unlike OFFSET, the next page is fetched with a WHERE on the last row's
+    values, so a deep page costs the same as the first one.
+    NULL values are treated as the largest ones (PostgreSQL default).
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    tiebreaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(queryset)
+        self.nullable = {name.lstrip('-'): self.is_nullable(queryset, name.lstrip('-')) for name in self.ordering}
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['r'])
+
+        ordering = [self.invert(name) for name in self.ordering] if reverse else self.ordering
+        queryset = queryset.order_by(*[self.order_expression(name) for name in ordering])
+        if cursor:
+            queryset = queryset.filter(self.after_position(ordering, cursor['p']))
+
+        results = list(queryset[:self.page_size + 1]) # берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.next_position = self.previous_position = None
+        if results:
+            if has_more or reverse:
+                self.next_position = self.get_position(results[-1])
+            if has_more if reverse else cursor:
+                self.previous_position = self.get_position(results[0])
+        elif cursor:
+            # пустая страница: назад можно вернуться от позиции самого курсора
+            if reverse:
+                self.next_position = cursor['p']
+            else:
+                self.previous_position = cursor['p']
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def get_ordering(self, queryset):
+        # сортировку берем из самого queryset, то есть ее уже применили OrderingFilter и остальные фильтры
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        for name in ordering:
+            if not isinstance(name, str):
+                raise TypeError(f'{self.__class__.__name__} supports only field name ordering, got {name!r}')
+        if self.tiebreaker not in [name.lstrip('-') for name in ordering]:
+            last_desc = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append(f'-{self.tiebreaker}' if last_desc else self.tiebreaker)
+        return ordering
+
+    def is_nullable(self, queryset, name):
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field.null
+        model = queryset.model
+        field = None
+        for part in name.split('__'):
+            try:
+                field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                return True
+            if field.is_relation and field.related_model:
+                if field.null or not field.concrete:
+                    return True
+                model = field.related_model
+        return field.null
+
+    @staticmethod
+    def invert(name):
+        return name[1:] if name.startswith('-') else f'-{name}'
+
+    @staticmethod
+    def order_expression(name):
+        if name.startswith('-'):
+            return F(name[1:]).desc(nulls_first=True)
+        return F(name).asc(nulls_last=True)
+
+    def after_position(self, ordering, position):
+        # (a, b, id) > (x, y, z) в лексикографическом смысле, с учетом направлений и NULL
+        condition = Q(pk__in=[])
+        equal = Q()
+        for name, value in zip(ordering, position):
+            field = name.lstrip('-')
+            desc = name.startswith('-')
+            nullable = self.nullable[field]
+            if value is None:
+                if desc:
+                    condition |= equal & Q(**{f'{field}__isnull': False})
+                equal &= Q(**{f'{field}__isnull': True})
+            else:
+                greater = Q(**{f'{field}__lt' if desc else f'{field}__gt': value})
+                if nullable and not desc:
+                    greater |= Q(**{f'{field}__isnull': True})
+                condition |= equal & greater
+                equal &= Q(**{field: value})
+
+        # избыточное ограничение по первому полю, чтобы индекс начинал скан сразу с нужного места
+        first, value = ordering[0], position[0]
+        field = first.lstrip('-')
+        if value is not None and (first.startswith('-') or not self.nullable[field]):
+            condition &= Q(**{f'{field}__lte' if first.startswith('-') else f'{field}__gte': value})
+        return condition
+
+    def get_position(self, item):
+        position = []
+        for name in self.ordering:
+            name = name.lstrip('-')
+            if isinstance(item, dict):
+                value = item[name]
+            else:
+                value = item
+                for part in name.split('__'):
+                    value = getattr(value, part, None) if value is not None else None
+            position.append(value)
+        return position
+
+    def encode_cursor(self, position, reverse):
+        data = {'o': self.ordering, 'p': position, 'r': reverse}
+        encoded = base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':'), default=str).encode('ascii'))
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode('ascii'))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            if data['o'] != self.ordering or len(data['p']) != len(self.ordering):
+                raise ValueError('Cursor ordering mismatch')
+            data['r'] = bool(data['r'])
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return data
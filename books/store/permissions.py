@@ -9,6 +9,15 @@ class IsOwnerOrStaffOrReadOnly(BasePermission):
         return bool(
             request.method in SAFE_METHODS or
             request.user and
-            request.user.is_authenticated and (obj.owner == request.user
+            # request.user.is_authenticated and (obj.owner == request.user # obj.owner - лишний запрос за пользователем
+            request.user.is_authenticated and (obj.owner_id == request.user.id
                                                or request.user.is_staff)
         )
+
+    def filter_queryset(self, request, queryset):
+        # то же правило для массовых операций: одно условие в WHERE у UPDATE/DELETE вместо проверки каждого объекта
+        if request.method in SAFE_METHODS or request.user.is_staff:
+            return queryset
+        if not request.user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(owner_id=request.user.id)
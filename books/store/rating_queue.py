@@ -0,0 +1,134 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from store.models import Book, RatingRecalcJob
+
+logger = logging.getLogger(__name__)
+
+
+class SyncRatingQueue:
+    """
+    Rating is updated in the same UPDATE as the relation counters, inside the
+    request. Used in tests and as the reference behaviour.
+    """
+    deferred = False
+
+    def schedule(self, book_ids):
+        self.process(book_ids)
+
+    def process(self, book_ids):
+        from store.logic import recalc_ratings # store.logic сам импортирует этот модуль
+
+        book_ids = sorted(set(book_ids)) # в одном порядке, чтобы параллельные пересчеты не ловили deadlock
+        if book_ids:
+            recalc_ratings(Book.objects.filter(pk__in=book_ids))
+        return len(book_ids)
+
+
+class ThreadRatingQueue(SyncRatingQueue):
+    """
+    In-process worker thread. Book ids are collected for STORE_RATING_QUEUE_DELAY
+    seconds after the first one arrives, then all of them are recalculated by one
+    UPDATE. On a normal exit the process waits up to exit_timeout seconds for the
+    queue to drain; ids are lost only if the process dies, rebuild_ratings
+    repairs that.
+    """
+    deferred = True
+    exit_timeout = 30
+
+    def __init__(self, delay=None):
+        self.delay = settings.STORE_RATING_QUEUE_DELAY if delay is None else delay
+        self.pending = set()
+        self.busy = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.exit_hook = False
+
+    def schedule(self, book_ids):
+        # worker должен увидеть уже закоммиченные оценки
+        transaction.on_commit(lambda: self.enqueue(book_ids))
+
+    def enqueue(self, book_ids):
+        with self.condition:
+            self.pending.update(book_ids)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='rating-queue', daemon=True)
+                self.thread.start()
+            if not self.exit_hook:
+                # поток daemon и не держит процесс, поэтому при выходе сами ждем, пока он разберет очередь
+                atexit.register(self.flush, self.delay + self.exit_timeout)
+                self.exit_hook = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+            time.sleep(self.delay) # debounce: за это время подтянутся остальные оценки этих же книг
+            with self.condition:
+                book_ids, self.pending = self.pending, set()
+                self.busy = True
+            try:
+                self.process(book_ids)
+            except Exception:
+                logger.exception('Rating recalculation failed for books %s', sorted(book_ids))
+            finally:
+                connections.close_all() # у потока свои соединения, держать их открытыми между пачками незачем
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        # ждет, пока worker разберет все, что уже стоит в очереди
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+
+class DbRatingQueue(SyncRatingQueue):
+    """
+    Jobs are rows of RatingRecalcJob written in the same transaction as the
+    relation, so they survive restarts. The drain_rating_queue command takes a
+    batch with SKIP LOCKED, recalculates each book once and deletes exactly the
+    rows it took: jobs added meanwhile stay for the next batch.
+    """
+    deferred = True
+
+    def schedule(self, book_ids):
+        RatingRecalcJob.objects.bulk_create([RatingRecalcJob(book_id=book_id) for book_id in book_ids])
+
+    def drain(self, batch_size=1000):
+        with transaction.atomic():
+            jobs = list(RatingRecalcJob.objects.select_for_update(skip_locked=True).order_by('id')
+                        .values_list('id', 'book_id')[:batch_size])
+            if not jobs:
+                return 0, 0
+            books = self.process(book_id for _, book_id in jobs)
+            RatingRecalcJob.objects.filter(pk__in=[job_id for job_id, _ in jobs]).delete()
+        return len(jobs), books
+
+
+RATING_QUEUES = {
+    'sync': SyncRatingQueue,
+    'thread': ThreadRatingQueue,
+    'db': DbRatingQueue,
+}
+_queues = {}
+
+
+def get_rating_queue():
+    # STORE_RATING_QUEUE - 'sync', 'thread', 'db' или путь к своему классу с методами schedule и process
+    name = settings.STORE_RATING_QUEUE
+    if name not in _queues:
+        try:
+            queue_class = RATING_QUEUES[name] if name in RATING_QUEUES else import_string(name)
+        except ImportError as e:
+            raise ImproperlyConfigured(f'Unknown STORE_RATING_QUEUE {name!r}') from e
+        _queues[name] = queue_class()
+    return _queues[name]
@@ -0,0 +1,225 @@
+import heapq
+import math
+from collections import defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Case, F, FloatField, Q, Value, When
+
+from store.models import Book, BookSimilarityState, SimilarBook, UserBookRelation
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError: # необязательные зависимости, без них матрица собирается из обычных словарей
+    numpy = sparse = None
+
+# вклад связи в вектор книги: лайк, покупка и высокая оценка - интерес, оценки ниже 4 не считаются
+SIGNAL_WEIGHTS = {'like': 1.0, 'bought': 1.0}
+RATE_WEIGHTS = {5: 1.0, 4: 0.5}
+
+
+def signal_weight():
+    parts = [Case(When(**{field: True}, then=Value(weight)), default=Value(0.0), output_field=FloatField())
+             for field, weight in SIGNAL_WEIGHTS.items()]
+    parts.append(Case(*[When(rate=rate, then=Value(weight)) for rate, weight in RATE_WEIGHTS.items()],
+                      default=Value(0.0), output_field=FloatField()))
+    return sum(parts[1:], parts[0])
+
+
+def signal_filter(prefix=''):
+    # те же условия, что дают ненулевой вес, но в виде WHERE, чтобы работали частичные индексы
+    condition = Q(**{f'{prefix}rate__in': list(RATE_WEIGHTS)})
+    for field in SIGNAL_WEIGHTS:
+        condition |= Q(**{f'{prefix}{field}': True})
+    return condition
+
+
+def signals():
+    # (user_id, book_id, weight) всех связей с ненулевым весом - ненулевые элементы матрицы user x book
+    return UserBookRelation.objects.filter(signal_filter()).annotate(weight=signal_weight()) \
+        .values_list('user_id', 'book_id', 'weight')
+
+
+class PythonSimilarity:
+    """
+    Item-item cosine similarity over a sparse user x book matrix kept as
+    dicts of (id, weight) lists. For one book only the users who have it and
+    their other books are visited, so a book costs the sum of its readers'
+    library sizes.
+    """
+    def __init__(self, rows):
+        self.by_user = defaultdict(list)
+        self.by_book = defaultdict(list)
+        for user_id, book_id, weight in rows:
+            self.by_user[user_id].append((book_id, weight))
+            self.by_book[book_id].append((user_id, weight))
+        self.norms = {book_id: math.sqrt(sum(weight * weight for _, weight in column))
+                      for book_id, column in self.by_book.items()}
+
+    def top_similar(self, book_ids, k):
+        for book_id in book_ids:
+            dots = defaultdict(float)
+            for user_id, weight in self.by_book.get(book_id, ()):
+                for other_id, other_weight in self.by_user[user_id]:
+                    dots[other_id] += weight * other_weight
+            dots.pop(book_id, None)
+            norm = self.norms.get(book_id)
+            scores = ((other_id, dot / (norm * self.norms[other_id])) for other_id, dot in dots.items())
+            # при равном сходстве выше книга с меньшим id, как и в ScipySimilarity
+            yield book_id, heapq.nlargest(k, scores, key=lambda item: (item[1], -item[0]))
+
+
+class ScipySimilarity:
+    """
+    The same similarity with the matrix in scipy.sparse: columns are
+    normalized once, and the scores of a chunk of books are one sparse
+    product chunk.T @ matrix.
+    """
+    chunk_size = 1000
+
+    def __init__(self, rows):
+        data = numpy.array(list(rows), dtype=numpy.float64).reshape(-1, 3)
+        if not len(data):
+            self.positions = {}
+            return
+        user_ids, users = numpy.unique(data[:, 0], return_inverse=True)
+        self.book_ids, books = numpy.unique(data[:, 1].astype(numpy.int64), return_inverse=True)
+        matrix = sparse.csc_matrix((data[:, 2], (users, books)), shape=(len(user_ids), len(self.book_ids)))
+        norms = numpy.sqrt(matrix.multiply(matrix).sum(axis=0)).A1
+        self.matrix = (matrix @ sparse.diags(1 / norms)).tocsc() # веса ненулевые, так что и нормы тоже
+        self.positions = {int(book_id): position for position, book_id in enumerate(self.book_ids)}
+
+    def top_similar(self, book_ids, k):
+        book_ids = iter(book_ids)
+        while chunk := list(islice(book_ids, self.chunk_size)):
+            known = [book_id for book_id in chunk if book_id in self.positions]
+            yield from ((book_id, []) for book_id in chunk if book_id not in self.positions)
+            if not known:
+                continue
+            columns = [self.positions[book_id] for book_id in known]
+            scores = (self.matrix[:, columns].T @ self.matrix).tocsr()
+            for row, (book_id, column) in enumerate(zip(known, columns)):
+                start, end = scores.indptr[row], scores.indptr[row + 1]
+                indices, values = scores.indices[start:end], scores.data[start:end]
+                keep = indices != column
+                indices, values = indices[keep], values[keep]
+                if len(values) > k:
+                    top = numpy.argpartition(-values, k)[:k]
+                    indices, values = indices[top], values[top]
+                order = numpy.lexsort((self.book_ids[indices], -values))
+                yield book_id, [(int(self.book_ids[index]), float(value))
+                                for index, value in zip(indices[order], values[order])]
+
+
+ENGINES = {'python': PythonSimilarity, 'scipy': ScipySimilarity}
+
+
+def get_engine_class(name=None):
+    name = name or settings.STORE_SIMILARITY_ENGINE
+    if name == 'auto':
+        name = 'python' if sparse is None else 'scipy'
+    if name == 'scipy' and sparse is None:
+        raise ImportError("STORE_SIMILARITY_ENGINE = 'scipy' needs numpy and scipy installed")
+    return ENGINES[name]
+
+
+def stale_books():
+    # книги, у которых Book.version ушел вперед с последнего расчета, и книги, для которых расчета еще не было
+    return dict(Book.objects.exclude(similarity_state__version=F('version')).values_list('id', 'version'))
+
+
+def affected_books(book_ids):
+    """
+    Books whose similar list can change when the signals of book_ids change:
+    the books themselves, books that share a reader with them (their score
+    may have gone up) and books that list them now (it may have gone down).
+    Other scores do not depend on these books, so their lists stay valid.
+    """
+    readers = UserBookRelation.objects.filter(signal_filter(), book_id__in=book_ids).values('user_id')
+    neighbours = UserBookRelation.objects.filter(signal_filter(), user_id__in=readers).values_list('book_id', flat=True)
+    listing = SimilarBook.objects.filter(similar_id__in=book_ids).values_list('book_id', flat=True)
+    return set(book_ids) | set(neighbours.distinct()) | set(listing.distinct())
+
+
+def array_type(model, name, connection):
+    # тип элементов массива для unnest: у внешнего ключа - тип ключа книги (bigint), а не integer
+    field = model._meta.get_field(name)
+    return (field.target_field if field.is_relation else field).cast_db_type(connection)
+
+
+def save_similar(results):
+    # results - [(book_id, [(similar_id, score), ...])]. Список книги всегда заменяется целиком.
+    # Строк много, а bulk_create тратит больше времени на объекты моделей, чем база на вставку, поэтому массивы и unnest
+    pairs = [(book_id, similar_id, score) for book_id, similar in results for similar_id, score in similar]
+    connection = connections[router.db_for_write(SimilarBook)]
+    quote = connection.ops.quote_name
+    arrays = ', '.join(f'%s::{array_type(SimilarBook, field, connection)}[]' for field in ('book', 'similar', 'score'))
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {quote(SimilarBook._meta.db_table)} WHERE book_id = ANY(%s)',
+                       [[book_id for book_id, _ in results]])
+        if pairs:
+            cursor.execute(f'INSERT INTO {quote(SimilarBook._meta.db_table)} (book_id, similar_id, score) '
+                           f'SELECT * FROM unnest({arrays})', [list(column) for column in zip(*pairs)])
+
+
+def save_states(versions):
+    connection = connections[router.db_for_write(BookSimilarityState)]
+    quote = connection.ops.quote_name
+    arrays = ', '.join(f'%s::{array_type(BookSimilarityState, field, connection)}[]' for field in ('book', 'version'))
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {quote(BookSimilarityState._meta.db_table)} (book_id, version) '
+                       f'SELECT * FROM unnest({arrays}) '
+                       f'ON CONFLICT (book_id) DO UPDATE SET version = EXCLUDED.version',
+                       [list(versions), list(versions.values())])
+
+
+def build_similar_books(full=False, engine=None, k=None, batch_size=1000):
+    """
+    Recomputes SimilarBook. full=True rebuilds every book, otherwise only the
+    lists affected by books whose version changed since the last run. The
+    signals are always loaded whole: a score needs the norms of both books.
+    Returns (number of changed books, number of recomputed lists).
+    """
+    k = k or settings.STORE_SIMILAR_BOOKS
+    versions = dict(Book.objects.values_list('id', 'version')) if full else stale_books()
+    if not versions:
+        return 0, 0
+
+    targets = sorted(versions) if full else sorted(affected_books(list(versions)))
+    similarity = get_engine_class(engine)(signals().iterator(chunk_size=10000))
+    results = similarity.top_similar(targets, k)
+    while batch := list(islice(results, batch_size)):
+        save_similar(batch)
+    # версии берем прочитанные до расчета: если книга поменялась за это время, следующий запуск посчитает ее снова
+    save_states(versions)
+    return len(versions), len(targets)
+
+
+def similar_books(queryset, book_id):
+    return queryset.filter(similar_to__book_id=book_id) \
+        .annotate(similarity=F('similar_to__score')).order_by('-similarity', 'id')
+
+
+def recommended_book_ids(user, limit=None):
+    """
+    Ids of books for the user's feed, best first: every book the user liked,
+    rated high or bought votes for its similar books with score * weight.
+    Books the user already has a relation with are left out.
+    """
+    limit = limit or settings.STORE_RECOMMENDED_BOOKS
+    connection = connections[router.db_for_read(SimilarBook)]
+    quote = connection.ops.quote_name
+    user_signals, params = UserBookRelation.objects.filter(signal_filter(), user=user) \
+        .annotate(weight=signal_weight()).values('book_id', 'weight').query.sql_with_params()
+    relations = quote(UserBookRelation._meta.db_table)
+    sql = (f'SELECT neighbour.similar_id, SUM(neighbour.score * signals.weight) AS score '
+           f'FROM {quote(SimilarBook._meta.db_table)} neighbour JOIN ({user_signals}) signals '
+           f'ON neighbour.book_id = signals.book_id '
+           f'WHERE NOT EXISTS (SELECT 1 FROM {relations} own '
+           f'WHERE own.user_id = %s AND own.book_id = neighbour.similar_id) '
+           f'GROUP BY neighbour.similar_id ORDER BY score DESC, neighbour.similar_id LIMIT %s')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*params, user.pk, limit])
+        return [book_id for book_id, _ in cursor.fetchall()]
@@ -0,0 +1,95 @@
+import csv
+import io
+import itertools
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError: # необязательная зависимость, без нее рендерим стандартным json
+    orjson = None
+
+
+def chunked(rows, size):
+    # отдаем клиенту пачками, а не по строке: меньше мелких записей в сокет
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes compact responses with orjson when it is
+    installed. The bytes are the same as JSONRenderer's for everything the
+    store API returns: values orjson does not know (Decimal, dates, lazy
+    strings) go through DRF's JSONEncoder, and anything orjson rejects falls
+    back to JSONRenderer. Floats may be formatted differently (1e16 vs 1e+16),
+    so the renderer is used only where responses have no floats.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except (orjson.JSONEncodeError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+        # как и JSONRenderer, экранируем разделители строк, чтобы ответ оставался валидным javascript
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class NDJSONRenderer(FastJSONRenderer):
+    """
+    One JSON object per line. stream() writes the export endpoint rows chunk
+    by chunk, render() is left for ordinary responses such as errors.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(self.render_line(row) for row in rows)
+
+    def render_line(self, row):
+        return super().render(row) + b'\n'
+
+    def stream(self, rows, names, chunk_size):
+        for chunk in chunked(rows, chunk_size):
+            yield b''.join(self.render_line(row) for row in chunk)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    CSV with a header row taken from the keys of the first row. stream()
+    writes the export endpoint rows chunk by chunk.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        if not rows:
+            return b''
+        return (self.render_header(list(rows[0])) + self.render_rows(rows)).encode(self.charset)
+
+    def stream(self, rows, names, chunk_size):
+        yield self.render_header(names).encode(self.charset)
+        for chunk in chunked(rows, chunk_size):
+            yield self.render_rows(chunk).encode(self.charset)
+
+    def render_header(self, names):
+        return self.render_rows([dict(zip(names, names))])
+
+    def render_rows(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([['' if value is None else value for value in row.values()] for row in rows])
+        return buffer.getvalue()
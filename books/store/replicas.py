@@ -0,0 +1,27 @@
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS
+
+# реплика, с которой читает текущий запрос. Ставится на время безопасного запроса во views.ReplicaReadMixin,
+# одна на весь запрос, чтобы все его запросы видели одно и то же состояние базы
+replica_alias = ContextVar('store_replica_alias', default=None)
+
+
+class ReplicaRouter:
+    """
+    Routes reads to replica_alias while it is set, i.e. inside safe requests
+    of the views with ReplicaReadMixin. Everything else - writes, reads of
+    write requests (get_or_create_relation, upserts, set_rating), management
+    commands and the rating queue - goes to the primary (default).
+    Migrations are not restricted: real replicas get the schema through
+    replication, and the test replica database needs it.
+    """
+    def db_for_read(self, model, **hints):
+        return replica_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # все базы проекта - primary и его реплики, объект с реплики можно связать с объектом из primary
+        return True
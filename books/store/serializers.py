@@ -1,17 +1,49 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import models
 from rest_framework.serializers import ModelSerializer
 from rest_framework import serializers
 
+from store.logic import attach_my_relations, attach_reader_previews, my_relations, reader_previews
+from store.metrics import TimedSerializerMixin
 from store.models import Book, UserBookRelation
 
-class BookReaderSerializer(ModelSerializer):
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class BookReaderSerializer(TimedSerializerMixin, ModelSerializer):
     class Meta:
         model = User
         fields = ('first_name', 'last_name')
+        list_serializer_class = TimedListSerializer
+
+
+def request_user(context):
+    request = context.get('request')
+    return getattr(request, 'user', None)
+
+
+class BookListSerializer(TimedListSerializer):
+    def to_representation(self, data):
+        # превью читателей и связи текущего пользователя для всех книг страницы достаем одним запросом каждое
+        books = list(data.all() if isinstance(data, models.Manager) else data)
+        attach_reader_previews([book for book in books if not hasattr(book, 'reader_preview')])
+        attach_my_relations([book for book in books if not hasattr(book, 'my_relation')], request_user(self.context))
+        return super().to_representation(books)
+
+
+class MyRelationSerializer(ModelSerializer):
+    # связь текущего пользователя с книгой, без book: она и так внутри книги
+    class Meta:
+        model = UserBookRelation
+        fields = ['like', 'in_bookmarks', 'rate', 'bought']
 
-class BooksSerializer(ModelSerializer):
+
+class BooksSerializer(TimedSerializerMixin, ModelSerializer):
     # likes_count = serializers.SerializerMethodField()  # первый способ вытащить лайки (метод SerializerMethodField ищет функцию get_<название этого поля>)
-    annotated_likes = serializers.IntegerField(read_only=True)  # второй способ вытащить лайки, при этом надо изменить queryset в views.py. read_only=True - нужен чтобы при создании книги это поле не требовалось
+    # annotated_likes = serializers.IntegerField(read_only=True)  # второй способ вытащить лайки, при этом надо изменить queryset в views.py. read_only=True - нужен чтобы при создании книги это поле не требовалось
+    annotated_likes = serializers.IntegerField(source='likes_count', read_only=True)  # третий способ: счетчик хранится в самой книге и обновляется при изменении UserBookRelation, так что в queryset ничего считать не надо. Название поля в ответе оставили прежним
     rating = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
     price_with_discount = serializers.IntegerField(read_only=True)
 
@@ -19,9 +51,11 @@ class BooksSerializer(ModelSerializer):
 
     owner_name = serializers.CharField(read_only=True) # в случае если вытаскиваем поле owner_name через annotate
 
-    readers = BookReaderSerializer(many=True, read_only=True) # название должно соответствовать названию поля в Book, а если хотим поменять, то можно сделать так:
+    # readers = BookReaderSerializer(many=True, read_only=True) # название должно соответствовать названию поля в Book, а если хотим поменять, то можно сделать так:
     # readers_asd = BookReaderSerializer(many=True, source='readers')
-
+    readers = BookReaderSerializer(many=True, read_only=True, source='reader_preview') # не все читатели, а только первые STORE_READERS_PREVIEW_SIZE, их подкладывает attach_reader_previews
+    readers_count = serializers.IntegerField(read_only=True)
+    my_relation = MyRelationSerializer(read_only=True, allow_null=True) # null для анонимного пользователя, подкладывает attach_my_relations
 
     class Meta:
         model = Book
@@ -31,15 +65,120 @@ class BooksSerializer(ModelSerializer):
                   'annotated_likes',
                   'rating',
                   'owner_name',
-                  'readers'
+                  'readers',
+                  'readers_count',
+                  'my_relation',
                   ]
+        list_serializer_class = BookListSerializer
+
+    def to_representation(self, instance):
+        if not hasattr(instance, 'reader_preview'): # одиночная книга, например в retrieve
+            attach_reader_previews([instance])
+        if not hasattr(instance, 'my_relation'):
+            attach_my_relations([instance], request_user(self.context))
+        return super().to_representation(instance)
 
     # def get_likes_count(self, instance):  # instance - возьмет текущую книгу (объект, который сериализуется)
     #     return UserBookRelation.objects.filter(book=instance,
     #                                            like=True).count()  # эта функция для первого способа вытаскивания лайков. НО она создает отдельный запрос в базу для каждой книги, это видно в django debug tools. Поэтому проще через annotation в этом случае
 
 
-class UserBookRelationSerializer(ModelSerializer):
+def book_fields():
+    # (имя в ответе, источник, to_representation) для каждого поля BooksSerializer
+    return [(name, field.source, field.to_representation) for name, field in BooksSerializer().fields.items()]
+
+
+COMPUTED_BOOK_FIELDS = ('readers', 'my_relation') # поля BooksSerializer, которых нет среди колонок книги
+
+
+def book_list_values():
+    # колонки для books_list_data: источники всех полей BooksSerializer, кроме превью читателей и связи пользователя
+    return [source for name, source, _ in book_fields() if name not in COMPUTED_BOOK_FIELDS]
+
+
+def book_row_data(row, fields):
+    book = {}
+    for name, source, to_representation in fields:
+        value = row[source]
+        book[name] = None if value is None else to_representation(value)
+    return book
+
+
+def books_list_data(rows, user=None, relations=None):
+    """
+    The same data as BooksSerializer(rows, many=True).data for the given
+    user, built from .values(*book_list_values()) rows: no model instances
+    and no nested BookReaderSerializer per book. Every value still goes through its
+    BooksSerializer field, so Decimal formatting and the like stay exactly
+    as in the serializer. relations, if given, are the user's relations by
+    book id, already read by the caller.
+    """
+    # превью читателей - уже готовые словари first_name/last_name, их отдаем как есть
+    fields = [(name, source, (lambda value: value) if name == 'readers' else to_representation)
+              for name, source, to_representation in book_fields()]
+    book_ids = [row['id'] for row in rows]
+    previews = reader_previews(book_ids)
+    if relations is None:
+        relations = my_relations(user, book_ids)
+    return [book_row_data(dict(row, reader_preview=previews[row['id']], my_relation=relations[row['id']]), fields)
+            for row in rows]
+
+
+class UserBookRelationSerializer(TimedSerializerMixin, ModelSerializer):
     class Meta:
         model = UserBookRelation
         fields = ['book', 'like', 'in_bookmarks', 'rate', 'bought']
+
+    def update(self, instance, validated_data):
+        # сохраняем только изменившиеся поля, а если не поменялось ничего - в базу не ходим совсем
+        changed = []
+        for field_name, value in validated_data.items():
+            field = instance._meta.get_field(field_name)
+            if getattr(instance, field.attname) != (value.pk if field.is_relation else value): # book_id, без загрузки книги
+                setattr(instance, field_name, value)
+                changed.append(field_name)
+        if changed:
+            instance.save(update_fields=changed)
+        return instance
+
+
+class UserBookRelationBulkListSerializer(TimedListSerializer):
+    def validate(self, attrs):
+        if len(attrs) > settings.STORE_RELATIONS_BULK_LIMIT:
+            raise serializers.ValidationError(f'No more than {settings.STORE_RELATIONS_BULK_LIMIT} items per request.')
+        book_ids = [item['book_id'] for item in attrs]
+        if len(set(book_ids)) != len(book_ids):
+            raise serializers.ValidationError('Each book can appear only once.')
+        # одна проверка существования на всю пачку, а не PrimaryKeyRelatedField с запросом на каждый элемент
+        missing = set(book_ids) - set(Book.objects.filter(pk__in=book_ids).values_list('pk', flat=True))
+        if missing:
+            raise serializers.ValidationError(f'Unknown books: {sorted(missing)}.')
+        return attrs
+
+
+class UserBookRelationBulkSerializer(TimedSerializerMixin, ModelSerializer):
+    book = serializers.IntegerField(source='book_id', min_value=1)
+
+    class Meta:
+        model = UserBookRelation
+        fields = ['book', 'like', 'in_bookmarks', 'rate', 'bought']
+        list_serializer_class = UserBookRelationBulkListSerializer
+
+
+class BookBulkSerializer(ModelSerializer):
+    # PATCH и DELETE /book/bulk/: id книг и, для PATCH, новые значения полей
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    class Meta:
+        model = Book
+        fields = ['ids', 'name', 'price', 'author_name', 'discount']
+
+    def validate_ids(self, ids):
+        if len(ids) > settings.STORE_BOOKS_BULK_LIMIT:
+            raise serializers.ValidationError(f'No more than {settings.STORE_BOOKS_BULK_LIMIT} books per request.')
+        return sorted(set(ids))
+
+    def validate(self, attrs):
+        if 'ids' not in attrs: # при partial=True обязательность полей не проверяется
+            raise serializers.ValidationError({'ids': [self.fields['ids'].error_messages['required']]})
+        return attrs
@@ -0,0 +1,44 @@
+from django.contrib.auth.models import User
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from store.models import Book, UserBookRelation
+
+USER_NAME_FIELDS = ('username', 'first_name', 'last_name') # попадают в ответы книг: owner_name и readers
+
+
+@receiver(post_delete, sender=UserBookRelation)
+def relation_deleted(sender, instance, **kwargs):
+    # Collector шлет post_delete на каждую связь: и при relation.delete(), и при queryset.delete(), readers.remove()
+    # и каскадном удалении пользователя или книги, так что счетчики и рейтинг книги не расходятся со связями
+    from store.logic import apply_relation_change # store.logic сам импортирует этот модуль
+
+    apply_relation_change(instance.old_values['book_id'], instance.old_values, None)
+
+
+def user_names(user):
+    # только загруженные поля: обращение к отложенному полю - лишний запрос
+    return {field: user.__dict__[field] for field in USER_NAME_FIELDS if field in user.__dict__}
+
+
+@receiver(post_init, sender=User)
+def user_initialized(sender, instance, **kwargs):
+    instance.old_names = user_names(instance)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, **kwargs):
+    # переименование меняет owner_name книг пользователя и readers книг, которые он читает
+    names = user_names(instance)
+    if not created and names != instance.old_names:
+        read = UserBookRelation.objects.filter(user=instance).values('book_id')
+        Book.objects.filter(Q(owner=instance) | Q(pk__in=read)).update(version=F('version') + 1)
+    instance.old_names = names
+
+
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # у книг пользователя owner станет NULL через UPDATE, без Book.save. Связи удаляются по одной,
+    # их книги пересчитывает relation_deleted
+    Book.objects.filter(owner=instance).update(version=F('version') + 1)
@@ -1,15 +1,29 @@
+import csv
 import json
+from urllib.parse import urlencode
+from datetime import datetime
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-from django.db import connection
+from django.conf import settings
+from django.db import connection, models, router
 from django.db.models import Count, Case, When, Avg, F
 from django.urls import reverse
+from django.test import AsyncClient, TransactionTestCase, override_settings
 from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APITestCase
 import rest_framework.status as status
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from rest_framework.exceptions import ErrorDetail
+from rest_framework.renderers import JSONRenderer
 
-from store.models import Book, UserBookRelation
+from store.cache import get_cache, replica_pin_key
+from store.logic import delete_books, set_rating
+from store.models import Book, BookStats, RatingRecalcJob, UserBookRelation
+from store.recommendations import build_similar_books
+from store.renderers import FastJSONRenderer
 from store.serializers import BooksSerializer
 
 
@@ -30,7 +44,7 @@ class BooksApiTestCase(APITestCase):
         # response = self.client.get(url) # стандартный вариант запроса, но можно обернуть его в CaptureQueriesContext, чтобы посчитать количество запросов в базу.
         with CaptureQueriesContext(connection) as queries:
             response = self.client.get(url)
-            self.assertEqual(2, len(queries))
+            self.assertEqual(3, len(queries)) # с версией каталога для ETag и кеша
             # print('queries', len(queries))
 
         books = Book.objects.all().annotate(
@@ -47,7 +61,7 @@ class BooksApiTestCase(APITestCase):
         # serializer_data = BooksSerializer([self.book1, self.book2, self.book3], many=True).data
         # если один объект, тогда можно указать без many и не списком
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results']) # список книг теперь отдается постранично, сами книги лежат в results
         # self.assertEqual(serializer_data[0]['likes_count'], 1)
         self.assertEqual(serializer_data[0]['annotated_likes'], 1)
         self.assertEqual(serializer_data[0]['rating'], '3.00')
@@ -74,7 +88,7 @@ class BooksApiTestCase(APITestCase):
         # print('serializer_data+++++++', serializer_data)
         # print('response.data++++++++', response.data)
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
 
     def test_get_search(self):
         url = reverse('book-list')
@@ -95,7 +109,7 @@ class BooksApiTestCase(APITestCase):
 
         # serializer_data = BooksSerializer([self.book1, self.book2], many=True).data # без annotate
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
 
     def test_get_ordering(self):
         url = reverse('book-list')
@@ -114,7 +128,46 @@ class BooksApiTestCase(APITestCase):
 
         # serializer_data = BooksSerializer([self.book3, self.book2, self.book1], many=True).data # без annotate
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_derived_fields(self):
+        # сортировка и диапазоны по полям, которые раньше считались в annotate
+        url = reverse('book-list')
+        for params, expected in [
+            ({'ordering': 'price_with_discount'}, [self.book1, self.book3, self.book2]),
+            ({'ordering': '-price_with_discount'}, [self.book2, self.book3, self.book1]),
+            ({'ordering': '-annotated_likes'}, [self.book1, self.book3, self.book2]),
+            ({'ordering': 'rating'}, [self.book1, self.book2, self.book3]),
+            ({'price_with_discount__lte': '40'}, [self.book1, self.book3]),
+            ({'price_with_discount__gte': '38.5', 'ordering': '-price_with_discount'}, [self.book2, self.book3]),
+            ({'rating__gte': '3'}, [self.book1]),
+            ({'annotated_likes__gte': '1'}, [self.book1]),
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(url, data=params)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertEqual([book.id for book in expected], [book['id'] for book in response.data['results']])
+
+        response = self.client.get(url, data={'price_with_discount__lte': 'abc'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_book_without_stats(self):
+        # строка BookStats потерялась (правка в обход триггеров) - книга все равно видна и редактируется
+        BookStats.objects.filter(book=self.book1).delete()
+        response = self.client.get(reverse('book-list'))
+        self.assertEqual([self.book1.id, self.book2.id, self.book3.id], [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['results'][0]['price_with_discount'])
+        url = reverse('book-detail', args=(self.book1.id,))
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url).status_code)
+
+        # сортировка по цене со скидкой идет по индексу BookStats, книги без строки в нее не попадают
+        response = self.client.get(reverse('book-list'), data={'ordering': 'price_with_discount'})
+        self.assertEqual([self.book3.id, self.book2.id], [book['id'] for book in response.data['results']])
+
+        self.client.force_login(self.user)
+        response = self.client.patch(url, data={'name': 'Renamed'}, format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('Renamed', Book.objects.get(pk=self.book1.pk).name)
 
     def test_create(self):
         self.assertEqual(3,
@@ -209,7 +262,8 @@ class BooksApiTestCase(APITestCase):
         self.assertEqual(3, Book.objects.all().count())
         # print('[self.book1, self.book2, self.book3]======', (self.book1, self.book2, self.book3))
         # print('[i for i in Book.objects.all()]===========', Book.objects.all())
-        self.assertEqual([self.book2, self.book3, self.book1], [i for i in Book.objects.all()])
+        # self.assertEqual([self.book2, self.book3, self.book1], [i for i in Book.objects.all()]) # без order_by порядок зависит от того, куда на странице легла обновленная строка book1
+        self.assertEqual([self.book1, self.book2, self.book3], [i for i in Book.objects.order_by('id')])
 
         self.assertEqual({'detail': ErrorDetail(string='You do not have permission to perform this action.',
                                                 code='permission_denied')}, response.data)
@@ -239,7 +293,7 @@ class BooksApiTestCase(APITestCase):
             ).order_by('id')
 
         Book.refresh_from_db(self.book2)
-        serializer_data = BooksSerializer(book, many=True).data
+        serializer_data = BooksSerializer(book, many=True, context={'request': response.wsgi_request}).data # с request - чтобы посчитался my_relation пользователя
         # serializer_data_dict = dict(*serializer_data) # так как url при book-detail возвращает простой словарь, а сериалайзер возвращает список OrderedDict, получается нужно его преобразовать тже в обычный словарь: сначала раскрыть этот список, а затем преобразовать этот OrderedDict в обычный словарь.
 
         # print('======serializer_data', dict(*serializer_data))
@@ -339,3 +393,801 @@ class BooksRelationTestCase(APITestCase):
         self.book1.refresh_from_db()  # а можно так
         relation = UserBookRelation.objects.get(user=self.user1, book=self.book1)
         self.assertTrue(relation.bought)
+
+
+class BooksRelationQueriesTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username1')
+        self.book1 = Book.objects.create(name='Test book 1', price=25, author_name='author 1')
+        self.url = reverse('userbookrelation-detail', args=(self.book1.id,))
+        self.client.force_authenticate(user=self.user) # без запросов к сессии
+
+    def patch(self, data, queries, url=None):
+        with self.assertNumQueries(queries):
+            response = self.client.patch(url or self.url, data=json.dumps(data), content_type='application/json')
+        return response
+
+    def test_budget(self):
+        # upsert связи (вместе с readers_count новой связи), UPDATE связи, UPDATE агрегатов книги
+        response = self.patch({'like': True, 'rate': 4}, 3)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'book': self.book1.id, 'like': True, 'in_bookmarks': False, 'rate': 4, 'bought': False},
+                         response.data)
+        response = self.patch({'rate': 2}, 3)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.patch({'rate': 2, 'like': True}, 1) # ничего не поменялось - только upsert
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        self.book1.refresh_from_db()
+        self.assertEqual(('2.00', 1, 1), (str(self.book1.rating), self.book1.likes_count, self.book1.readers_count))
+
+    def test_new_relation_without_changes(self):
+        response = self.patch({'like': False}, 1)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.book1.refresh_from_db()
+        self.assertEqual((1, 0), (self.book1.readers_count, self.book1.likes_count))
+
+    def test_invalid_data_does_not_create_relation(self):
+        response = self.patch({'rate': 6}, 0)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertFalse(UserBookRelation.objects.exists())
+
+    def test_unknown_book(self):
+        response = self.patch({'like': True}, 1, url=reverse('userbookrelation-detail', args=(100500,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        response = self.patch({'like': True}, 0, url=reverse('userbookrelation-detail', args=('abc',)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class BooksRelationBulkTestCase(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='test_username1')
+        self.user2 = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=25, author_name='author') for i in range(5)]
+        UserBookRelation.objects.create(user=self.user1, book=self.books[0], like=True, rate=2)
+        UserBookRelation.objects.create(user=self.user2, book=self.books[0], rate=4)
+        self.url = reverse('userbookrelation-bulk')
+
+    def test_upsert(self):
+        self.client.force_login(user=self.user1)
+        data = [
+            {'book': self.books[0].id, 'rate': 5}, # like остается прежним
+            {'book': self.books[1].id, 'like': True, 'in_bookmarks': True},
+            {'book': self.books[2].id, 'rate': 3, 'bought': True},
+        ]
+        response = self.client.post(self.url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+        self.assertEqual([
+            {'book': self.books[0].id, 'like': True, 'in_bookmarks': False, 'rate': 5, 'bought': False},
+            {'book': self.books[1].id, 'like': True, 'in_bookmarks': True, 'rate': None, 'bought': False},
+            {'book': self.books[2].id, 'like': False, 'in_bookmarks': False, 'rate': 3, 'bought': True},
+        ], response.data)
+
+        relation = UserBookRelation.objects.get(user=self.user1, book=self.books[0])
+        self.assertEqual((True, 5), (relation.like, relation.rate))
+        book0, book1, book2 = Book.objects.filter(pk__in=[book.id for book in self.books[:3]]).order_by('id')
+        self.assertEqual(('4.50', 2, 1), (str(book0.rating), book0.readers_count, book0.likes_count))
+        self.assertEqual((None, 1, 1, 1), (book1.rating, book1.readers_count, book1.likes_count, book1.bookmarks_count))
+        self.assertEqual(('3.00', 1, 1), (str(book2.rating), book2.readers_count, book2.buyers_count))
+
+    def test_bigint_book_id(self):
+        book = Book.objects.create(id=2 ** 31 + 1, name='Big id book', price=25, author_name='author')
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(self.url, data=json.dumps([{'book': book.id, 'like': True}]),
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+        self.assertTrue(UserBookRelation.objects.filter(user=self.user1, book=book, like=True).exists())
+
+    def test_queries_do_not_grow_with_items(self):
+        self.client.force_authenticate(user=self.user1)
+        for books in (self.books[1:2], self.books):
+            data = [{'book': book.id, 'like': True, 'rate': 4} for book in books]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.url, data=json.dumps(data), content_type='application/json')
+            self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+            self.assertEqual(6, len(queries)) # savepoint, проверка книг, select for update, upsert, пересчет, release
+        self.assertEqual(5, UserBookRelation.objects.filter(user=self.user1, like=True, rate=4).count())
+
+    def test_wrong(self):
+        self.client.force_login(user=self.user1)
+        for data in ([{'book': self.books[1].id}, {'book': self.books[1].id, 'like': True}],
+                     [{'book': 100500, 'like': True}],
+                     [{'book': self.books[1].id, 'rate': 6}]):
+            with self.subTest(data=data):
+                response = self.client.post(self.url, data=json.dumps(data), content_type='application/json')
+                self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code, response.data)
+        self.assertFalse(UserBookRelation.objects.filter(user=self.user1, book=self.books[1]).exists())
+
+        self.client.logout()
+        response = self.client.post(self.url, data=json.dumps([]), content_type='application/json')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
+class BooksBulkTestCase(APITestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.other = User.objects.create(username='other')
+        self.own = [Book.objects.create(name=f'Own book {i}', price=10, author_name='author', owner=self.owner)
+                    for i in range(3)]
+        self.foreign = Book.objects.create(name='Foreign book', price=10, author_name='author', owner=self.other)
+        UserBookRelation.objects.create(user=self.other, book=self.own[0], like=True, rate=5)
+        RatingRecalcJob.objects.create(book=self.own[0])
+        self.url = reverse('book-bulk')
+        self.ids = [book.id for book in self.own] + [self.foreign.id]
+
+    def test_update_only_own(self):
+        self.client.force_authenticate(self.owner)
+        versions = dict(Book.objects.values_list('id', 'version'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url, data={'ids': self.ids, 'discount': 50, 'name': 'Renamed'},
+                                         format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+        self.assertEqual({'updated': 3}, response.data)
+        self.assertEqual(1, len(queries)) # один UPDATE, без загрузки книг и владельцев
+
+        for book in Book.objects.filter(pk__in=self.ids):
+            own = book.owner_id == self.owner.id
+            self.assertEqual((50 if own else None, versions[book.id] + own), (book.discount, book.version))
+        self.assertEqual('5.0000', str(BookStats.objects.get(book=self.own[1]).price_with_discount)) # триггер BookStats
+        response = self.client.get(reverse('book-list'), data={'search': 'renamed'})
+        self.assertEqual(sorted(book.id for book in self.own), sorted(book['id'] for book in response.data['results']))
+
+    def test_delete_only_own(self):
+        self.client.force_authenticate(self.owner)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+        self.assertEqual({'deleted': 3}, response.data)
+        self.assertEqual(7, len(queries)) # книги и по одному DELETE на каждую ссылающуюся на них таблицу
+        self.assertEqual([self.foreign], list(Book.objects.all()))
+        self.assertFalse(UserBookRelation.objects.exists())
+        self.assertFalse(RatingRecalcJob.objects.exists())
+        self.assertEqual([self.foreign.id], list(BookStats.objects.values_list('book_id', flat=True)))
+
+    def on_delete(self, on_delete):
+        # другое on_delete у ссылки RatingRecalcJob.book на время теста
+        return mock.patch.object(RatingRecalcJob._meta.get_field('book').remote_field, 'on_delete', on_delete)
+
+    def test_delete_protected(self):
+        self.client.force_authenticate(self.owner)
+        with self.on_delete(models.PROTECT):
+            response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code, response.data)
+            self.assertIn('RatingRecalcJob.book', response.data['non_field_errors'][0])
+            self.assertEqual(4, Book.objects.count())
+
+            response = self.client.delete(self.url, data={'ids': [book.id for book in self.own[1:]]}, format='json')
+        self.assertEqual({'deleted': 2}, response.data)
+
+    def test_delete_set_null(self):
+        with connection.cursor() as cursor: # откатится вместе с транзакцией теста
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE') # ALTER TABLE не идет при отложенных проверках внешних ключей
+            cursor.execute('ALTER TABLE store_ratingrecalcjob ALTER COLUMN book_id DROP NOT NULL')
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+        self.client.force_authenticate(self.owner)
+        with self.on_delete(models.SET_NULL):
+            response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+        self.assertEqual({'deleted': 3}, response.data)
+        self.assertEqual([None], list(RatingRecalcJob.objects.values_list('book_id', flat=True)))
+        self.assertFalse(UserBookRelation.objects.exists())
+
+    def test_delete_falls_back_to_collector(self):
+        self.client.force_authenticate(self.owner)
+        with self.on_delete(models.RESTRICT), CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(self.url, data={'ids': [book.id for book in self.own[1:]]}, format='json')
+        self.assertEqual({'deleted': 2}, response.data)
+        self.assertIn('SELECT "store_book"."id"', ''.join(query['sql'] for query in queries)) # Collector загружает книги
+        self.assertEqual({self.own[0], self.foreign}, set(Book.objects.all()))
+        with self.on_delete(models.RESTRICT), self.assertRaises(models.RestrictedError):
+            delete_books(Book.objects.filter(pk=self.own[0].pk))
+        self.assertTrue(Book.objects.filter(pk=self.own[0].pk).exists())
+
+    def test_staff(self):
+        self.client.force_authenticate(User.objects.create(username='staff', is_staff=True))
+        response = self.client.patch(self.url, data={'ids': self.ids, 'price': '12.00'}, format='json')
+        self.assertEqual({'updated': 4}, response.data)
+        response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+        self.assertEqual({'deleted': 4}, response.data)
+
+    def test_wrong(self):
+        self.client.force_authenticate(self.owner)
+        for data in ({'ids': self.ids}, {'discount': 5}, {'ids': [], 'discount': 5}, {'ids': [self.own[0].id], 'price': 'abc'}):
+            with self.subTest(data=data):
+                response = self.client.patch(self.url, data=data, format='json')
+                self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code, response.data)
+        with override_settings(STORE_BOOKS_BULK_LIMIT=2):
+            response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(4, Book.objects.count())
+
+        self.client.force_authenticate(None)
+        response = self.client.delete(self.url, data={'ids': self.ids}, format='json')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+        self.assertEqual(4, Book.objects.count())
+
+
+class BooksRecommendationsTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.user2 = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=10, author_name='author') for i in range(4)]
+        b1, b2, b3, b4 = self.books
+        for user, book in [(self.user, b1), (self.user, b2), (self.user2, b1), (self.user2, b2), (self.user2, b3)]:
+            UserBookRelation.objects.create(user=user, book=book, like=True)
+        build_similar_books(full=True, engine='python')
+
+    def test_similar(self):
+        b1, b2, b3, b4 = self.books
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-similar', args=(b1.id,)))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([b2.id, b3.id], [book['id'] for book in response.data])
+        self.assertEqual(3, len(queries)) # книга, похожие книги, превью читателей
+        self.assertEqual(BooksSerializer(Book.objects.get(pk=b2.id)).data['name'], response.data[0]['name'])
+
+        self.assertEqual([], self.client.get(reverse('book-similar', args=(b4.id,))).data)
+        response = self.client.get(reverse('book-similar', args=(100500,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_recommended(self):
+        url = reverse('book-recommended')
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.books[2].id], [book['id'] for book in response.data]) # свои книги не предлагаются
+
+        self.client.force_authenticate(self.user2)
+        self.assertEqual([], self.client.get(url).data)
+
+        self.client.force_authenticate(None)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get(url).status_code)
+
+
+class BooksMyRelationTestCase(APITestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='test_username')
+        self.user2 = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=10, author_name='author') for i in range(3)]
+        UserBookRelation.objects.create(user=self.user, book=self.books[0], like=True, rate=4)
+        UserBookRelation.objects.create(user=self.user2, book=self.books[1], in_bookmarks=True)
+
+    def test_list(self):
+        url = reverse('book-list')
+        default = {'like': False, 'in_bookmarks': False, 'rate': None, 'bought': False}
+        for fast in (True, False):
+            with self.subTest(fast=fast), override_settings(STORE_FAST_LIST=fast):
+                get_cache().clear()
+                self.client.force_authenticate(None)
+                with CaptureQueriesContext(connection) as anonymous:
+                    response = self.client.get(url)
+                self.assertEqual([None] * 3, [book['my_relation'] for book in response.data['results']])
+
+                self.client.force_authenticate(self.user)
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(len(anonymous) + 1, len(queries)) # один запрос на всю страницу
+                self.assertEqual([dict(default, like=True, rate=4), default, default],
+                                 [book['my_relation'] for book in response.data['results']])
+
+                self.client.force_authenticate(self.user2) # у другого пользователя свой кеш
+                response = self.client.get(url)
+                self.assertEqual([default, dict(default, in_bookmarks=True), default],
+                                 [book['my_relation'] for book in response.data['results']])
+
+    def test_detail_etag_follows_relation(self):
+        url = reverse('book-detail', args=(self.books[0].id,))
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url)
+        self.assertEqual(False, response.data['my_relation']['in_bookmarks'])
+        etag = response['ETag']
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        version = Book.objects.get(pk=self.books[0].id).version
+        relation = UserBookRelation.objects.get(user=self.user, book=self.books[0])
+        relation.in_bookmarks = True
+        relation.save()
+        self.assertEqual(version + 1, Book.objects.get(pk=self.books[0].id).version)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(True, response.data['my_relation']['in_bookmarks'])
+
+        self.client.force_authenticate(None)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertIsNone(response.data['my_relation'])
+        self.assertEqual(3, len(queries)) # версия, книга, превью читателей - без связей пользователя
+        self.assertNotEqual(etag, response['ETag'])
+
+
+class BooksShelvesTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.user2 = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=10 + i, author_name='author') for i in range(4)]
+        UserBookRelation.objects.create(user=self.user, book=self.books[2], like=True, rate=5)
+        UserBookRelation.objects.create(user=self.user, book=self.books[0], like=True, in_bookmarks=True)
+        UserBookRelation.objects.create(user=self.user, book=self.books[3], bought=True, rate=2)
+        UserBookRelation.objects.create(user=self.user2, book=self.books[1], like=True, bought=True)
+        self.client.force_authenticate(self.user)
+
+    def shelf(self, shelf, **params):
+        response = self.client.get(reverse('my-books-list'), data={'shelf': shelf, **params})
+        self.assertEqual(status.HTTP_200_OK, response.status_code, response.data)
+        return response.data
+
+    def test_shelves(self):
+        expected = {'liked': [0, 2], 'bookmarked': [0], 'bought': [3], 'rated': [3, 2]} # новые связи первыми
+        for shelf, indexes in expected.items():
+            with self.subTest(shelf=shelf):
+                self.assertEqual([self.books[i].id for i in indexes],
+                                 [book['id'] for book in self.shelf(shelf)['results']])
+
+        # та же форма, что у /book/, вместе со связью пользователя
+        book = self.shelf('liked')['results'][0]
+        self.assertEqual(self.client.get(reverse('book-detail', args=(self.books[0].id,))).data, book)
+        self.assertEqual({'like': True, 'in_bookmarks': True, 'rate': None, 'bought': False}, book['my_relation'])
+
+        self.client.force_authenticate(self.user2)
+        self.assertEqual([self.books[1].id], [book['id'] for book in self.shelf('bought')['results']])
+        self.assertEqual([], self.shelf('rated')['results'])
+
+    def test_pages(self):
+        for book in self.books:
+            UserBookRelation.objects.update_or_create(user=self.user, book=book, defaults={'in_bookmarks': True})
+        url, ids = reverse('my-books-list'), []
+        data = {'shelf': 'bookmarked', 'page_size': 3}
+        while url:
+            response = self.client.get(url, data=data)
+            ids += [book['id'] for book in response.data['results']]
+            url, data = response.data['next'], None
+        self.assertEqual([self.books[i].id for i in (1, 3, 0, 2)], ids)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.shelf('bookmarked')
+        self.assertEqual(3, len(queries)) # связи страницы, книги, превью читателей
+
+    def test_wrong(self):
+        response = self.client.get(reverse('my-books-list'), data={'shelf': 'read'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, self.client.get(reverse('my-books-list')).status_code)
+        self.client.force_authenticate(None)
+        response = self.client.get(reverse('my-books-list'), data={'shelf': 'liked'})
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get(reverse('my-books-counts')).status_code)
+
+    def test_counts(self):
+        url = reverse('my-books-counts')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(1, len(queries)) # одна строка UserShelfStats, без COUNT(*)
+        self.assertEqual({'liked': 2, 'bookmarked': 1, 'bought': 1, 'rated': 2}, response.data)
+
+        self.client.patch(reverse('userbookrelation-detail', args=(self.books[1].id,)), data={'in_bookmarks': True},
+                          format='json')
+        self.client.post(reverse('userbookrelation-bulk'), data=[{'book': self.books[2].id, 'like': False}],
+                         format='json')
+        self.assertEqual({'liked': 1, 'bookmarked': 2, 'bought': 1, 'rated': 2}, self.client.get(url).data)
+
+        # удаление книг сносит связи одним DELETE в обход моделей, счетчики все равно сходятся
+        Book.objects.filter(pk=self.books[3].pk).update(owner=self.user2)
+        self.client.force_authenticate(self.user2)
+        self.client.delete(reverse('book-bulk'), data={'ids': [self.books[3].id]}, format='json')
+        self.assertEqual({'liked': 1, 'bookmarked': 0, 'bought': 1, 'rated': 0}, self.client.get(url).data)
+        self.client.force_authenticate(self.user)
+        self.assertEqual({'liked': 1, 'bookmarked': 2, 'bought': 0, 'rated': 1}, self.client.get(url).data)
+
+        self.client.force_authenticate(User.objects.create(username='test_username3'))
+        self.assertEqual({'liked': 0, 'bookmarked': 0, 'bought': 0, 'rated': 0}, self.client.get(url).data)
+
+
+REPLICA_CONFIGURED = 'replica' in settings.DATABASES # тестовая реплика есть в books.settings_test
+
+
+@skipUnless(REPLICA_CONFIGURED, 'needs the replica database of books.settings_test')
+@override_settings(STORE_DB_REPLICAS=['replica'])
+class BooksReplicaTestCase(APITestCase):
+    # 'replica' - отдельная тестовая база со своими данными, как реплика, еще не получившая записи с primary.
+    # Раннер создает базы всех тестов, даже пропущенных, поэтому без реплики в настройках ее здесь нет
+    databases = {'default', 'replica'} if REPLICA_CONFIGURED else {'default'}
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create(username='test_username')
+        self.user2 = User.objects.create(username='test_username2')
+        self.book = Book.objects.create(name='Primary book', price=10, author_name='author')
+        Book.objects.using('replica').create(pk=self.book.pk, name='Replica book', price=10, author_name='author')
+
+    def names(self):
+        detail = self.client.get(reverse('book-detail', args=(self.book.id,))).data['name']
+        return detail, [book['name'] for book in self.client.get(reverse('book-list')).data['results']]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(('Replica book', ['Replica book']), self.names())
+        self.client.force_authenticate(self.user)
+        self.assertEqual(('Replica book', ['Replica book']), self.names())
+        self.assertEqual('default', router.db_for_read(Book)) # вне запроса к BookViewSet - primary
+
+    def test_read_your_writes(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.patch(reverse('userbookrelation-detail', args=(self.book.id,)), data={'like': True},
+                                     format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(UserBookRelation.objects.filter(user=self.user, book=self.book, like=True).exists())
+        self.assertFalse(UserBookRelation.objects.using('replica').exists())
+
+        # автор записи читает с primary и видит свой лайк, остальные - с реплики
+        response = self.client.get(reverse('book-detail', args=(self.book.id,)))
+        self.assertEqual(('Primary book', 1, True),
+                         (response.data['name'], response.data['annotated_likes'], response.data['my_relation']['like']))
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(('Replica book', ['Replica book']), self.names())
+
+        get_cache().delete(replica_pin_key(self.user.id)) # окно STORE_REPLICA_LAG прошло
+        self.client.force_authenticate(self.user)
+        self.assertEqual(('Replica book', ['Replica book']), self.names()) # ответ с primary лежит в кеше под версией primary
+
+    def test_cached_under_replica_versions(self):
+        url = reverse('book-list')
+        response = self.client.get(url)
+        self.assertEqual('MISS', response['X-Cache'])
+        etag = response['ETag']
+        self.assertEqual('HIT', self.client.get(url)['X-Cache'])
+
+        # запись на primary, до реплики еще не дошла: ее версия и ответ прежние
+        self.client.force_authenticate(self.user)
+        self.client.patch(reverse('userbookrelation-detail', args=(self.book.id,)), data={'like': True}, format='json')
+        self.client.force_authenticate(None)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        Book.objects.using('replica').filter(pk=self.book.pk).update(name='Replicated book') # запись дошла до реплики
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((status.HTTP_200_OK, 'MISS'), (response.status_code, response['X-Cache']))
+        self.assertEqual(['Replicated book'], [book['name'] for book in response.data['results']])
+
+
+class BooksFastListTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username', first_name='Иван', last_name='"Петров"\u2028')
+        names = ['Test book 1', 'Война и мир', 'Quote " and \\ slash', 'Line\u2028separator\tand\x01control', 'Test book 5']
+        for i, name in enumerate(names):
+            book = Book.objects.create(name=name, price=Decimal('10.5') * (i + 1), author_name=f'author {i % 2}',
+                                       discount=[None, 0, 15][i % 3], owner=self.user if i % 2 else None)
+            if i < 3:
+                UserBookRelation.objects.create(user=self.user, book=book, like=True, rate=i + 3)
+
+    def get(self, params, fast):
+        get_cache().clear()
+        with override_settings(STORE_FAST_LIST=fast):
+            response = self.client.get(reverse('book-list'), data=params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return response
+
+    def test_same_bytes_as_serializer(self):
+        for params in [{}, {'ordering': '-price'}, {'ordering': 'discount', 'page_size': 2}, {'search': 'book'},
+                       {'price': '21.00'}]:
+            with self.subTest(params=params):
+                fast, slow = self.get(params, True), self.get(params, False)
+                self.assertEqual(slow.content, fast.content)
+                if slow.data['next']: # и следующая страница по курсору тоже
+                    self.assertEqual(self.client.get(slow.data['next']).content,
+                                     self.client.get(fast.data['next']).content)
+
+    def test_same_bytes_for_user(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.get({}, False).content, self.get({}, True).content)
+
+    def test_renderer_same_bytes_as_json_renderer(self):
+        data = {'price': Decimal('1.10'), 'date': datetime(2023, 5, 1, 12, 30, 15, 123456), 'name': 'Ж\u2029"\n',
+                'nested': [None, True, 1, {'ключ': 'значение'}], 1: 'int key'}
+        self.assertEqual(JSONRenderer().render(data), FastJSONRenderer().render(data))
+        self.assertEqual(JSONRenderer().render(data, 'application/json; indent=4'),
+                         FastJSONRenderer().render(data, 'application/json; indent=4'))
+
+
+@override_settings(STORE_EXPORT_CHUNK_SIZE=2)
+class BookExportTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        for i, name in enumerate(['Test book 1', 'Война и мир', 'Book, with "comma"', 'Test book 4', 'Test book 5']):
+            book = Book.objects.create(name=name, price=10 + i * 7, author_name=f'author {i % 2}',
+                                       discount=[None, 0, 15][i % 3], owner=self.user if i % 2 else None)
+            UserBookRelation.objects.create(user=self.user, book=book, like=bool(i % 2), rate=i % 5 + 1)
+        self.url = reverse('book-export')
+
+    def expected(self, params):
+        # то же, что отдает список, только без превью читателей, связи пользователя и пагинации
+        response = self.client.get(reverse('book-list'), data=dict(params, page_size=100))
+        return [{key: value for key, value in book.items() if key not in ('readers', 'my_relation')}
+                for book in response.data['results']]
+
+    def test_ndjson(self):
+        for params in [{}, {'ordering': '-price'}, {'search': 'book'}, {'price': '24.00'}]:
+            with self.subTest(params=params):
+                response = self.client.get(self.url, data=params)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertTrue(response.streaming)
+                self.assertEqual('application/x-ndjson', response['Content-Type'])
+                lines = b''.join(response.streaming_content).decode().splitlines()
+                self.assertEqual(self.expected(params), [json.loads(line) for line in lines])
+
+    def test_csv(self):
+        response = self.client.get(self.url, data={'format': 'csv', 'ordering': 'name'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('attachment; filename="books.csv"', response['Content-Disposition'])
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        expected = self.expected({'ordering': 'name'})
+        self.assertEqual(list(expected[0]), rows[0])
+        self.assertEqual([['' if value is None else str(value) for value in book.values()] for book in expected], rows[1:])
+
+    def test_unknown_format(self):
+        response = self.client.get(self.url, data={'format': 'xml'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class BooksAsyncTestCase(TransactionTestCase):
+    # TransactionTestCase: async view читает из потока пула своим соединением и видит только закоммиченные данные
+
+    def setUp(self):
+        user = User.objects.create(username='test_username', first_name='Ivan')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=10 + i, author_name=f'author {i}', owner=user)
+                      for i in range(3)]
+        UserBookRelation.objects.create(user=user, book=self.books[0], like=True, rate=5)
+
+    async def test_same_response_as_sync_view(self):
+        client = AsyncClient()
+        for sync_url, async_url, params in [
+            (reverse('book-list'), reverse('book-list-async'), {'ordering': '-price', 'search': 'book'}),
+            (reverse('book-detail', args=(self.books[0].id,)), reverse('book-detail-async', args=(self.books[0].id,)), {}),
+        ]:
+            expected = await sync_to_async(self.client.get)(sync_url, data=params)
+            response = await client.get(f'{async_url}?{urlencode(params)}') # AsyncClient в Django 3.2 теряет data у GET
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual(expected.content.replace(b'/book/', b'/async/book/'), response.content)
+            self.assertTrue(response['ETag'])
+
+        response = await client.get(reverse('book-detail-async', args=(100500,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        response = await client.post(reverse('book-list-async'))
+        self.assertEqual(status.HTTP_405_METHOD_NOT_ALLOWED, response.status_code)
+
+
+@override_settings(STORE_READERS_PREVIEW_SIZE=2)
+class BookReadersTestCase(APITestCase):
+
+    def setUp(self):
+        self.book1 = Book.objects.create(name='Test book 1', price=25, author_name='author 1')
+        self.book2 = Book.objects.create(name='Test book 2', price=55, author_name='author 2')
+        for i in range(5):
+            user = User.objects.create(username=f'reader{i}', first_name=f'First{i}', last_name=f'Last{i}')
+            UserBookRelation.objects.create(user=user, book=self.book1, like=i % 2 == 0)
+            if i < 1:
+                UserBookRelation.objects.create(user=user, book=self.book2)
+
+    def test_preview(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-list'))
+            self.assertEqual(3, len(queries)) # версия каталога, книги и превью читателей, независимо от количества читателей
+        book1, book2 = response.data['results']
+        self.assertEqual([{'first_name': 'First0', 'last_name': 'Last0'},
+                          {'first_name': 'First1', 'last_name': 'Last1'}], book1['readers'])
+        self.assertEqual(5, book1['readers_count'])
+        self.assertEqual([{'first_name': 'First0', 'last_name': 'Last0'}], book2['readers'])
+        self.assertEqual(1, book2['readers_count'])
+
+    def test_readers_endpoint(self):
+        url = reverse('book-readers', args=(self.book1.id,))
+        response = self.client.get(url, data={'page_size': 3})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        readers = response.data['results']
+        response = self.client.get(response.data['next'])
+        readers += response.data['results']
+        self.assertIsNone(response.data['next'])
+        self.assertEqual([f'First{i}' for i in range(5)], [reader['first_name'] for reader in readers])
+
+
+class BooksCacheTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book1 = Book.objects.create(name='Test book 1', price=25, author_name='author 1', owner=self.user)
+        self.book2 = Book.objects.create(name='Test book 2', price=55, author_name='author 2')
+
+    def test_list_cached_until_relation_changes(self):
+        url = reverse('book-list')
+        self.assertEqual('MISS', self.client.get(url, data={'ordering': 'price', 'search': 'book'})['X-Cache'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'search': 'book', 'ordering': 'price'}) # тот же запрос, параметры в другом порядке
+            self.assertEqual(1, len(queries)) # только версия каталога
+        self.assertEqual('HIT', response['X-Cache'])
+
+        relation = UserBookRelation.objects.create(user=self.user, book=self.book1, like=True)
+        response = self.client.get(url, data={'ordering': 'price', 'search': 'book'})
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual(1, response.data['results'][0]['annotated_likes'])
+
+        relation.delete()
+        response = self.client.get(url, data={'ordering': 'price', 'search': 'book'})
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual(0, response.data['results'][0]['annotated_likes'])
+
+    def test_write_under_other_worker(self):
+        # у каждого воркера свой LocMemCache: запись, обработанная другим воркером, в наш кеш не попадает
+        url = reverse('book-list')
+        detail_url = reverse('book-detail', args=(self.book1.id,))
+        self.client.get(url)
+        self.client.get(detail_url)
+
+        other_worker = dict(settings.CACHES, other_worker={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                           'LOCATION': 'other-worker'})
+        with override_settings(CACHES=other_worker, STORE_CACHE_ALIAS='other_worker'):
+            self.client.force_login(self.user)
+            data = {"name": 'New name', "price": '30.00', "author_name": 'author 1'}
+            self.client.put(detail_url, data=json.dumps(data), content_type='application/json')
+            self.client.logout()
+
+        response = self.client.get(url)
+        self.assertEqual(('MISS', 'New name'), (response['X-Cache'], response.data['results'][0]['name']))
+        response = self.client.get(detail_url)
+        self.assertEqual(('MISS', 'New name'), (response['X-Cache'], response.data['name']))
+
+    def test_detail_invalidated_per_book(self):
+        url1 = reverse('book-detail', args=(self.book1.id,))
+        url2 = reverse('book-detail', args=(self.book2.id,))
+        self.client.force_login(self.user) # кеш у каждого пользователя свой, поэтому логинимся до первых запросов
+        self.client.get(url1)
+        self.client.get(url2)
+
+        data = {"name": 'New name', "price": '30.00', "author_name": 'author 1'}
+        self.client.put(url1, data=json.dumps(data), content_type='application/json')
+        response = self.client.get(url1)
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual('New name', response.data['name'])
+        self.assertEqual('HIT', self.client.get(url2)['X-Cache'])
+
+        set_rating(self.book2)
+        self.assertEqual('MISS', self.client.get(url2)['X-Cache'])
+
+        self.client.delete(url1)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, self.client.get(url1).status_code)
+
+    def test_user_rename_invalidates_books(self):
+        reader = User.objects.create(username='reader', first_name='Old')
+        UserBookRelation.objects.create(user=reader, book=self.book2, like=True)
+        url1 = reverse('book-detail', args=(self.book1.id,))
+        url2 = reverse('book-detail', args=(self.book2.id,))
+        self.client.get(url1)
+        self.client.get(url2)
+
+        reader.last_login = timezone.now()
+        reader.save(update_fields=['last_login']) # имена не менялись
+        self.assertEqual('HIT', self.client.get(url2)['X-Cache'])
+
+        self.user.username = 'new_username' # владелец book1
+        self.user.save()
+        response = self.client.get(url1)
+        self.assertEqual(('MISS', 'new_username'), (response['X-Cache'], response.data['owner_name']))
+        self.assertEqual('HIT', self.client.get(url2)['X-Cache'])
+
+        reader = User.objects.get(pk=reader.pk)
+        reader.first_name = 'New'
+        reader.save()
+        response = self.client.get(url2)
+        self.assertEqual(('MISS', 'New'), (response['X-Cache'], response.data['readers'][0]['first_name']))
+
+        self.user.delete()
+        response = self.client.get(url1)
+        self.assertEqual(('MISS', None), (response['X-Cache'], response.data['owner_name']))
+
+
+class BooksETagTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book1 = Book.objects.create(name='Test book 1', price=25, author_name='author 1', owner=self.user)
+
+    def test_list(self):
+        url = reverse('book-list')
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(1, len(queries)) # только версия каталога
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url, data={'ordering': 'price'},
+                                                             HTTP_IF_NONE_MATCH=etag).status_code)
+        UserBookRelation.objects.create(user=self.user, book=self.book1, like=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_detail(self):
+        url = reverse('book-detail', args=(self.book1.id,))
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(1, len(queries)) # только версия книги
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        relation = UserBookRelation.objects.create(user=self.user, book=self.book1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code) # добавился читатель
+        etag = response['ETag']
+
+        relation.in_bookmarks = True # закладки видны только в my_relation, но Book.version растит любое изменение связи
+        relation.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        etag = response['ETag']
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        relation.rate = 4
+        relation.save()
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        etag = self.client.get(url)['ETag']
+
+        self.book1.price = 30
+        self.book1.save()
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        with self.assertNumQueries(0): # save() уже дочитал новую версию
+            self.assertEqual(5, self.book1.version) # создание, новый читатель, закладка, оценка, сохранение книги
+
+    def test_list_after_local_cache_cleared(self):
+        # ETag строится из версии в базе, а не из кеша процесса: перезапуск воркера или запись через другой воркер
+        # не оставляют клиента со старыми данными
+        url = reverse('book-list')
+        etag = self.client.get(url)['ETag']
+        get_cache().clear()
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        self.book1.price = 30
+        self.book1.save()
+        get_cache().clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('30.00', response.data['results'][0]['price'])
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_detail_follows_user_renames(self):
+        url = reverse('book-detail', args=(self.book1.id,))
+        etag = self.client.get(url)['ETag']
+        self.user.username = 'new_username'
+        self.user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('new_username', response.data['owner_name'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED,
+                         self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code)
+
+
+class BookSearchTestCase(APITestCase):
+
+    def setUp(self):
+        self.book1 = Book.objects.create(name='Tolstoy biography', price=25, author_name='Ivan Bunin')
+        self.book2 = Book.objects.create(name='War and Peace', price=55, author_name='Leo Tolstoy')
+        self.book3 = Book.objects.create(name='Dead Souls', price=55, author_name='Nikolai Gogol')
+
+    def search(self, **params):
+        response = self.client.get(reverse('book-list'), data=params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return [book['id'] for book in response.data['results']]
+
+    def test_ranked_prefix_search(self):
+        self.assertEqual([self.book1.id, self.book2.id], self.search(search='tolst')) # в названии важнее, чем в авторе
+        self.assertEqual([self.book2.id, self.book1.id], self.search(search='tolst', ordering='-price'))
+        self.assertEqual([self.book2.id], self.search(search='peace LEO'))
+        self.assertEqual([], self.search(search='peace gogol'))
+
+    def test_vector_follows_save(self):
+        self.book3.name = 'Peace of mind'
+        self.book3.save()
+        self.assertEqual([self.book2.id, self.book3.id], self.search(search='peace', ordering='id'))
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import psycopg2
+from django.db import connection, connections
+from django.test import TestCase
+from psycopg2 import extensions
+
+from books.db.backends.pooled.pool import ConnectionPool, PoolTimeout, pool_metrics, pools_of
+from store.metrics import registry
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    def make_pool(self, **options):
+        params = connection.get_connection_params()
+        pool = ConnectionPool(lambda: psycopg2.connect(**params), name='test', **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def backend_pid(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            return cursor.fetchone()[0]
+
+    def test_reuse(self):
+        pool = self.make_pool(min_size=1, max_size=2)
+        pool.fill()
+        conn = pool.getconn()
+        pid = self.backend_pid(conn)
+        pool.putconn(conn)
+        conn = pool.getconn()
+        self.assertEqual(pid, self.backend_pid(conn))
+        pool.putconn(conn)
+        metrics = pool.metrics()
+        self.assertEqual((2, 1, 1, 0), (metrics['checkouts'], metrics['opened'], metrics['idle'], metrics['in_use']))
+
+    def test_rollback_on_return(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(extensions.TRANSACTION_STATUS_INTRANS, conn.info.transaction_status)
+        pool.putconn(conn)
+        self.assertEqual(extensions.TRANSACTION_STATUS_IDLE, conn.info.transaction_status)
+        self.assertIs(conn, pool.getconn())
+
+    def test_session_reset_on_return(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = '1s'")
+            cursor.execute('CREATE TEMP TABLE leftover (id integer)')
+        conn.set_session(readonly=True)
+        pool.putconn(conn)
+
+        self.assertIs(conn, pool.getconn())
+        self.assertEqual((True, None), (conn.autocommit, conn.readonly))
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT current_setting('statement_timeout'), current_setting('default_transaction_read_only'), "
+                           "to_regclass('pg_temp.leftover')")
+            self.assertEqual(('0', 'off', None), cursor.fetchone())
+
+    def test_max_lifetime(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        pid = self.backend_pid(conn)
+        pool.putconn(conn)
+        pool.max_lifetime = 0
+        conn = pool.getconn()
+        self.assertNotEqual(pid, self.backend_pid(conn))
+        metrics = pool.metrics()
+        self.assertEqual((1, 2, 1), (metrics['expired'], metrics['opened'], metrics['closed']))
+
+    def test_health_check(self):
+        pool = self.make_pool(check_idle=0)
+        conn = pool.getconn()
+        pid = self.backend_pid(conn)
+        pool.putconn(conn)
+        # соединение оборвалось, пока лежало в пуле
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s, 5000)', [pid])
+        conn = pool.getconn()
+        self.assertNotEqual(pid, self.backend_pid(conn))
+        self.assertEqual(1, pool.metrics()['failed_checks'])
+
+    def test_wait_and_timeout(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+        conn = pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual((1, 1), (pool.metrics()['waits'], pool.metrics()['timeouts']))
+
+        pool.timeout = 5
+        threading.Timer(0.05, pool.putconn, [conn]).start()
+        self.assertIs(conn, pool.getconn())
+        metrics = pool.metrics()
+        self.assertEqual((2, 1, 1), (metrics['waits'], metrics['timeouts'], metrics['opened']))
+        self.assertGreater(metrics['wait_seconds'], 0)
+
+    def test_idle_connections_closed(self):
+        pool = self.make_pool(min_size=1, max_size=3, max_idle=0.01)
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns[:2]:
+            pool.putconn(conn)
+        time.sleep(0.02)
+        pool.putconn(conns[2])
+        # сверх min_size остается только что возвращенное
+        self.assertEqual((1, 1, 2), (pool.size, pool.metrics()['idle'], pool.metrics()['closed']))
+
+
+class PooledBackendTestCase(TestCase):
+
+    def test_close_returns_connection_to_pool(self):
+        wrapper = connections.create_connection('default')
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        pid = wrapper.connection.get_backend_pid()
+        pool, raw = wrapper.pool, wrapper.connection
+        wrapper.close()
+        self.assertIsNone(wrapper.connection)
+        self.assertFalse(raw.closed)
+        self.assertNotIn(id(raw), pool.in_use)
+
+        wrapper.ensure_connection()
+        self.assertEqual(pid, wrapper.connection.get_backend_pid())
+        self.assertIs(pool, wrapper.pool)
+        self.assertIn(pool, pools_of('default'))
+
+    def test_metrics(self):
+        wrapper = connections.create_connection('default')
+        wrapper.ensure_connection()
+        wrapper.close()
+        lines = pool_metrics()
+        self.assertIn('# TYPE store_db_pool_checkouts_total counter', lines)
+        name = f'default:{wrapper.settings_dict["NAME"]}'
+        # соединение этого теста (TestCase держит транзакцию) выдано, соединение wrapper вернулось в пул
+        self.assertIn(f'store_db_pool_connections{{pool="{name}",state="in_use"}} 1', lines)
+        self.assertTrue(any(line.startswith(f'store_db_pool_checkouts_total{{pool="{name}"}}') for line in lines))
+        self.assertIn(pool_metrics, registry.collectors) # подключает StoreConfig.ready
@@ -1,8 +1,21 @@
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.models import Max
-from django.test import TestCase
-from store.logic import set_rating
-from store.models import Book, UserBookRelation
+from django.test import TestCase, TransactionTestCase, override_settings
+from books.db.backends.pooled.pool import pools_of
+from store.bench import bench_users
+from store.logic import book_stats_drift, counters_drift, ratings_drift, rebuild_book_stats, set_rating, shelf_counts, upsert_relations
+from store.models import Book, BookSimilarityState, BookStats, RatingRecalcJob, SimilarBook, UserBookRelation, UserShelfStats
+from store.rating_queue import ThreadRatingQueue, get_rating_queue
+from store.recommendations import build_similar_books, sparse
 
 
 class SetRatingTestCase(TestCase):
@@ -33,3 +46,419 @@ class SetRatingTestCase(TestCase):
         # print('self.book1.rating==R====', self.book1.rating)
         # self.assertEqual(4.666666666666667, self.book1.rating)
         self.assertEqual('4.67', str(self.book1.rating))
+
+
+class UpdateRatingTestCase(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1_username')
+        self.user2 = User.objects.create(username='user2_username')
+        self.book1 = Book.objects.create(name='Test book 1', price=111, author_name="Author1")
+
+    def test_incremental(self):
+        relation1 = UserBookRelation.objects.create(user=self.user1, book=self.book1, rate=5)
+        relation2 = UserBookRelation.objects.create(user=self.user2, book=self.book1, rate=4)
+        self.book1.refresh_from_db()
+        self.assertEqual((9, 2, '4.50'), (self.book1.rating_sum, self.book1.rating_count, str(self.book1.rating)))
+
+        relation1.rate = 2
+        relation1.save()
+        relation2.rate = None
+        relation2.save()
+        self.book1.refresh_from_db()
+        self.assertEqual((2, 1, '2.00'), (self.book1.rating_sum, self.book1.rating_count, str(self.book1.rating)))
+
+        relation1.delete()
+        self.book1.refresh_from_db()
+        self.assertEqual((0, 0, None), (self.book1.rating_sum, self.book1.rating_count, self.book1.rating))
+
+    def test_book_save_keeps_aggregates(self):
+        book = Book.objects.get(pk=self.book1.pk) # копия книги из базы до появления оценок
+        UserBookRelation.objects.create(user=self.user1, book=self.book1, rate=3)
+        book.name = 'New name'
+        book.save()
+        book.refresh_from_db()
+        self.assertEqual((3, 1, '3.00'), (book.rating_sum, book.rating_count, str(book.rating)))
+
+    def test_rebuild_command(self):
+        UserBookRelation.objects.create(user=self.user1, book=self.book1, rate=5)
+        Book.objects.filter(pk=self.book1.pk).update(rating_sum=1, rating_count=7, rating=None)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_ratings', check=True, stdout=StringIO())
+        call_command('rebuild_ratings', stdout=StringIO())
+        call_command('rebuild_ratings', check=True, stdout=StringIO())
+        self.book1.refresh_from_db()
+        self.assertEqual((5, 1, '5.00'), (self.book1.rating_sum, self.book1.rating_count, str(self.book1.rating)))
+
+
+class CountersTestCase(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(username='user1_username')
+        self.user2 = User.objects.create(username='user2_username')
+        self.book1 = Book.objects.create(name='Test book 1', price=111, author_name="Author1")
+        self.book2 = Book.objects.create(name='Test book 2', price=222, author_name="Author2")
+
+    def counters(self, book):
+        book.refresh_from_db()
+        return book.likes_count, book.bookmarks_count, book.buyers_count
+
+    def test_incremental(self):
+        relation1 = UserBookRelation.objects.create(user=self.user1, book=self.book1, like=True, bought=True)
+        UserBookRelation.objects.create(user=self.user2, book=self.book1, like=True, in_bookmarks=True)
+        self.assertEqual((2, 1, 1), self.counters(self.book1))
+
+        relation1.like = False
+        relation1.in_bookmarks = True
+        relation1.save()
+        self.assertEqual((1, 2, 1), self.counters(self.book1))
+
+        relation1.book = self.book2
+        relation1.save()
+        self.assertEqual((1, 1, 0), self.counters(self.book1))
+        self.assertEqual((0, 1, 1), self.counters(self.book2))
+
+        relation1.delete()
+        self.assertEqual((0, 0, 0), self.counters(self.book2))
+
+    def test_cascade_and_queryset_delete(self):
+        # каскадное удаление и queryset.delete() не вызывают UserBookRelation.delete()
+        UserBookRelation.objects.create(user=self.user1, book=self.book1, like=True, rate=5, bought=True)
+        UserBookRelation.objects.create(user=self.user2, book=self.book1, like=True, rate=3, in_bookmarks=True)
+        UserBookRelation.objects.create(user=self.user2, book=self.book2, like=True)
+
+        self.user1.delete()
+        self.assertEqual((1, 1, 0), self.counters(self.book1))
+        self.assertEqual((1, 3, 1, Decimal('3.00')), (self.book1.readers_count, self.book1.rating_sum,
+                                                       self.book1.rating_count, self.book1.rating))
+
+        UserBookRelation.objects.filter(user=self.user2).delete()
+        self.assertEqual((0, 0, 0), self.counters(self.book1))
+        self.assertEqual((0, 0, None), (self.book1.readers_count, self.book1.rating_count, self.book1.rating))
+        self.assertEqual((0, 0, 0), self.counters(self.book2))
+        self.assertFalse(counters_drift(Book.objects.all()).exists())
+        self.assertFalse(ratings_drift(Book.objects.all()).exists())
+
+    def test_reconcile_command(self):
+        UserBookRelation.objects.create(user=self.user1, book=self.book1, like=True, in_bookmarks=True)
+        Book.objects.filter(pk=self.book1.pk).update(likes_count=5, bookmarks_count=0)
+
+        with self.assertRaises(CommandError):
+            call_command('reconcile_counters', check=True, stdout=StringIO())
+        call_command('reconcile_counters', stdout=StringIO())
+        call_command('reconcile_counters', check=True, stdout=StringIO())
+        self.assertEqual((1, 1, 0), self.counters(self.book1))
+
+
+@override_settings(STORE_RATING_QUEUE='db')
+class DbRatingQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user{i}_username') for i in range(3)]
+        self.book1 = Book.objects.create(name='Test book 1', price=111, author_name="Author1")
+
+    def test_drain_coalesces_jobs(self):
+        for user, rate in zip(self.users, [5, 4, 3]):
+            UserBookRelation.objects.create(user=user, book=self.book1, rate=rate, like=True)
+        self.book1.refresh_from_db()
+        self.assertEqual((None, 0, 3), (self.book1.rating, self.book1.rating_count, self.book1.likes_count)) # лайки считаются сразу
+        self.assertEqual(3, RatingRecalcJob.objects.count())
+
+        out = StringIO()
+        call_command('drain_rating_queue', stdout=out)
+        self.assertIn('Processed 3 job(s) for 1 book(s)', out.getvalue())
+        self.assertFalse(RatingRecalcJob.objects.exists())
+        self.book1.refresh_from_db()
+        self.assertEqual(('4.00', 3), (str(self.book1.rating), self.book1.rating_count))
+
+    def test_only_rate_changes_are_queued(self):
+        relation = UserBookRelation.objects.create(user=self.users[0], book=self.book1, like=True)
+        relation.in_bookmarks = True
+        relation.save()
+        self.assertFalse(RatingRecalcJob.objects.exists())
+
+
+@override_settings(STORE_RATING_QUEUE='thread', STORE_RATING_QUEUE_DELAY=0.05)
+class ThreadRatingQueueTestCase(TransactionTestCase):
+    # TransactionTestCase: поток работает через свое соединение и видит только закоммиченные данные
+
+    def test_recalculated_after_commit(self):
+        users = [User.objects.create(username=f'user{i}_username') for i in range(3)]
+        book = Book.objects.create(name='Test book 1', price=111, author_name="Author1")
+        for user, rate in zip(users, [5, 5, 2]):
+            UserBookRelation.objects.create(user=user, book=book, rate=rate)
+
+        self.assertTrue(get_rating_queue().flush(timeout=5))
+        book.refresh_from_db()
+        self.assertEqual((12, 3, '4.00'), (book.rating_sum, book.rating_count, str(book.rating)))
+
+    def test_flushed_at_exit(self):
+        queue = ThreadRatingQueue(delay=0.05)
+        with mock.patch('atexit.register') as register:
+            queue.enqueue([])
+            queue.enqueue([])
+        register.assert_called_once_with(queue.flush, queue.delay + queue.exit_timeout)
+
+
+class BenchmarkCommandsTestCase(TestCase):
+
+    def test_seed_and_bench(self):
+        call_command('seed_books', books=30, users=8, relations=60, stdout=StringIO())
+        self.assertEqual((30, 8), (Book.objects.count(), bench_users().count()))
+        self.assertEqual(60, UserBookRelation.objects.count())
+        self.assertFalse(ratings_drift(Book.objects.all()).exists())
+        self.assertFalse(counters_drift(Book.objects.all()).exists())
+        self.assertFalse(Book.objects.filter(search_vector__isnull=True).exists())
+
+        relations = list(UserBookRelation.objects.values_list('book_id', 'rate', 'like').order_by('id'))
+        aggregates = list(Book.objects.values_list('id', 'rating', 'likes_count', 'readers_count').order_by('id'))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.json')
+            call_command('bench_api', requests=3, warmup=1, host='testserver', output=path, stdout=StringIO())
+            with open(path) as f:
+                results = json.load(f)
+            self.assertEqual(30, results['meta']['books'])
+            for name, stats in results['scenarios'].items():
+                self.assertEqual((3, 0), (stats['requests'], stats['errors']), name)
+                self.assertGreater(stats['queries_mean'], 0, name)
+
+            out = StringIO()
+            call_command('bench_api', compare=path, against=path, fail_on_regression=True, stdout=out)
+            self.assertIn('relation_patch', out.getvalue())
+        # связи, поменянные PATCH-ами бенчмарка, возвращаются как были, вместе с агрегатами книг
+        self.assertEqual(relations, list(UserBookRelation.objects.values_list('book_id', 'rate', 'like').order_by('id')))
+        self.assertEqual(aggregates, list(Book.objects.values_list('id', 'rating', 'likes_count', 'readers_count')
+                                          .order_by('id')))
+
+    def test_bench_db_pool(self):
+        out = StringIO()
+        call_command('bench_db_pool', requests=3, threads=2, pool_size=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['query', 'plain', 'pooled'], [line.split()[0] for line in lines])
+        self.assertIn('requests=6 threads=2 errors=0', lines[2])
+        self.assertIn('opened=1', lines[2])
+        self.assertFalse(pools_of('bench_pooled'))
+
+
+class ImportBooksCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.reader = User.objects.create(username='reader')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def test_import(self):
+        books = self.write('books.csv', 'external_id,name,price,author_name,discount,owner\n'
+                                        'b1,First,10.50,Author 1,,owner1\n'
+                                        'b2,Second,20,Author 2,10,owner1\n'
+                                        'b3,Third,30,Author 3,0,\n')
+        relations = self.write('relations.jsonl', '{"book": "b1", "user": "reader", "like": true, "rate": 4}\n'
+                                                  '{"book": "b1", "user": "new_reader", "rate": "2", "bought": "yes"}\n'
+                                                  '\n'
+                                                  '{"book": "b2", "user": "new_reader", "in_bookmarks": 1}\n')
+        for _ in range(2): # повторный запуск ничего не меняет
+            call_command('import_books', books, relations=relations, batch_size=2, stdout=StringIO())
+
+            self.assertEqual(3, Book.objects.count())
+            self.assertEqual(3, UserBookRelation.objects.count())
+            book = Book.objects.get(external_id='b1')
+            self.assertEqual(('First', 'owner1', 2, 1, '3.00'),
+                             (book.name, book.owner.username, book.readers_count, book.likes_count, str(book.rating)))
+            self.assertFalse(ratings_drift(Book.objects.all()).exists())
+            self.assertFalse(counters_drift(Book.objects.all()).exists())
+            self.assertFalse(Book.objects.filter(search_vector__isnull=True).exists())
+            self.assertEqual([], book_stats_drift())
+        self.assertEqual({'reader', 'owner1', 'new_reader'}, set(User.objects.values_list('username', flat=True)))
+        self.assertFalse(User.objects.get(username='new_reader').has_usable_password())
+
+    def test_json_with_nested_relations(self):
+        path = self.write('books.json', json.dumps([
+            {'external_id': 'j1', 'name': 'Json', 'price': 5, 'author_name': 'A',
+             'relations': [{'user': 'reader', 'like': True}]},
+        ]))
+        out = StringIO()
+        call_command('import_books', path, stdout=out)
+        self.assertIn('Imported 1 new book(s)', out.getvalue())
+        self.assertEqual(1, Book.objects.get(external_id='j1').likes_count)
+
+    def test_invalid_record(self):
+        path = self.write('books.csv', 'external_id,name,price,author_name\n'
+                                       'b1,First,10,Author\n'
+                                       'b2,Second,abc,Author\n')
+        with self.assertRaisesMessage(CommandError, 'record 3: price'):
+            call_command('import_books', path, batch_size=1, stdout=StringIO())
+        self.assertEqual(['b1'], list(Book.objects.values_list('external_id', flat=True))) # первая пачка осталась
+
+        path = self.write('relations.csv', 'book,user,rate\nb1,reader,7\n')
+        with self.assertRaisesMessage(CommandError, 'record 2: rate'):
+            call_command('import_books', self.write('empty.csv', 'external_id\n'), relations=path, stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, 'unknown format'):
+            call_command('import_books', self.write('books.xml', ''), stdout=StringIO())
+
+
+class BookStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner_username')
+        self.user = User.objects.create(username='user_username')
+        self.book = Book.objects.create(name='Test book 1', price='10.01', author_name='Author1', discount=15,
+                                        owner=self.owner)
+
+    def stats(self):
+        stats = BookStats.objects.get(book=self.book)
+        return str(stats.price_with_discount), stats.owner_name
+
+    def test_follows_changes(self):
+        self.assertEqual(('8.5085', 'owner_username'), self.stats())
+
+        # лайки и оценки меняют только счетчики книги, триггер BookStats на них не срабатывает
+        BookStats.objects.filter(book=self.book).update(owner_name='stale')
+        UserBookRelation.objects.create(user=self.user, book=self.book, like=True, rate=4)
+        self.assertEqual(('8.5085', 'stale'), self.stats())
+        self.assertEqual((1, Decimal('4.00')), Book.objects.values_list('likes_count', 'rating').get(pk=self.book.pk))
+        rebuild_book_stats([self.book.id])
+        self.assertEqual(('8.5085', 'owner_username'), self.stats())
+
+        Book.objects.filter(pk=self.book.pk).update(price=20, discount=0) # queryset.update тоже доходит до триггера
+        self.assertEqual(('20.0000', 'owner_username'), self.stats())
+
+        self.owner.username = 'renamed'
+        self.owner.save()
+        self.assertEqual('renamed', self.stats()[1])
+        self.owner.delete()
+        self.assertIsNone(self.stats()[1])
+
+        self.book.delete()
+        self.assertFalse(BookStats.objects.exists())
+
+    def test_rebuild_command(self):
+        BookStats.objects.filter(book=self.book).update(price_with_discount=1, owner_name=None)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_book_stats', check=True, stdout=StringIO())
+        call_command('rebuild_book_stats', stdout=StringIO())
+        call_command('rebuild_book_stats', check=True, stdout=StringIO())
+        self.assertEqual(('8.5085', 'owner_username'), self.stats())
+
+
+class ShelfStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_username')
+        self.books = [Book.objects.create(name=f'Test book {i}', price=10, author_name='Author') for i in range(3)]
+
+    def test_follows_changes(self):
+        self.assertEqual({'liked': 0, 'bookmarked': 0, 'bought': 0, 'rated': 0}, shelf_counts(self.user))
+
+        UserBookRelation.objects.bulk_create([UserBookRelation(user=self.user, book=book, like=True)
+                                              for book in self.books])
+        self.assertEqual({'liked': 3, 'bookmarked': 0, 'bought': 0, 'rated': 0}, shelf_counts(self.user))
+
+        # upsert: одна связь меняется, одна не меняется вовсе
+        upsert_relations(self.user, [{'book_id': self.books[0].id, 'rate': 4, 'bought': True},
+                                     {'book_id': self.books[1].id, 'like': True}])
+        self.assertEqual({'liked': 3, 'bookmarked': 0, 'bought': 1, 'rated': 1}, shelf_counts(self.user))
+
+        UserBookRelation.objects.filter(user=self.user).update(like=False, in_bookmarks=True)
+        self.assertEqual({'liked': 0, 'bookmarked': 3, 'bought': 1, 'rated': 1}, shelf_counts(self.user))
+        UserBookRelation.objects.filter(book=self.books[0]).delete()
+        self.assertEqual({'liked': 0, 'bookmarked': 2, 'bought': 0, 'rated': 0}, shelf_counts(self.user))
+
+        self.user.delete() # вместе со связями и счетчиками
+        self.assertFalse(UserShelfStats.objects.exists())
+
+    def test_rebuild_command(self):
+        UserBookRelation.objects.create(user=self.user, book=self.books[0], like=True, rate=3)
+        other = User.objects.create(username='other_username')
+        UserShelfStats.objects.filter(user=self.user).update(liked_count=7)
+        UserShelfStats.objects.create(user=other, bought_count=2) # связей у пользователя нет
+
+        with self.assertRaisesMessage(CommandError, '2 user(s)'):
+            call_command('rebuild_shelf_stats', check=True, stdout=StringIO())
+        call_command('rebuild_shelf_stats', stdout=StringIO())
+        call_command('rebuild_shelf_stats', check=True, stdout=StringIO())
+        self.assertEqual({'liked': 1, 'bookmarked': 0, 'bought': 0, 'rated': 1}, shelf_counts(self.user))
+        self.assertFalse(UserShelfStats.objects.filter(user=other).exists())
+
+
+class SimilarBooksTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'reader{i}') for i in range(4)]
+        self.books = [Book.objects.create(name=f'Book {i}', price=10, author_name='author') for i in range(5)]
+        u1, u2, u3, u4 = self.users
+        b1, b2, b3, b4, b5 = self.books
+        for user, book, values in [(u1, b1, {'like': True}), (u1, b2, {'like': True}),
+                                   (u2, b1, {'like': True}), (u2, b2, {'rate': 5}), (u2, b3, {'bought': True}),
+                                   (u3, b3, {'like': True}), (u3, b4, {'rate': 5}),
+                                   (u4, b5, {'bought': True}), (u4, b4, {'rate': 2, 'in_bookmarks': True})]:
+            UserBookRelation.objects.create(user=user, book=book, **values)
+
+    def similar(self):
+        result = {}
+        for book_id, similar_id, score in SimilarBook.objects.values_list('book_id', 'similar_id', 'score') \
+                .order_by('book_id', '-score', 'similar_id'):
+            result.setdefault(book_id, []).append((similar_id, round(score, 4)))
+        return result
+
+    def test_full_build(self):
+        self.assertEqual((5, 5), build_similar_books(full=True, engine='python'))
+        b1, b2, b3, b4, b5 = [book.id for book in self.books]
+        self.assertEqual({
+            b1: [(b2, 1.0), (b3, 0.5)],
+            b2: [(b1, 1.0), (b3, 0.5)],
+            b3: [(b4, 0.7071), (b1, 0.5), (b2, 0.5)],
+            b4: [(b3, 0.7071)],
+        }, self.similar()) # оценка 2 и закладка - не сигнал, у b5 общих читателей нет
+        self.assertEqual((0, 0), build_similar_books(engine='python'))
+
+        build_similar_books(full=True, engine='python', k=1)
+        self.assertEqual([(b2, 1.0)], self.similar()[b1])
+
+    def test_incremental_matches_full_build(self):
+        build_similar_books(full=True, engine='python')
+        u1, u2, u3, u4 = self.users
+        UserBookRelation.objects.create(user=u4, book=self.books[0], like=True)
+        relation = UserBookRelation.objects.get(user=u2, book=self.books[2])
+        relation.bought = False # покупка тоже меняет Book.version
+        relation.save()
+
+        changed, rebuilt = build_similar_books(engine='python')
+        self.assertEqual(2, changed)
+        self.assertLess(rebuilt, len(self.books) + 1)
+        incremental = self.similar()
+        build_similar_books(full=True, engine='python')
+        self.assertEqual(self.similar(), incremental)
+        self.assertIn(self.books[0].id, [similar_id for similar_id, _ in incremental[self.books[4].id]])
+
+    def test_bigint_book_id(self):
+        book = Book.objects.create(id=2 ** 31 + 1, name='Big id book', price=10, author_name='author')
+        UserBookRelation.objects.create(user=self.users[3], book=book, bought=True)
+        build_similar_books(full=True, engine='python')
+        self.assertEqual([(self.books[4].id, 1.0)], self.similar()[book.id])
+        self.assertTrue(BookSimilarityState.objects.filter(book=book).exists())
+
+    @skipUnless(sparse, 'numpy and scipy are not installed')
+    def test_scipy_engine_matches_python(self):
+        build_similar_books(full=True, engine='python')
+        expected = self.similar()
+        build_similar_books(full=True, engine='scipy')
+        self.assertEqual(expected, self.similar())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('build_similar_books', full=True, engine='python', stdout=out)
+        self.assertIn('5 changed book(s), rebuilt 5 list(s) with PythonSimilarity', out.getvalue())
+        out = StringIO()
+        call_command('bench_similar_books', books=20, users=10, relations=60, changed=3, engine=['python'], stdout=out)
+        self.assertIn('incremental after 3 changed book(s)', out.getvalue())
+        self.assertEqual(4, SimilarBook.objects.values('book').distinct().count()) # данные бенчмарка откатились
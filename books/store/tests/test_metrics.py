@@ -0,0 +1,60 @@
+import json
+import re
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+import rest_framework.status as status
+
+from store.metrics import registry
+from store.models import Book
+
+
+class RequestMetricsTestCase(APITestCase):
+
+    def setUp(self):
+        registry.clear()
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='Test book 1', price=25, author_name='author 1', owner=self.user)
+
+    def timing(self, response):
+        return {name: params for name, params in
+                (part.strip().split(';', 1) for part in response['Server-Timing'].split(','))}
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-list'), data={'ordering': 'price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        timing = self.timing(response)
+        self.assertEqual(['db', 'serializer', 'total'], list(timing))
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+        self.assertRegex(timing['total'], r'^dur=\d+\.\d\d$')
+
+    def test_histograms_per_action(self):
+        self.client.get(reverse('book-list'))
+        self.client.get(reverse('book-detail', args=(self.book.id,)))
+        self.client.force_authenticate(self.user)
+        self.client.patch(reverse('userbookrelation-detail', args=(self.book.id,)), data=json.dumps({'like': True}),
+                          content_type='application/json')
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        text = response.content.decode()
+        for view in ['BookViewSet.list', 'BookViewSet.retrieve', 'UserBookRelationView.partial_update']:
+            self.assertIn(f'store_request_duration_seconds_count{{view="{view}"}} 1', text)
+        # upsert, UPDATE связи и UPDATE книги - все запросы PATCH попадают в корзину le="3"
+        self.assertIn('store_db_queries_bucket{view="UserBookRelationView.partial_update",le="3"} 1', text)
+        size = re.search(r'store_response_size_bytes_sum\{view="BookViewSet.retrieve"\} (\d+)', text)
+        self.assertTrue(int(size.group(1)))
+
+    def test_metrics_access(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
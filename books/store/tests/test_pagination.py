@@ -0,0 +1,67 @@
+from django.db.models import F
+from django.urls import reverse
+from rest_framework.test import APITestCase
+import rest_framework.status as status
+
+from store.models import Book
+
+
+class KeysetPaginationTestCase(APITestCase):
+
+    def setUp(self):
+        discounts = [None, 10, 0, None, 30, 10, None]
+        for i, discount in enumerate(discounts):
+            Book.objects.create(name=f'Book {i % 3}', price=10 + i % 2, author_name='Author', discount=discount)
+        for book, rating in zip(Book.objects.order_by('id'), [5, None, 3, 5, None, 1, 4]):
+            Book.objects.filter(pk=book.pk).update(rating=rating, likes_count=book.id % 3)
+
+    def walk(self, ordering):
+        # проходим все страницы вперед, а потом обратно по ссылкам previous
+        url = reverse('book-list')
+        response = self.client.get(url, data={'ordering': ordering, 'page_size': 2})
+        pages = [response.data]
+        while pages[-1]['next']:
+            response = self.client.get(pages[-1]['next'])
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            pages.append(response.data)
+
+        back = [pages[-1]]
+        while back[-1]['previous']:
+            back.append(self.client.get(back[-1]['previous']).data)
+
+        forward_ids = [book['id'] for page in pages for book in page['results']]
+        backward_ids = [book['id'] for page in reversed(back) for book in page['results']]
+        return forward_ids, backward_ids
+
+    def test_default_ordering(self):
+        forward_ids, backward_ids = self.walk('')
+        expected = list(Book.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(expected, forward_ids)
+        self.assertEqual(expected, backward_ids)
+
+    def test_ordering_with_ties_and_nulls(self):
+        for ordering, order_by in [
+            ('price', ['price', 'id']),
+            ('-name', ['-name', '-id']),
+            ('discount', ['discount', 'id']),
+            ('-discount', ['-discount', '-id']),
+            ('-price,discount', ['-price', 'discount', 'id']),
+            ('price_with_discount', ['stats__price_with_discount', 'id']),
+            ('-price_with_discount', ['-stats__price_with_discount', '-id']),
+            ('-annotated_likes', ['-likes_count', '-id']),
+            ('rating', [F('rating').asc(nulls_last=True), 'id']),
+        ]:
+            with self.subTest(ordering=ordering):
+                forward_ids, backward_ids = self.walk(ordering)
+                expected = list(Book.objects.order_by(*order_by).values_list('id', flat=True))
+                self.assertEqual(expected, forward_ids)
+                self.assertEqual(expected, backward_ids)
+
+    def test_invalid_cursor(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'cursor': 'garbage'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+        next_url = self.client.get(url, data={'page_size': 2}).data['next']
+        response = self.client.get(next_url + '&ordering=price') # курсор от другой сортировки
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
@@ -73,7 +73,9 @@ class BookSerializerTestCase(TestCase):
                     {'first_name': 'Ivan', 'last_name': 'Petrov'},
                     {'first_name': 'Alex', 'last_name': 'Sidorov'},
                     {'first_name': 'Ann', 'last_name': 'Stern'},
-                ]
+                ],
+                'readers_count': 3,
+                'my_relation': None, # без request в контексте пользователя нет
             },
             {
                 'id': book2.id,
@@ -90,8 +92,9 @@ class BookSerializerTestCase(TestCase):
                     {'first_name': 'Ivan', 'last_name': 'Petrov'},
                     {'first_name': 'Alex', 'last_name': 'Sidorov'},
                     {'first_name': 'Ann', 'last_name': 'Stern'},
-                ]
-
+                ],
+                'readers_count': 3,
+                'my_relation': None,
             }
         ]
         # print('expected_data===', expected_data)
@@ -1,32 +1,105 @@
-from django.db.models import When, Case, Count, Avg, F
+import random
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db.models import F, ProtectedError, Q
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.mixins import UpdateModelMixin
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter, OrderingFilter
 
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, IsAuthenticatedOrReadOnly
 from django.shortcuts import render
 
-from store.models import Book, UserBookRelation
+from store.cache import CachedReadMixin, ConditionalReadMixin, pin_to_primary, pinned_to_primary
+from store.filters import BookFilter, BookOrderingFilter, BookSearchFilter
+from store.logic import delete_books, get_or_create_relation, shelf_counts, update_books, upsert_relations
+from store.metrics import registry, serializer_timer
+from store.models import SHELVES, Book, UserBookRelation
 from store.permissions import IsOwnerOrStaffOrReadOnly
-from store.serializers import BooksSerializer, UserBookRelationSerializer
+from store.recommendations import recommended_book_ids, similar_books
+from store.renderers import CSVRenderer, FastJSONRenderer, NDJSONRenderer
+from store.replicas import replica_alias
+from store.serializers import COMPUTED_BOOK_FIELDS, BookBulkSerializer, BookReaderSerializer, BooksSerializer, UserBookRelationBulkSerializer, \
+    UserBookRelationSerializer, book_fields, book_list_values, book_row_data, books_list_data
+
+
+class ReplicaReadMixin:
+    """
+    Safe requests read from one of STORE_DB_REPLICAS (see
+    store.replicas.ReplicaRouter), unless the user wrote something less than
+    STORE_REPLICA_LAG seconds ago: then they read from the primary and see
+    their own like or rating. A successful write request pins the user.
+    """
+    replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs) # здесь аутентификация, после нее пользователь уже известен
+        if request.method in SAFE_METHODS and settings.STORE_DB_REPLICAS and not pinned_to_primary(request):
+            self.replica_token = replica_alias.set(random.choice(settings.STORE_DB_REPLICAS))
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # и после необработанного исключения: иначе следующие запросы этого потока остались бы на реплике
+            if self.replica_token is not None:
+                replica_alias.reset(self.replica_token)
+                self.replica_token = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class FastBookListMixin:
+    """
+    GET /book/ without ModelSerializer machinery: the page is read with
+    .values() and turned into the BooksSerializer payload by books_list_data.
+    Turned off with STORE_FAST_LIST = False.
+    """
+    def list(self, request, *args, **kwargs):
+        if not settings.STORE_FAST_LIST or self.get_serializer_class() is not BooksSerializer:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        names = book_list_values()
+        # пагинации нужны значения полей сортировки, например search_rank из поиска
+        names += [name.lstrip('-') for name in queryset.query.order_by
+                  if isinstance(name, str) and name.lstrip('-') not in names]
+        rows = queryset.values(*names)
+        page = self.paginate_queryset(rows)
+        with serializer_timer():
+            data = books_list_data(page if page is not None else rows, request.user)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
 
 
-class BookViewSet(ModelViewSet):
+class BookViewSet(ReplicaReadMixin, ConditionalReadMixin, CachedReadMixin, FastBookListMixin, ModelViewSet):
     # queryset = Book.objects.all() # стандартный сет (если без annotane в сериалайзере)
 
     # если используем для подтягивания лайков к книге annotate в сериалайзере, то нужно указывать так:
     queryset = Book.objects.all().annotate(
-        annotated_likes=Count(Case(When(userbookrelation__like=True, then=1))),
+        # annotated_likes=Count(Case(When(userbookrelation__like=True, then=1))), # каждый раз делает JOIN и GROUP BY по всем связям. Теперь лайки хранятся в поле Book.likes_count
         # rating=Avg('userbookrelation__rate'), # каждый раз высчитывает в среднюю величину. Можно добавить поле в модель Book, чтобы оно хранилось и хешировалось при обновлении количества лайков. При добавлении такого поля в Book нужно удалить отсюда.
-        price_with_discount=Case(
-            When(discount=None, then=F('price')),
-            When(discount=0, then=F('price')),
-            default=F('price') - (F('price') * F('discount') / 100)),
-        owner_name=F('owner__username'), # можно обратиться к полю owner в Book и оттуда взять
+        # price_with_discount=Case(
+        #     When(discount=None, then=F('price')),
+        #     When(discount=0, then=F('price')),
+        #     default=F('price') - (F('price') * F('discount') / 100)),
+        # owner_name=F('owner__username'), # можно обратиться к полю owner в Book и оттуда взять
+        # цена со скидкой и имя владельца заранее посчитаны в BookStats (обновляется триггерами), вместо CASE и JOIN с auth_user
+        price_with_discount=F('stats__price_with_discount'),
+        owner_name=F('stats__owner_name'),
         # owner_name=F('userbookrelation__user__username'), # а можно обратиться к модели userbookrelation и оттуда взять
 
-        ).prefetch_related('readers').order_by( # можно аннотировать поле owner_name внутри annotate, тогда будет тянуть в запросе только его, а можно указать select_related как ниже сделано, тогда будет тянуть все поля из User.
+        # ).prefetch_related('readers').order_by( # prefetch_related тянул ВСЕХ читателей каждой книги, теперь сериалайзер берет только первых STORE_READERS_PREVIEW_SIZE
+        ).order_by( # можно аннотировать поле owner_name внутри annotate, тогда будет тянуть в запросе только его, а можно указать select_related как ниже сделано, тогда будет тянуть все поля из User.
 
         # ).select_related('owner').prefetch_related('readers').order_by(
         'id')  # select_related - по полю owner выбирает один объект, связанный с книгой (то есть раотает для foreignKey) связывает таблицы запроса, чтоб не делать несколько запросов в базу отдельно для модели книги и модели UserBookRelation
@@ -34,35 +107,196 @@ class BookViewSet(ModelViewSet):
     # можно указать так "order_by(F('discount').desc(nulls_last=True), 'id')" чтобы сортировало сначала по discount, и значения null выставляет в конец, а потом сортировало это по id. Но при применении фильтра сортировки в гет запросе это не работает, для этого нужно переопределить функцию get_ordering в классе OrderingFilter, который указан здесь в filter_backends
 
     serializer_class = BooksSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    renderer_classes = [FastJSONRenderer] # те же байты, что у JSONRenderer, но быстрее, если установлен orjson
+    filter_backends = [DjangoFilterBackend, BookSearchFilter, BookOrderingFilter] # BookSearchFilter вместо SearchFilter: полнотекстовый поиск по индексу вместо ILIKE
     # permission_classes = [IsAuthenticated]
     # permission_classes = [IsAuthenticatedOrReadOnly] # стандартный класс, дает читать чтолько аутентифицированным
     permission_classes = [
         IsOwnerOrStaffOrReadOnly]  # создали кастомный класс, который проверяет является ли клиент создателем объекта
-    filterset_fields = ['id', 'price', 'name']
+    # filterset_fields = ['id', 'price', 'name']
+    filterset_class = BookFilter # те же id/price/name плюс диапазоны по price_with_discount, rating и annotated_likes
     search_fields = ['author_name', 'name']
-    ordering_fields = ['price', 'name', 'discount']
+    ordering_fields = ['price', 'name', 'discount', 'price_with_discount', 'rating', 'annotated_likes']
+    ordering_aliases = {'annotated_likes': 'likes_count'} # в API поле называется annotated_likes, в базе likes_count
+    # с LEFT JOIN планировщик не может идти по индексу BookStats и сортирует ?ordering=price_with_discount целиком,
+    # фильтр делает JOIN внутренним. Только для этой сортировки: книга без строки BookStats не пропадает из списка
+    ordering_filters = {'price_with_discount': Q(stats__isnull=False)}
 
     def perform_create(self, serializer):
         serializer.validated_data['owner'] = self.request.user
         serializer.save()
 
+    @action(detail=False, methods=['patch', 'delete'], serializer_class=BookBulkSerializer,
+            permission_classes=[IsAuthenticated, IsOwnerOrStaffOrReadOnly])
+    def bulk(self, request):
+        # массовое изменение и удаление своих книг (staff - любых). Книги не загружаются и has_object_permission не
+        # вызывается: права - это фильтр permission.filter_queryset в самом UPDATE/DELETE, чужие id просто не совпадут
+        serializer = self.get_serializer(data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        values = dict(serializer.validated_data)
+        book_ids = values.pop('ids')
+        books = Book.objects.filter(pk__in=book_ids)
+        for permission in self.get_permissions():
+            if hasattr(permission, 'filter_queryset'):
+                books = permission.filter_queryset(request, books)
 
-class UserBookRelationView(UpdateModelMixin, GenericViewSet):
+        if request.method == 'DELETE':
+            try:
+                return Response({'deleted': delete_books(books)})
+            except ProtectedError as error:
+                raise ValidationError({'non_field_errors': [error.args[0]]})
+        if not values:
+            raise ValidationError({'non_field_errors': ['Nothing to update.']})
+        return Response({'updated': update_books(books, values)})
+
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        # весь каталог потоком, с теми же фильтрами, поиском и сортировкой, что и список. iterator() читает из базы
+        # server-side курсором по STORE_EXPORT_CHUNK_SIZE строк, так что память не зависит от числа книг
+        # вложенные превью читателей и связь пользователя в CSV не ложатся, да и выгрузка - это каталог, а не чья-то полка
+        fields = [field for field in book_fields() if field[0] not in COMPUTED_BOOK_FIELDS]
+        queryset = self.filter_queryset(self.get_queryset()).values(*[source for _, source, _ in fields])
+        queryset = queryset.using(queryset.db) # поток читается уже после выхода из view, базу запроса фиксируем сейчас
+        rows = (book_row_data(row, fields) for row in queryset.iterator(chunk_size=settings.STORE_EXPORT_CHUNK_SIZE))
+
+        renderer = request.accepted_renderer
+        content_type = f'{renderer.media_type}; charset={renderer.charset}' if renderer.charset else renderer.media_type
+        response = StreamingHttpResponse(
+            renderer.stream(rows, [name for name, _, _ in fields], settings.STORE_EXPORT_CHUNK_SIZE),
+            content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="books.{renderer.format}"'
+        return response
+
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        # похожие книги заранее посчитаны в SimilarBook (build_similar_books), на запрос - только чтение по индексу
+        book = self.get_object()
+        serializer = self.get_serializer(similar_books(self.get_queryset(), book.pk), many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def recommended(self, request):
+        book_ids = recommended_book_ids(request.user)
+        books = {book.pk: book for book in self.get_queryset().filter(pk__in=book_ids)}
+        serializer = self.get_serializer([books[book_id] for book_id in book_ids if book_id in books], many=True)
+        return Response(serializer.data)
+
+    @action(detail=True)
+    def readers(self, request, pk=None):
+        # полный список читателей книги, постранично
+        book = self.get_object()
+        relations = UserBookRelation.objects.filter(book_id=book.pk).select_related('user').order_by('id')
+        page = self.paginate_queryset(relations)
+        serializer = BookReaderSerializer([relation.user for relation in page], many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class UserBookRelationView(ReplicaReadMixin, UpdateModelMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
     queryset = UserBookRelation.objects.all()
     serializer_class = UserBookRelationSerializer
     lookup_field = 'bookk'
 
     def get_object(self):
-        obj, _ = UserBookRelation.objects.get_or_create(user=self.request.user,
-                                                        book_id=self.kwargs['bookk'],
-                                                        )  # метод get_or_create возвращает объект и статус - найден он или создан, поэтому переменной '_' присвоится этот статус, но он нам не важен
-        # print('============b', self.kwargs)
-        # print('============u', self.request.user)
-        # print('============o', obj)
+        # obj, _ = UserBookRelation.objects.get_or_create(user=self.request.user,
+        #                                                 book_id=self.kwargs['bookk'],
+        #                                                 )  # метод get_or_create возвращает объект и статус - найден он или создан, поэтому переменной '_' присвоится этот статус, но он нам не важен
+        # get_or_create - это SELECT, а для новой связи еще INSERT и отдельный UPDATE книги. Теперь один upsert
+        try:
+            book_id = int(self.kwargs['bookk'])
+        except ValueError:
+            raise Http404
+        obj = get_or_create_relation(self.request.user, book_id)
+        if obj is None:
+            raise Http404
         return obj
 
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True) # сначала проверяем данные, чтобы кривой запрос не создавал связь
+        with transaction.atomic(savepoint=False): # связь заблокирована upsert-ом до конца транзакции
+            serializer.instance = self.get_object()
+            self.perform_update(serializer)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['post'], serializer_class=UserBookRelationBulkSerializer)
+    def bulk(self, request):
+        # много связей за один запрос: один upsert и один пересчет агрегатов вместо запроса и set_rating на каждую книгу
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        relations = upsert_relations(request.user, serializer.validated_data)
+        return Response(self.get_serializer(relations, many=True).data)
+
+
+class MyBooksView(ReplicaReadMixin, GenericViewSet):
+    """
+    The user's shelves: GET /me/books/?shelf=liked|bookmarked|bought|rated,
+    newest relation first, in the BooksSerializer shape. The page is read
+    from UserBookRelation by the partial index of the shelf, then its books
+    by primary key. GET /me/books/counts/ gives the size of every shelf.
+    """
+    permission_classes = [IsAuthenticated]
+    queryset = UserBookRelation.objects.all()
+    renderer_classes = [FastJSONRenderer]
+
+    def list(self, request):
+        shelf = request.query_params.get('shelf')
+        if shelf not in SHELVES:
+            raise ValidationError({'shelf': [f'Expected one of: {", ".join(SHELVES)}.']})
+        relations = self.get_queryset().filter(SHELVES[shelf], user=request.user).order_by('-id') \
+            .values('id', *UserBookRelation.COUNTED_FIELDS)
+        page = self.paginate_queryset(relations)
+        # связи страницы уже прочитаны, из них же и my_relation, отдельный запрос за ними не нужен
+        relations = {}
+        for relation in page:
+            del relation['id']
+            relations[relation.pop('book_id')] = relation
+        books = {row['id']: row for row in
+                 BookViewSet.queryset.filter(pk__in=list(relations)).values(*book_list_values())}
+        with serializer_timer():
+            data = books_list_data([books[book_id] for book_id in relations if book_id in books], request.user, relations)
+        return self.get_paginated_response(data)
+
+    @action(detail=False)
+    def counts(self, request):
+        return Response(shelf_counts(request.user))
+
+
+book_list = BookViewSet.as_view({'get': 'list'})
+book_detail = BookViewSet.as_view({'get': 'retrieve'})
+
+
+def render_read(view, request, *args, **kwargs):
+    # весь синхронный путь BookViewSet (кеш, ETag, фильтры, сериализация и рендер) в потоке из пула
+    try:
+        response = view(request, *args, **kwargs)
+        response.render()
+        return response
+    finally:
+        close_old_connections() # у потока пула свое соединение, закрываем его как после обычного запроса
+
+
+async def book_list_async(request):
+    """
+    GET /async/book/ under ASGI. Django 3.2 has no async ORM, and a sync DRF
+    view under ASGI runs with thread_sensitive=True, i.e. on the single shared
+    sync thread, one request at a time. Here the same BookViewSet read path
+    runs with thread_sensitive=False, so concurrent reads use the thread pool.
+    """
+    return await sync_to_async(render_read, thread_sensitive=False)(book_list, request)
+
+
+async def book_detail_async(request, pk):
+    return await sync_to_async(render_read, thread_sensitive=False)(book_detail, request, pk=pk)
+
+
+def metrics(request):
+    # гистограммы RequestMetricsMiddleware этого процесса в текстовом формате Prometheus
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 def auth(request):
     return render(request=request, template_name='oauth.html')